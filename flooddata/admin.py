@@ -1,9 +1,9 @@
 from django.contrib import admin
 from .models import (FloodZone, FloodEvent, MeasurementPoint, WaterLevelMeasurement, DEMFile, SatelliteImage, FloodAnalysis, WaterbodyVector)
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django.conf import settings
 import os
-from .utils import hydrological_dem_correction, process_satellite_image, create_flood_mask_vector
+from .tasks import process_dem_hydrology_bg, process_satellite_image_bg, import_waterbody_features_bg
 
 class MeasurementInline(admin.TabularInline):
     model = WaterLevelMeasurement
@@ -48,24 +48,16 @@ class DEMFileAdmin(admin.ModelAdmin):
 
     def run_hydro_correction(self, request, queryset):
         for dem in queryset:
-            base_name = os.path.splitext(os.path.basename(dem.file.name))[0]
-            corrected_path = f"dem_results/{base_name}_corrected.tif"
-            acc_path = f"dem_results/{base_name}_accumulation.tif"
-            abs_corrected = os.path.join(settings.MEDIA_ROOT, corrected_path)
-            abs_acc = os.path.join(settings.MEDIA_ROOT, acc_path)
-            os.makedirs(os.path.dirname(abs_corrected), exist_ok=True)
-            hydrological_dem_correction(dem.file.path, abs_corrected, abs_acc)
-            dem.corrected_file.name = corrected_path
-            dem.accumulation_file.name = acc_path
-            dem.processed = True
-            dem.save()
-            self.message_user(request, f"Гидрологическая коррекция выполнена для {dem.file.name}")
+            process_dem_hydrology_bg(dem.id, force=True)
+        self.message_user(request, f"Гидрологическая коррекция поставлена в очередь для {queryset.count()} файлов")
     run_hydro_correction.short_description = "Выполнить гидрологическую коррекцию DEM"
     
     def set_as_base_layer(self, request, queryset):
         for dem in queryset:
             dem.is_base_layer = True
             dem.save()
+            # Для базового слоя заранее готовим flow accumulation, которую используют анализы
+            process_dem_hydrology_bg(dem.id)
         self.message_user(request, f"Выбрано {queryset.count()} файлов как базовые слои")
     set_as_base_layer.short_description = "Установить как базовый слой"
     
@@ -84,33 +76,17 @@ class SatelliteImageAdmin(admin.ModelAdmin):
     actions = ['process_satellite_images', 'mark_as_processed', 'mark_as_error']
     
     def process_satellite_images(self, request, queryset):
+        count = 0
         for image in queryset:
             # Только для новых или с ошибкой
             if image.status not in ['new', 'error']:
                 continue
-                
             image.status = 'processing'
             image.save()
-            
-            try:
-                # Получаем путь к файлу и создаем путь для маски
-                image_path = image.file.path
-                base_name = os.path.splitext(os.path.basename(image_path))[0]
-                output_dir = os.path.join(settings.MEDIA_ROOT, 'satellite_results')
-                os.makedirs(output_dir, exist_ok=True)
-                
-                mask_path = os.path.join(output_dir, f"{base_name}_water_mask.tif")
-                
-                # Обрабатываем снимок для выделения воды
-                process_satellite_image(image_path, mask_path, method='simple')
-                
-                image.status = 'completed'
-                image.save()
-                self.message_user(request, f"Обработан снимок: {image.name}")
-            except Exception as e:
-                image.status = 'error'
-                image.save()
-                self.message_user(request, f"Ошибка при обработке {image.name}: {str(e)}", level='ERROR')
+            # Обработка выполняется рабочим процессом фоновых задач, а не в запросе
+            process_satellite_image_bg(image.id)
+            count += 1
+        self.message_user(request, f"Обработка поставлена в очередь для {count} снимков")
     process_satellite_images.short_description = "Обработать космические снимки"
     
     def mark_as_processed(self, request, queryset):
@@ -128,11 +104,40 @@ class FloodAnalysisAdmin(admin.ModelAdmin):
     list_display = ('name', 'created_at', 'created_by', 'status', 'flooded_area_sqkm')
     list_filter = ('created_at', 'status', 'compared_with_base')
     search_fields = ('name',)
-    readonly_fields = ('created_at', 'flooded_area_sqkm')
+    readonly_fields = ('created_at', 'flooded_area_sqkm', 'profile_table')
     actions = []  # Удалены действия, связанные с Celery
 
+    def profile_table(self, obj):
+        """Профиль этапов обработки в виде таблицы"""
+        if not obj.profile:
+            return "-"
+        columns = ('name', 'wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_bytes', 'children_peak_rss_bytes',
+                   'tracemalloc_peak_bytes', 'read_bytes', 'write_bytes')
+        mb_columns = {'peak_rss_bytes', 'children_peak_rss_bytes', 'tracemalloc_peak_bytes', 'read_bytes', 'write_bytes'}
+
+        def cell(stage, column):
+            value = stage.get(column)
+            if value is None:
+                return "-"
+            return f"{value / 1024 / 1024:.1f}" if column in mb_columns else value
+
+        header = format_html_join('', '<th>{}</th>', ((c.replace('_bytes', ', МБ'),) for c in columns))
+        rows = format_html_join('', '<tr>{}</tr>', (
+            (format_html_join('', '<td>{}</td>', ((cell(stage, c),) for c in columns)),)
+            for stage in obj.profile.get('stages', [])
+        ))
+        return format_html('<table><tr>{}</tr>{}</table><p>Всего: {} с</p>', header, rows, obj.profile.get('total_wall_s'))
+    profile_table.short_description = "Профиль обработки"
+
 @admin.register(WaterbodyVector)
 class WaterbodyVectorAdmin(admin.ModelAdmin):
-    list_display = ('name', 'upload_date', 'uploaded_by', 'is_active')
+    list_display = ('name', 'upload_date', 'uploaded_by', 'is_active', 'features_imported')
     search_fields = ('name',)
-    list_filter = ('is_active',)
\ No newline at end of file
+    list_filter = ('is_active', 'features_imported')
+    actions = ['import_features']
+
+    def import_features(self, request, queryset):
+        for layer in queryset:
+            import_waterbody_features_bg(layer.id)
+        self.message_user(request, f"Загрузка объектов в БД поставлена в очередь для {queryset.count()} слоёв")
+    import_features.short_description = "Загрузить объекты слоя в БД (PostGIS)"
\ No newline at end of file
@@ -0,0 +1,222 @@
+"""
+Кэш артефактов этапов анализа затоплений с адресацией по содержимому.
+Результат каждого этапа хранится в каталоге, имя которого - хэш входов этапа
+(хэши содержимого файлов, границы, пороги, метод). Повторный запуск с теми же входами
+берет готовый результат из кэша; в каталог анализа артефакты выкладываются жесткими ссылками.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Хэши содержимого файлов в рамках процесса: (путь, размер, время изменения) -> sha256
+_file_digests = {}
+
+
+def cache_dir():
+    """Корневой каталог кэша артефактов."""
+    return getattr(settings, 'FLOOD_ARTIFACT_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'artifact_cache'))
+
+
+def _digest_memo_path(memo_key):
+    """Файл с сохраненным хэшем версии файла (путь, размер, время изменения) в кэше артефактов."""
+    name = hashlib.sha1('|'.join(map(str, memo_key)).encode()).hexdigest()
+    return os.path.join(cache_dir(), '.digests', name[:2], name)
+
+
+def file_digest(*paths):
+    """
+    Хэш содержимого одного или нескольких файлов (sha256).
+    Хэш версии файла (путь, размер, время изменения) запоминается в процессе и сохраняется в кэше артефактов,
+    поэтому большие растры не перечитываются ни повторно, ни в новых процессах.
+    Args:
+        paths: пути к файлам
+    Returns:
+        hex-строка хэша
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in _file_digests:
+            memo_path = _digest_memo_path(memo_key)
+            try:
+                with open(memo_path, encoding='utf-8') as f:
+                    _file_digests[memo_key] = f.read().strip()
+            except FileNotFoundError:
+                file_hash = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        file_hash.update(chunk)
+                _file_digests[memo_key] = file_hash.hexdigest()
+                os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(memo_path))
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(_file_digests[memo_key])
+                os.replace(tmp_path, memo_path)
+        digest.update(_file_digests[memo_key].encode())
+    return digest.hexdigest()
+
+
+def stage_key(stage, inputs):
+    """
+    Ключ этапа: хэш имени этапа и его входов.
+    Args:
+        stage: имя этапа
+        inputs: dict входов (JSON-сериализуемые значения; для файлов - file_digest, для предыдущих этапов - их ключи)
+    Returns:
+        hex-строка ключа
+    """
+    payload = json.dumps({'stage': stage, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def stage_path(stage, key, name=''):
+    """Путь к каталогу этапа в кэше или к артефакту name в нем."""
+    return os.path.join(cache_dir(), stage, key, name)
+
+
+def load_stage(stage, key):
+    """
+    Метаданные готового этапа из кэша.
+    Returns:
+        dict метаданных или None, если этап еще не рассчитан
+    """
+    meta_path = stage_path(stage, key, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    # Время изменения meta.json - время последнего использования (для вытеснения LRU)
+    try:
+        os.utime(meta_path)
+    except OSError:
+        pass
+    return meta
+
+
+def publish_stage(stage, key, files, meta=None):
+    """
+    Помещает результаты этапа в кэш. Файлы переносятся во временный каталог,
+    который затем атомарно переименовывается в каталог этапа; meta.json - признак готовности.
+    Args:
+        stage: имя этапа
+        key: ключ этапа
+        files: dict {имя артефакта: путь к готовому файлу}
+        meta: JSON-сериализуемые метаданные этапа
+    Returns:
+        метаданные этапа
+    """
+    root = os.path.join(cache_dir(), stage)
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{key}.", dir=root)
+    for name, path in files.items():
+        shutil.move(path, os.path.join(tmp_dir, name))
+    meta = meta or {}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_dir, stage_path(stage, key))
+    except OSError:
+        # Этап уже опубликован параллельной задачей с теми же входами
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return meta
+
+
+def cached_stage(stage, inputs, build, max_bytes=None):
+    """
+    Результат этапа из кэша или его расчет и сохранение в кэш.
+    Args:
+        stage: имя этапа
+        inputs: dict входов этапа
+        build: функция build(tmp_dir), записывающая артефакты в tmp_dir и возвращающая метаданные (или None)
+        max_bytes: ограничение размера кэша этапа; давно не использованные результаты вытесняются
+    Returns:
+        (ключ этапа, метаданные)
+    """
+    key = stage_key(stage, inputs)
+    meta = load_stage(stage, key)
+    if meta is not None:
+        logger.info(f"Этап {stage}: результат взят из кэша ({key[:12]})")
+        return key, meta
+    logger.info(f"Этап {stage}: расчет ({key[:12]})")
+    root = os.path.join(cache_dir(), stage)
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{key}.build.", dir=root)
+    try:
+        meta = build(tmp_dir)
+        files = {name: os.path.join(tmp_dir, name) for name in os.listdir(tmp_dir)}
+        meta = publish_stage(stage, key, files, meta)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if max_bytes:
+        evict_stage(stage, max_bytes, keep=key)
+    return key, meta
+
+
+def evict_stage(stage, max_bytes, keep=None):
+    """
+    Вытеснение давно не использованных результатов этапа (LRU), пока размер кэша этапа больше max_bytes.
+    Выложенные в каталоги анализов жесткие ссылки при этом остаются действительными.
+    Args:
+        stage: имя этапа
+        max_bytes: допустимый размер кэша этапа в байтах
+        keep: ключ, который не вытесняется (только что рассчитанный результат)
+    Returns:
+        число вытесненных результатов
+    """
+    root = os.path.join(cache_dir(), stage)
+    entries = []
+    total = 0
+    for key in os.listdir(root):
+        meta_path = os.path.join(root, key, 'meta.json')
+        if key.startswith('.') or not os.path.exists(meta_path):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(root, key)) if entry.is_file())
+        entries.append((os.path.getmtime(meta_path), key, size))
+        total += size
+    evicted = 0
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(root, key), ignore_errors=True)
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(f"Кэш этапа {stage}: вытеснено результатов: {evicted}")
+    return evicted
+
+
+def discard_stage(stage, key):
+    """Удаляет результат этапа из кэша (например, если вытеснен результат этапа, от которого он зависит)."""
+    shutil.rmtree(stage_path(stage, key), ignore_errors=True)
+
+
+def link_artifact(stage, key, name, target_path):
+    """
+    Выкладывает артефакт этапа по пути target_path (жесткая ссылка, при невозможности - копия).
+    Returns:
+        target_path
+    """
+    source = stage_path(stage, key, name)
+    # Ссылка создается под временным именем и заменяет target_path атомарно (параллельные задачи не мешают друг другу)
+    directory, target_name = os.path.split(target_path)
+    tmp_path = os.path.join(directory, f".{target_name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+    return target_path
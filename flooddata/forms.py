@@ -93,11 +93,25 @@ class FloodAnalysisForm(forms.ModelForm):
         min_value=1,
         label="Порог flow accumulation (река/озеро)"
     )
+    min_region_pixels = forms.IntegerField(
+        required=False,
+        initial=0,
+        min_value=0,
+        label="Минимальный размер области воды (пикселей)"
+    )
+    mndwi_threshold = forms.FloatField(
+        required=False,
+        initial=0.0,
+        min_value=-1.0,
+        max_value=1.0,
+        label="Порог MNDWI"
+    )
     class Meta:
         model = FloodAnalysis
         fields = [
             'name', 'dem_file', 'green_band_image', 'swir2_band_image',
-            'permanent_water_method', 'waterbody_vector', 'accumulation_threshold'
+            'permanent_water_method', 'waterbody_vector', 'accumulation_threshold',
+            'min_region_pixels', 'mndwi_threshold'
         ]
     
     def __init__(self, *args, **kwargs):
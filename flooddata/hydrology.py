@@ -0,0 +1,515 @@
+"""
+Гидрологическая коррекция DEM в процессе: заполнение понижений (Priority-Flood), направления стока D8
+и аккумуляция стока (число ячеек водосбора, включая саму ячейку, как d8_flow_accumulation в WhiteboxTools).
+Работает с массивами в памяти, без внешних процессов и промежуточных файлов.
+DEM больше памяти обрабатывается по тайлам (tiled_fill_and_accumulate) с записью результатов в тайловые GeoTIFF.
+Циклы по ячейкам компилируются numba (если установлена), иначе выполняются интерпретатором.
+Модуль не зависит от Django.
+"""
+import heapq
+import logging
+import math
+import os
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+logger = logging.getLogger(__name__)
+
+try:
+    from numba import njit
+except ImportError:  # numba - необязательная зависимость
+    njit = None
+
+JIT_AVAILABLE = njit is not None
+
+# Смещения восьми соседей (строка, столбец)
+D8_ROW_OFFSETS = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+D8_COL_OFFSETS = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+# Коды растра направлений стока: 0..7 - индекс соседа-приемника, сток за пределы области данных, нет данных
+D8_OUTLET = 8
+D8_NODATA = 255
+# Значение "нет данных" растра аккумуляции (не зависит от nodata DEM: 65535 или 3.4e38 совпали бы с числом ячеек)
+ACC_NODATA = -32768.0
+
+
+def _jit(func):
+    """Компиляция функции numba, если она установлена."""
+    if njit is None:
+        return func
+    return njit(cache=True, nogil=True)(func)
+
+
+@_jit
+def _priority_flood(z, closed, seeds, rows, cols, row_offsets, col_offsets, epsilon):
+    """
+    Заполнение понижений Priority-Flood (Barnes et al., 2014).
+    Ячейки обрабатываются от начальных (края области данных) в порядке неубывания заполненной высоты;
+    ячейка ниже уже обработанного соседа поднимается до его высоты.
+    Args:
+        z: плоский массив высот float64 (заполняется на месте)
+        closed: плоский массив bool, True - ячейка не обрабатывается (изменяется на месте)
+        seeds: плоские индексы начальных ячеек
+        rows, cols: размер растра
+        row_offsets, col_offsets: смещения соседей D8
+        epsilon: поднимать ячейку на минимальное приращение выше соседа (Priority-Flood+epsilon):
+            в заполненном DEM не остается плоских участков, у каждой ячейки кроме начальных есть сосед ниже
+    Returns:
+        (order, parent): порядок обработки ячеек и ячейка, из которой достигнута каждая ячейка (-1 - начальная)
+    """
+    n = rows * cols
+    parent = np.full(n, -1, dtype=np.int64)
+    order = np.empty(n, dtype=np.int64)
+    # Очередь ям: заполняемые ячейки имеют высоту текущей ячейки и обрабатываются без кучи
+    pits = np.empty(n, dtype=np.int64)
+    heap = [(0.0, np.int64(0))]
+    heap.pop()
+    for i in seeds:
+        closed[i] = True
+        heapq.heappush(heap, (z[i], np.int64(i)))
+    count = 0
+    pit_head = 0
+    pit_tail = 0
+    while pit_head < pit_tail or len(heap) > 0:
+        if pit_head < pit_tail:
+            i = pits[pit_head]
+            pit_head += 1
+        else:
+            i = heapq.heappop(heap)[1]
+        order[count] = i
+        count += 1
+        r = i // cols
+        c = i - r * cols
+        for k in range(8):
+            nr = r + row_offsets[k]
+            nc = c + col_offsets[k]
+            if nr < 0 or nc < 0 or nr >= rows or nc >= cols:
+                continue
+            j = nr * cols + nc
+            if closed[j]:
+                continue
+            closed[j] = True
+            parent[j] = i
+            if epsilon:
+                # Без очереди ям: высоты ячеек в очереди различаются, порядок задает только куча
+                if z[j] <= z[i]:
+                    z[j] = np.nextafter(z[i], np.inf)
+                heapq.heappush(heap, (z[j], np.int64(j)))
+            elif z[j] <= z[i]:
+                # Понижение или плоский участок: высота поднимается до уровня перелива
+                z[j] = z[i]
+                pits[pit_tail] = j
+                pit_tail += 1
+            else:
+                heapq.heappush(heap, (z[j], np.int64(j)))
+    return order[:count], parent
+
+
+@_jit
+def _accumulate_directions(directions, weights, rows, cols, row_offsets, col_offsets):
+    """
+    Аккумуляция стока по растру направлений D8 (топологическая сортировка: ячейка передает сток
+    приемнику после того, как в нее пришел сток от всех ячеек водосбора).
+    Args:
+        directions: плоский массив кодов направлений (D8_OUTLET, D8_NODATA - ячейка не передает сток)
+        weights: плоский массив собственного стока ячеек (float64)
+        rows, cols: размер растра
+        row_offsets, col_offsets: смещения соседей D8
+    Returns:
+        плоский массив аккумуляции float64
+    """
+    n = rows * cols
+    receivers = np.full(n, -1, dtype=np.int64)
+    indegree = np.zeros(n, dtype=np.int32)
+    for i in range(n):
+        k = directions[i]
+        if k < 8:
+            r = i // cols + row_offsets[k]
+            c = i % cols + col_offsets[k]
+            if 0 <= r < rows and 0 <= c < cols:
+                receivers[i] = r * cols + c
+                indegree[r * cols + c] += 1
+    stack = np.empty(n, dtype=np.int64)
+    top = 0
+    for i in range(n):
+        if indegree[i] == 0 and directions[i] != D8_NODATA:
+            stack[top] = i
+            top += 1
+    acc = weights.copy()
+    while top > 0:
+        top -= 1
+        i = stack[top]
+        j = receivers[i]
+        if j < 0:
+            continue
+        acc[j] += acc[i]
+        indegree[j] -= 1
+        if indegree[j] == 0 and directions[j] != D8_NODATA:
+            stack[top] = j
+            top += 1
+    return acc
+
+
+def cell_size(transform, crs=None, height=0):
+    """
+    Размер ячейки в метрах (по X и по Y).
+    Для географической CRS градусы переводятся в метры по широте центра растра (как в WhiteboxTools).
+    Args:
+        transform: Affine растра
+        crs: CRS растра (rasterio CRS, строка или None)
+        height: число строк растра (для широты центра)
+    Returns:
+        (dx, dy)
+    """
+    dx, dy = abs(transform.a), abs(transform.e)
+    if crs is not None and getattr(crs, 'is_geographic', False):
+        lat = math.radians(transform.f + transform.e * height / 2)
+        dx *= 111320.0 * math.cos(lat)
+        dy *= 110574.0
+    return dx, dy
+
+
+def edge_seeds(valid):
+    """
+    Начальные ячейки заполнения: ячейки с данными на границе растра или рядом с ячейками без данных.
+    Args:
+        valid: 2D-массив bool ячеек с данными
+    Returns:
+        плоские индексы ячеек
+    """
+    rows, cols = valid.shape
+    outside = np.pad(~valid, 1, constant_values=True)
+    near = np.zeros_like(valid)
+    for dr, dc in zip(D8_ROW_OFFSETS, D8_COL_OFFSETS):
+        near |= outside[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+    return np.flatnonzero(valid & near)
+
+
+def priority_flood_fill(dem, valid=None, seeds=None, epsilon=False):
+    """
+    Заполнение понижений DEM.
+    Args:
+        dem: 2D-массив высот
+        valid: 2D-массив bool ячеек с данными (None - все конечные значения)
+        seeds: плоские индексы начальных ячеек (None - edge_seeds)
+        epsilon: заполнение с минимальным уклоном (без плоских участков)
+    Returns:
+        (filled, order, parent): заполненный DEM (float64), порядок обработки ячеек
+        и ячейка, из которой достигнута каждая ячейка (плоские индексы)
+    """
+    if valid is None:
+        valid = np.isfinite(dem)
+    if seeds is None:
+        seeds = edge_seeds(valid)
+    rows, cols = dem.shape
+    z = np.array(dem, dtype=np.float64).ravel()
+    closed = ~np.asarray(valid, dtype=bool).ravel()
+    order, parent = _priority_flood(z, closed, np.asarray(seeds, dtype=np.int64), rows, cols,
+                                    D8_ROW_OFFSETS, D8_COL_OFFSETS, epsilon)
+    return z.reshape(rows, cols), order, parent
+
+
+def d8_directions(filled, valid, dx=1.0, dy=1.0):
+    """
+    Направления стока D8: каждая ячейка отдает сток соседу с наибольшим уклоном вниз.
+    Args:
+        filled: заполненный DEM
+        valid: 2D-массив bool ячеек с данными
+        dx, dy: размер ячейки по X и по Y
+    Returns:
+        2D-массив uint8 кодов направлений (D8_OUTLET - нет соседа ниже, D8_NODATA - нет данных)
+    """
+    rows, cols = filled.shape
+    z = np.where(valid, filled, np.inf)
+    best = np.zeros((rows, cols), dtype=np.float64)
+    directions = np.full((rows, cols), D8_OUTLET, dtype=np.uint8)
+    diagonal = math.hypot(dx, dy)
+    for k, (dr, dc) in enumerate(zip(D8_ROW_OFFSETS, D8_COL_OFFSETS)):
+        distance = diagonal if dr and dc else (dx if dc else dy)
+        # Срезы ячеек и их соседей со смещением (dr, dc)
+        src = (slice(max(-dr, 0), rows - max(dr, 0)), slice(max(-dc, 0), cols - max(dc, 0)))
+        dst = (slice(max(dr, 0), rows + min(dr, 0)), slice(max(dc, 0), cols + min(dc, 0)))
+        with np.errstate(invalid='ignore'):
+            slope = z[src] - z[dst]
+        slope /= distance
+        steeper = slope > best[src]
+        np.copyto(best[src], slope, where=steeper)
+        directions[src][steeper] = k
+    directions[~valid] = D8_NODATA
+    return directions
+
+
+def fill_and_accumulate(dem, valid=None, dx=1.0, dy=1.0):
+    """
+    Заполнение понижений и аккумуляция стока D8 по DEM в памяти.
+    Заполнение Priority-Flood+epsilon (без плоских участков), направления D8 по заполненной поверхности
+    и аккумуляция по растру направлений - так же, как в tiled_fill_and_accumulate, поэтому результат
+    не зависит от того, обрабатывается DEM в памяти или по тайлам.
+    Args:
+        dem: 2D-массив высот
+        valid: 2D-массив bool ячеек с данными (None - все конечные значения)
+        dx, dy: размер ячейки по X и по Y (для уклонов D8)
+    Returns:
+        (filled, accumulation): заполненный DEM (float64, с приращениями epsilon) и аккумуляция (float64, 0 вне данных)
+    """
+    if valid is None:
+        valid = np.isfinite(dem)
+    filled, _, _ = priority_flood_fill(dem, valid, epsilon=True)
+    directions = d8_directions(filled, valid, dx, dy)
+    accumulation = _accumulate_directions(directions.ravel(), valid.ravel().astype(np.float64), *directions.shape,
+                                          D8_ROW_OFFSETS, D8_COL_OFFSETS)
+    return filled, accumulation.reshape(filled.shape)
+
+
+# --- Обработка DEM по тайлам (DEM больше памяти) ---
+
+def iter_tiles(height, width, tile_size):
+    """
+    Сетка квадратных тайлов растра.
+    Returns:
+        список строк сетки, каждая - список rasterio.windows.Window
+    """
+    return [
+        [Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+         for col_off in range(0, width, tile_size)]
+        for row_off in range(0, height, tile_size)
+    ]
+
+
+class TileSeams:
+    """
+    Значения на краях тайлов (первая и последняя строка и столбец каждого тайла) для обмена между тайлами.
+    Тайл обрабатывается с ореолом в одну ячейку, значения ореола берутся с краев соседних тайлов.
+    Память - несколько строк и столбцов на тайл, а не весь растр.
+    """
+
+    def __init__(self, height, width, tile_size, fill_value):
+        self.height = height
+        self.width = width
+        self.fill_value = fill_value
+        self.rows = {}
+        self.cols = {}
+        for row_off in range(0, height, tile_size):
+            for row in (row_off, min(row_off + tile_size, height) - 1):
+                self.rows[row] = np.full(width, fill_value, dtype=np.float64)
+        for col_off in range(0, width, tile_size):
+            for col in (col_off, min(col_off + tile_size, width) - 1):
+                self.cols[col] = np.full(height, fill_value, dtype=np.float64)
+
+    def halo(self, window):
+        """
+        Массив тайла с ореолом (высота + 2, ширина + 2): в ореоле - значения соседних тайлов,
+        за пределами растра и внутри тайла - fill_value.
+        """
+        r0, c0 = window.row_off, window.col_off
+        r1, c1 = r0 + window.height, c0 + window.width
+        out = np.full((window.height + 2, window.width + 2), self.fill_value, dtype=np.float64)
+        left, right = max(c0 - 1, 0), min(c1 + 1, self.width)
+        if r0 > 0:
+            out[0, left - c0 + 1:right - c0 + 1] = self.rows[r0 - 1][left:right]
+        if r1 < self.height:
+            out[-1, left - c0 + 1:right - c0 + 1] = self.rows[r1][left:right]
+        if c0 > 0:
+            out[1:-1, 0] = self.cols[c0 - 1][r0:r1]
+        if c1 < self.width:
+            out[1:-1, -1] = self.cols[c1][r0:r1]
+        return out
+
+    def store(self, window, values):
+        """
+        Сохраняет края тайла (values - массив тайла без ореола).
+        Returns:
+            (верхний, нижний, левый, правый): признаки изменения краев (соседние тайлы нужно пересчитать)
+        """
+        r0, c0 = window.row_off, window.col_off
+        r1, c1 = r0 + window.height, c0 + window.width
+        edges = (
+            (self.rows[r0], slice(c0, c1), values[0, :]),
+            (self.rows[r1 - 1], slice(c0, c1), values[-1, :]),
+            (self.cols[c0], slice(r0, r1), values[:, 0]),
+            (self.cols[c1 - 1], slice(r0, r1), values[:, -1]),
+        )
+        changed = []
+        for seam, part, edge in edges:
+            changed.append(not np.array_equal(seam[part], edge))
+            if changed[-1]:
+                seam[part] = edge
+        return tuple(changed)
+
+
+def sweep_tiles(tiles, process):
+    """
+    Итеративные проходы по сетке тайлов до установления значений на краях.
+    Тайл пересчитывается, если изменились прилегающие к нему края соседних тайлов; направление обхода
+    чередуется, чтобы значения распространялись через сетку в обе стороны за меньшее число проходов.
+    Args:
+        tiles: сетка тайлов (из iter_tiles)
+        process: функция (window) -> признаки изменения краев тайла (из TileSeams.store)
+    Returns:
+        число проходов
+    """
+    n_rows, n_cols = len(tiles), len(tiles[0])
+    dirty = np.ones((n_rows, n_cols), dtype=bool)
+    cells = [(i, j) for i in range(n_rows) for j in range(n_cols)]
+    passes = 0
+    while dirty.any():
+        for i, j in (cells if passes % 2 == 0 else reversed(cells)):
+            if not dirty[i, j]:
+                continue
+            dirty[i, j] = False
+            top, bottom, left, right = process(tiles[i][j])
+            near_cols = slice(max(j - 1, 0), j + 2)
+            near_rows = slice(max(i - 1, 0), i + 2)
+            if top and i > 0:
+                dirty[i - 1, near_cols] = True
+            if bottom:
+                dirty[i + 1:i + 2, near_cols] = True
+            if left and j > 0:
+                dirty[near_rows, j - 1] = True
+            if right:
+                dirty[near_rows, j + 1:j + 2] = True
+        passes += 1
+    return passes
+
+
+def read_padded(src, window, fill_value, dtype=None):
+    """
+    Чтение окна тайла с ореолом в одну ячейку; ячейки за пределами растра заполняются fill_value.
+    Returns:
+        (values, valid): массив (высота + 2, ширина + 2) и маска ячеек с данными
+    """
+    r0, c0 = window.row_off - 1, window.col_off - 1
+    top, left = max(r0, 0), max(c0, 0)
+    bottom = min(r0 + window.height + 2, src.height)
+    right = min(c0 + window.width + 2, src.width)
+    data = src.read(1, window=Window(left, top, right - left, bottom - top), masked=True)
+    values = np.full((window.height + 2, window.width + 2), fill_value, dtype=dtype or data.dtype)
+    valid = np.zeros(values.shape, dtype=bool)
+    part = (slice(top - r0, bottom - r0), slice(left - c0, right - c0))
+    values[part] = data.data
+    valid[part] = ~np.ma.getmaskarray(data)
+    if values.dtype.kind == 'f':
+        valid &= np.isfinite(values)
+    return values, valid
+
+
+def tiled_profile(src, tile_size, dtype, nodata):
+    """Профиль тайлового GeoTIFF результата (блоки перезаписываются на месте, без сжатия)."""
+    profile = src.profile.copy()
+    block = 256 if tile_size % 256 == 0 else 16 * max(1, min(tile_size, 256) // 16)
+    profile.update(driver='GTiff', count=1, dtype=dtype, nodata=nodata, tiled=True,
+                   blockxsize=block, blockysize=block, BIGTIFF='IF_SAFER')
+    profile.pop('compress', None)
+    return profile
+
+
+def tiled_fill_and_accumulate(dem_path, filled_path, acc_path, tile_size=4096, already_filled=False, scratch_dir=None):
+    """
+    Заполнение понижений и аккумуляция стока D8 для DEM, не помещающегося в память.
+    DEM обрабатывается тайлами с ореолом в одну ячейку, пиковая память определяется размером тайла.
+    1. Заполнение (Priority-Flood+epsilon) в каждом тайле от краев области данных и от ореола
+       (заполненные высоты соседних тайлов); проходы повторяются, пока высоты на краях тайлов меняются.
+       В каждом тайле сохраняются направления D8 по заполненной поверхности (без плоских участков).
+    2. Аккумуляция по направлениям в каждом тайле с притоком из ореола (аккумуляция ячеек соседних тайлов,
+       стекающих в тайл); проходы повторяются, пока аккумуляция на краях тайлов меняется.
+    Результат совпадает с fill_and_accumulate для всего DEM в памяти.
+    Args:
+        dem_path: путь к исходному DEM
+        filled_path: путь для сохранения заполненного DEM (тайловый GeoTIFF)
+        acc_path: путь для сохранения аккумуляции (тайловый GeoTIFF, float32)
+        tile_size: размер стороны тайла (пикселей)
+        already_filled: DEM уже заполнен - сохраняется без изменений, заполнение нужно только для направлений
+        scratch_dir: каталог временного растра направлений (по умолчанию каталог acc_path)
+    Returns:
+        dict: число тайлов, проходов заполнения и аккумуляции, ячеек с данными, максимальная аккумуляция
+    """
+    with rasterio.open(dem_path) as src:
+        height, width = src.height, src.width
+        dtype = np.dtype(src.dtypes[0])
+        nodata = src.nodata
+        dx, dy = cell_size(src.transform, src.crs, src.height)
+        filled_profile = tiled_profile(src, tile_size, dtype.name, nodata)
+        acc_profile = tiled_profile(src, tile_size, 'float32', ACC_NODATA)
+        dir_profile = tiled_profile(src, tile_size, 'uint8', D8_NODATA)
+    tiles = iter_tiles(height, width, tile_size)
+    fd, dir_path = tempfile.mkstemp(suffix='_d8.tif', dir=scratch_dir or os.path.dirname(os.path.abspath(acc_path)))
+    os.close(fd)
+    stats = {'tiles': len(tiles) * len(tiles[0]), 'valid_cells': 0, 'max_accumulation': 0.0}
+    try:
+        seams = TileSeams(height, width, tile_size, np.inf)
+        with rasterio.open(dem_path) as src, \
+                rasterio.open(filled_path, 'w', **filled_profile) as filled_dst, \
+                rasterio.open(dir_path, 'w', **dir_profile) as dir_dst:
+
+            def fill_tile(window):
+                dem, valid = read_padded(src, window, 0, np.float64)
+                ring = np.ones(dem.shape, dtype=bool)
+                ring[1:-1, 1:-1] = False
+                z = np.where(ring, seams.halo(window), dem)
+                # Начальные ячейки: края области данных внутри тайла и ореол с уже известными высотами
+                seeds = edge_seeds(valid)
+                seeds = np.concatenate([seeds[~ring.ravel()[seeds]], np.flatnonzero(ring & valid & np.isfinite(z))])
+                filled, order, _ = priority_flood_fill(z, valid & ~ring, seeds, epsilon=True)
+                # Ячейки, до которых заполнение не дошло, ждут высот соседних тайлов
+                reached = np.zeros(filled.size, dtype=bool)
+                reached[order] = True
+                filled.ravel()[~reached & valid.ravel()] = np.inf
+                inner = filled[1:-1, 1:-1]
+                changed = seams.store(window, inner)
+                directions = d8_directions(filled, valid & np.isfinite(filled), dx, dy)[1:-1, 1:-1]
+                inner_valid = valid[1:-1, 1:-1]
+                if already_filled:
+                    out = dem[1:-1, 1:-1]
+                elif dtype.kind in 'iu':
+                    out = np.floor(inner)  # Приращения epsilon отбрасываются
+                else:
+                    out = inner
+                out = np.where(inner_valid, out, nodata if nodata is not None else 0).astype(dtype)
+                filled_dst.write(out, 1, window=window)
+                dir_dst.write(directions, 1, window=window)
+                return changed
+
+            stats['fill_passes'] = sweep_tiles(tiles, fill_tile)
+        del seams
+        logger.info(f"Заполнение DEM {dem_path} по тайлам: тайлов {stats['tiles']}, проходов {stats['fill_passes']}")
+
+        seams = TileSeams(height, width, tile_size, 0.0)
+        with rasterio.open(dir_path) as dir_src, rasterio.open(acc_path, 'w', **acc_profile) as acc_dst:
+
+            def accumulate_tile(window):
+                directions, _ = read_padded(dir_src, window, D8_NODATA)
+                inflow = seams.halo(window)
+                ring = np.ones(directions.shape, dtype=bool)
+                ring[1:-1, 1:-1] = False
+                weights = np.where(~ring & (directions != D8_NODATA), 1.0, 0.0)
+                # Приток из ореола: ячейки соседних тайлов, приемник которых внутри тайла
+                rr, cc = np.nonzero(ring & (directions < 8))
+                k = directions[rr, cc]
+                tr, tc = rr + D8_ROW_OFFSETS[k], cc + D8_COL_OFFSETS[k]
+                inside = (tr >= 1) & (tc >= 1) & (tr <= window.height) & (tc <= window.width)
+                np.add.at(weights, (tr[inside], tc[inside]), inflow[rr[inside], cc[inside]])
+                directions[ring] = D8_NODATA
+                acc = _accumulate_directions(directions.ravel(), weights.ravel(), *directions.shape,
+                                             D8_ROW_OFFSETS, D8_COL_OFFSETS).reshape(directions.shape)[1:-1, 1:-1]
+                changed = seams.store(window, acc)
+                inner_valid = directions[1:-1, 1:-1] != D8_NODATA
+                acc_dst.write(np.where(inner_valid, acc, ACC_NODATA).astype(np.float32), 1, window=window)
+                return changed
+
+            stats['accumulation_passes'] = sweep_tiles(tiles, accumulate_tile)
+
+        # Итоговая статистика - отдельным проходом: при пересчете тайла предыдущие значения перезаписываются
+        with rasterio.open(acc_path) as acc_src:
+            for row in tiles:
+                for window in row:
+                    acc = acc_src.read(1, window=window, masked=True)
+                    if acc.count():
+                        stats['valid_cells'] += int(acc.count())
+                        stats['max_accumulation'] = max(stats['max_accumulation'], float(acc.max()))
+        logger.info(f"Аккумуляция DEM {dem_path} по тайлам: проходов {stats['accumulation_passes']}, "
+                    f"максимальная аккумуляция {stats['max_accumulation']}")
+        return stats
+    finally:
+        if os.path.exists(dir_path):
+            os.remove(dir_path)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import numpy as np
+import os
+import rasterio
+from flooddata.hydrology import tiled_fill_and_accumulate
+from flooddata.utils import native_dem_correction
+from flooddata.workspace import scratch_workspace
+
+class Command(BaseCommand):
+    help = ('Проверка совпадения гидрологической коррекции DEM в памяти и по тайлам: заполненный DEM и аккумуляция '
+            'должны совпадать по ячейкам (иначе маска постоянных вод зависит от размера DEM)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('dem_path', type=str, help='Путь к DEM (GeoTIFF, помещающийся в память)')
+        parser.add_argument('--tile-size', type=int, default=256,
+                            help='Размер тайла (меньше DEM, чтобы проверить обмен значениями на швах тайлов)')
+        parser.add_argument('--already-filled', action='store_true', help='DEM уже заполнен (базовый слой)')
+
+    def handle(self, *args, **options):
+        dem_path = options['dem_path']
+        if not os.path.exists(dem_path):
+            raise CommandError(f'DEM не найден: {dem_path}')
+        with scratch_workspace(getattr(settings, 'FLOOD_SCRATCH_DIR', None), 'hydro_check') as workdir:
+            paths = {
+                engine: (os.path.join(workdir, f'{engine}_filled.tif'), os.path.join(workdir, f'{engine}_acc.tif'))
+                for engine in ('native', 'tiled')
+            }
+            native_dem_correction(dem_path, *paths['native'], already_filled=options['already_filled'])
+            stats = tiled_fill_and_accumulate(dem_path, *paths['tiled'], tile_size=options['tile_size'],
+                                              already_filled=options['already_filled'], scratch_dir=workdir)
+            self.stdout.write(f"Тайлов: {stats['tiles']}, проходов заполнения: {stats['fill_passes']}, "
+                              f"аккумуляции: {stats['accumulation_passes']}")
+            mismatches = {}
+            for i, name in enumerate(('filled', 'accumulation')):
+                with rasterio.open(paths['native'][i]) as a, rasterio.open(paths['tiled'][i]) as b:
+                    x = a.read(1, masked=True)
+                    y = b.read(1, masked=True)
+                mask_x, mask_y = np.ma.getmaskarray(x), np.ma.getmaskarray(y)
+                differ = (mask_x != mask_y) | (~mask_x & ~mask_y & (x.data != y.data))
+                mismatches[name] = int(differ.sum())
+                self.stdout.write(f'{name}: ячеек {x.size}, несовпадений {mismatches[name]}')
+        if any(mismatches.values()):
+            raise CommandError(f'Результаты в памяти и по тайлам не совпадают: {mismatches}')
+        self.stdout.write(self.style.SUCCESS('Результаты в памяти и по тайлам совпадают'))
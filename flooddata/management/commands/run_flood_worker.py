@@ -0,0 +1,54 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.conf import settings
+import importlib
+import time
+from flooddata.raster_processing import start_persistent_pool
+from flooddata.workspace import remove_stale_workspaces
+
+# Тяжелые библиотеки, которые задачи импортируют при первом вызове (GDAL, растры, геометрии, отрисовка, whitebox)
+PRELOAD_MODULES = (
+    'osgeo.gdal',
+    'rasterio',
+    'geopandas',
+    'shapely',
+    'pyproj',
+    'scipy.ndimage',
+    'skimage.measure',
+    'matplotlib.pyplot',
+    'whitebox.whitebox_tools',
+    'flooddata.utils',
+    'flooddata.tasks',
+)
+
+class Command(BaseCommand):
+    help = ('Рабочий процесс фоновых задач (process_tasks) с заранее импортированными геобиблиотеками '
+            'и запущенным пулом процессов анализа, общим для всех задач')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов пула анализа (по умолчанию FLOOD_ANALYSIS_WORKERS)')
+        parser.add_argument('--queue', type=str, default=None, help='Очередь фоновых задач')
+        parser.add_argument('--duration', type=int, default=0, help='Время работы в секундах (0 - без ограничения)')
+        parser.add_argument('--sleep', type=float, default=5.0, help='Пауза между проверками очереди, с')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        for module in PRELOAD_MODULES:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                self.stdout.write(self.style.WARNING(f'Модуль {module} не импортирован заранее: {e}'))
+        # Рабочие каталоги задач, оставшиеся после аварийного завершения прежних процессов (на tmpfs они занимают память)
+        remove_stale_workspaces(getattr(settings, 'FLOOD_SCRATCH_DIR', None))
+        # Пул запускается до обработки задач: анализы используют его вместо запуска своих процессов
+        workers = options['workers'] or getattr(settings, 'FLOOD_ANALYSIS_WORKERS', 1)
+        start_persistent_pool(workers)
+        self.stdout.write(self.style.SUCCESS(
+            f'Рабочий процесс готов за {time.perf_counter() - started:.1f} с (процессов пула: {workers})'
+        ))
+
+        task_options = {'duration': options['duration'], 'sleep': options['sleep']}
+        if options['queue']:
+            task_options['queue'] = options['queue']
+        call_command('process_tasks', **task_options)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='satelliteimage',
+            name='band_stats',
+            field=models.JSONField(blank=True, null=True, verbose_name='Статистика канала'),
+        ),
+    ]
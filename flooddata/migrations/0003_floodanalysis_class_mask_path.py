@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0002_satelliteimage_band_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floodanalysis',
+            name='class_mask_path',
+            field=models.CharField(blank=True, max_length=512, null=True, verbose_name='Путь к растру классов'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0003_floodanalysis_class_mask_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floodanalysis',
+            name='min_region_pixels',
+            field=models.PositiveIntegerField(default=0, verbose_name='Минимальный размер области воды (пикселей)'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0004_floodanalysis_min_region_pixels'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='demfile',
+            name='corrected_file',
+            field=models.FileField(blank=True, null=True, upload_to='dem_results/', verbose_name='Скорректированный DEM'),
+        ),
+        migrations.AddField(
+            model_name='demfile',
+            name='accumulation_file',
+            field=models.FileField(blank=True, null=True, upload_to='dem_results/', verbose_name='Flow accumulation'),
+        ),
+        migrations.AddField(
+            model_name='demfile',
+            name='processed',
+            field=models.BooleanField(default=False, verbose_name='Гидрологическая коррекция выполнена'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:30
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0005_demfile_hydrology'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='waterbodyvector',
+            name='features_imported',
+            field=models.BooleanField(default=False, verbose_name='Объекты загружены в БД'),
+        ),
+        migrations.CreateModel(
+            name='WaterbodyFeature',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geometry', django.contrib.gis.db.models.fields.GeometryField(srid=4326, verbose_name='Геометрия')),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='features', to='flooddata.waterbodyvector', verbose_name='Слой водоёмов')),
+            ],
+            options={
+                'verbose_name': 'Объект слоя водоёмов',
+                'verbose_name_plural': 'Объекты слоёв водоёмов',
+            },
+        ),
+        migrations.CreateModel(
+            name='WaterbodyFeatureProjection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('srid', models.IntegerField(db_index=True, verbose_name='EPSG-код CRS')),
+                ('wkb', models.BinaryField(verbose_name='Геометрия (WKB)')),
+                ('feature', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='projections', to='flooddata.waterbodyfeature', verbose_name='Объект')),
+            ],
+            options={
+                'verbose_name': 'Проекция объекта водоёма',
+                'verbose_name_plural': 'Проекции объектов водоёмов',
+                'unique_together': {('feature', 'srid')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0006_waterbodyfeature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floodanalysis',
+            name='mndwi_threshold',
+            field=models.FloatField(default=0.0, verbose_name='Порог MNDWI'),
+        ),
+        migrations.AddField(
+            model_name='floodanalysis',
+            name='mndwi_index_path',
+            field=models.CharField(blank=True, max_length=512, null=True, verbose_name='Путь к индексу MNDWI'),
+        ),
+        migrations.AddField(
+            model_name='floodanalysis',
+            name='mndwi_histogram',
+            field=models.JSONField(blank=True, null=True, verbose_name='Гистограмма индекса MNDWI'),
+        ),
+    ]
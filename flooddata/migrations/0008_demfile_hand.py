@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0007_floodanalysis_mndwi_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='demfile',
+            name='hand_file',
+            field=models.FileField(blank=True, null=True, upload_to='dem_results/', verbose_name='HAND'),
+        ),
+        migrations.AddField(
+            model_name='demfile',
+            name='hand_index',
+            field=models.JSONField(blank=True, null=True, verbose_name='Индекс уровень-площадь HAND'),
+        ),
+    ]
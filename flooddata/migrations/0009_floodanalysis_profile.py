@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0008_demfile_hand'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='floodanalysis',
+            name='profile',
+            field=models.JSONField(blank=True, null=True, verbose_name='Профиль обработки'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 17:40
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0009_floodanalysis_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='demfile',
+            name='footprint',
+            field=django.contrib.gis.db.models.fields.PolygonField(blank=True, null=True, srid=4326, verbose_name='Охват DEM'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flooddata', '0010_demfile_footprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='waterbodyvector',
+            name='features_digest',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Хэш загруженного shapefile'),
+        ),
+    ]
@@ -131,6 +131,15 @@ class DEMFile(models.Model):
                                    related_name="dem_files", verbose_name="Загружено")
     is_active = models.BooleanField(default=True, verbose_name="Активен")
     is_base_layer = models.BooleanField(default=False, verbose_name="Базовый слой")
+    # Заполненный DEM и flow accumulation считаются один раз для всего DEM (в фоне после загрузки)
+    corrected_file = models.FileField(upload_to='dem_results/', null=True, blank=True, verbose_name="Скорректированный DEM")
+    accumulation_file = models.FileField(upload_to='dem_results/', null=True, blank=True, verbose_name="Flow accumulation")
+    processed = models.BooleanField(default=False, verbose_name="Гидрологическая коррекция выполнена")
+    # HAND (высота над ближайшим водотоком) и индекс "уровень воды - площадь затопления" (накопленные площади по уровням)
+    hand_file = models.FileField(upload_to='dem_results/', null=True, blank=True, verbose_name="HAND")
+    hand_index = models.JSONField(null=True, blank=True, verbose_name="Индекс уровень-площадь HAND")
+    # Охват DEM (WGS84): по нему выбираются листы DEM, пересекающие снимок, для виртуальной мозаики
+    footprint = models.PolygonField(srid=4326, null=True, blank=True, spatial_index=True, verbose_name="Охват DEM")
     
     class Meta:
         verbose_name = "DEM файл"
@@ -161,6 +170,8 @@ class SatelliteImage(models.Model):
         verbose_name="Статус"
     )
     area = models.PolygonField(srid=4326, null=True, blank=True, verbose_name="Область снимка")
+    # Статистика канала (min/max/перцентили/гистограмма), рассчитывается один раз после загрузки
+    band_stats = models.JSONField(null=True, blank=True, verbose_name="Статистика канала")
     
     class Meta:
         verbose_name = "Космический снимок"
@@ -202,6 +213,8 @@ class FloodAnalysis(models.Model):
     # Новые поля для хранения путей к маскам и площадям
     dem_mask_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к маске воды DEM")
     mndwi_mask_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к маске воды MNDWI")
+    # Растр классов: 0 - суша, 1 - только пост. воды, 2 - только снимок, 3 - совпадающая вода
+    class_mask_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к растру классов")
     only_dem_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к GeoJSON только DEM")
     only_mndwi_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к GeoJSON только снимок")
     both_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к GeoJSON совпадающие")
@@ -220,6 +233,16 @@ class FloodAnalysis(models.Model):
     )
     waterbody_vector = models.ForeignKey('WaterbodyVector', on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Векторный слой водоёмов")
     accumulation_threshold = models.IntegerField(null=True, blank=True, default=1000, verbose_name="Порог flow accumulation")
+    # Области воды MNDWI не больше этого размера удаляются из маски до векторизации (0 - без удаления)
+    min_region_pixels = models.PositiveIntegerField(default=0, verbose_name="Минимальный размер области воды (пикселей)")
+    # Вода по снимку - пиксели с MNDWI выше порога (порог округляется до 0.01)
+    mndwi_threshold = models.FloatField(default=0.0, verbose_name="Порог MNDWI")
+    # Квантованный индекс MNDWI (uint8: ceil(MNDWI*100)+100, 255 - нет данных) и его гистограмма по площадям
+    # вне/на постоянных водах - для расчета площадей и повторной векторизации при другом пороге
+    mndwi_index_path = models.CharField(max_length=512, null=True, blank=True, verbose_name="Путь к индексу MNDWI")
+    mndwi_histogram = models.JSONField(null=True, blank=True, verbose_name="Гистограмма индекса MNDWI")
+    # Профиль этапов обработки: время, процессорное время, пиковая память, объем чтения/записи (см. profiling.py)
+    profile = models.JSONField(null=True, blank=True, verbose_name="Профиль обработки")
     
     class Meta:
         verbose_name = "Анализ затопления"
@@ -237,6 +260,9 @@ class WaterbodyVector(models.Model):
     upload_date = models.DateTimeField(auto_now_add=True, verbose_name="Дата загрузки")
     uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name="waterbody_vectors", verbose_name="Загружено")
     is_active = models.BooleanField(default=True, verbose_name="Активен")
+    features_imported = models.BooleanField(default=False, verbose_name="Объекты загружены в БД")
+    # Хэш файлов shapefile, объекты которого загружены в БД (по нему обнаруживается замена shapefile)
+    features_digest = models.CharField(max_length=64, null=True, blank=True, verbose_name="Хэш загруженного shapefile")
 
     class Meta:
         verbose_name = "Векторный слой водоёмов"
@@ -244,4 +270,24 @@ class WaterbodyVector(models.Model):
         ordering = ['-upload_date']
 
     def __str__(self):
-        return f"{self.name} ({self.upload_date.strftime('%d.%m.%Y')})"
\ No newline at end of file
+        return f"{self.name} ({self.upload_date.strftime('%d.%m.%Y')})"
+
+class WaterbodyFeature(models.Model):
+    """Объект векторного слоя водоёмов в PostGIS (с пространственным индексом GiST)"""
+    layer = models.ForeignKey(WaterbodyVector, on_delete=models.CASCADE, related_name="features", verbose_name="Слой водоёмов")
+    geometry = models.GeometryField(srid=4326, spatial_index=True, verbose_name="Геометрия")
+
+    class Meta:
+        verbose_name = "Объект слоя водоёмов"
+        verbose_name_plural = "Объекты слоёв водоёмов"
+
+class WaterbodyFeatureProjection(models.Model):
+    """Заранее перепроецированная копия объекта водоёма (WKB) в часто используемой CRS (зоны UTM)"""
+    feature = models.ForeignKey(WaterbodyFeature, on_delete=models.CASCADE, related_name="projections", verbose_name="Объект")
+    srid = models.IntegerField(db_index=True, verbose_name="EPSG-код CRS")
+    wkb = models.BinaryField(verbose_name="Геометрия (WKB)")
+
+    class Meta:
+        verbose_name = "Проекция объекта водоёма"
+        verbose_name_plural = "Проекции объектов водоёмов"
+        unique_together = ('feature', 'srid')
\ No newline at end of file
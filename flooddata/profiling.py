@@ -0,0 +1,173 @@
+"""
+Профилирование этапов анализа затоплений: время, процессорное время, пиковая память и объем ввода-вывода.
+Модуль не зависит от Django; профиль сохраняется в FloodAnalysis.profile.
+Процессорное время и ввод-вывод учитываются для текущего процесса и его дочерних процессов (пул тайловой обработки).
+Счетчики памяти и ввода-вывода читаются из /proc (Linux); на других ОС соответствующие поля равны None.
+"""
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+try:
+    _CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):  # Windows
+    _CLOCK_TICKS = None
+
+
+def _read_proc(pid, name):
+    """Содержимое /proc/<pid>/<name> или None, если файл недоступен."""
+    try:
+        with open(f"/proc/{pid}/{name}", encoding='ascii') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _child_pids():
+    """Идентификаторы дочерних процессов текущего процесса (Linux)."""
+    pids = []
+    for tid in os.listdir('/proc/self/task') if os.path.isdir('/proc/self/task') else []:
+        children = _read_proc('self', f"task/{tid}/children")
+        if children:
+            pids.extend(int(pid) for pid in children.split())
+    return pids
+
+
+def _process_counters(pid):
+    """
+    Счетчики процесса: процессорное время (с), прочитано и записано байт, пиковый RSS (байт).
+    Returns:
+        dict счетчиков (значения None, если недоступны)
+    """
+    counters = {'cpu_s': None, 'read_bytes': None, 'write_bytes': None, 'peak_rss_bytes': None}
+    stat = _read_proc(pid, 'stat')
+    if stat and _CLOCK_TICKS:
+        # Поля после имени процесса (имя в скобках может содержать пробелы); utime и stime - поля 14 и 15
+        fields = stat.rsplit(')', 1)[1].split()
+        counters['cpu_s'] = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    io = _read_proc(pid, 'io')
+    if io:
+        values = dict(line.split(':', 1) for line in io.splitlines() if ':' in line)
+        counters['read_bytes'] = int(values['rchar'])
+        counters['write_bytes'] = int(values['wchar'])
+    status = _read_proc(pid, 'status')
+    if status:
+        for line in status.splitlines():
+            if line.startswith('VmHWM:'):
+                counters['peak_rss_bytes'] = int(line.split()[1]) * 1024
+    return counters
+
+
+def _reset_peak_rss(pid='self'):
+    """Сброс пикового RSS процесса до текущего RSS (Linux: запись 5 в /proc/<pid>/clear_refs)."""
+    try:
+        with open(f"/proc/{pid}/clear_refs", 'w', encoding='ascii') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _snapshot():
+    """Счетчики текущего процесса и живых дочерних процессов."""
+    return {
+        'self': _process_counters('self'),
+        'children': {pid: _process_counters(pid) for pid in _child_pids()},
+        'reaped_cpu_s': sum(os.times()[2:4]),
+    }
+
+
+def _delta(start, end, field):
+    """Прирост счетчика за этап по текущему процессу и дочерним процессам (None, если счетчик недоступен)."""
+    if end['self'][field] is None:
+        return None
+    total = end['self'][field] - start['self'][field]
+    for pid, counters in end['children'].items():
+        if counters[field] is not None:
+            total += counters[field] - (start['children'].get(pid, {}).get(field) or 0)
+    return total
+
+
+class StageProfiler:
+    """
+    Профиль этапов конвейера анализа.
+    Использование: with profiler.stage('classes'): ...; результат - profiler.as_dict().
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        Args:
+            trace_memory: учитывать пиковый объем памяти Python/numpy через tracemalloc (замедляет выделение памяти)
+        """
+        self.stages = []
+        self.trace_memory = trace_memory
+        self._tracing = False
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Замер этапа name. Внутри блока в выдаваемый dict можно добавить свои поля.
+        Этап записывается в профиль и при исключении (с полем error).
+        Пиковый RSS дочерних процессов - за этап: у живых процессов (в том числе постоянного пула)
+        он сбрасывается в начале этапа; процессы, завершившиеся до конца этапа, не учитываются.
+        """
+        record = {'name': name}
+        rss_reset = _reset_peak_rss()
+        # Процессы, пиковый RSS которых сбросить не удалось: их пик - за все время жизни, а не за этап
+        children_not_reset = {pid for pid in _child_pids() if not _reset_peak_rss(pid)}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = _snapshot()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            end = _snapshot()
+            record['wall_s'] = round(time.perf_counter() - wall_start, 3)
+            record['cpu_s'] = round(time.process_time() - cpu_start, 3)
+            children_cpu = _delta(start, end, 'cpu_s')
+            if children_cpu is not None:
+                # Процессорное время дочерних процессов: живых (по /proc) и завершившихся за этап.
+                # os.times учитывает завершившийся процесс за все время жизни; время, прожитое им до этапа,
+                # уже учтено в предыдущих этапах и вычитается
+                children_cpu -= end['self']['cpu_s'] - start['self']['cpu_s']
+                children_cpu += end['reaped_cpu_s'] - start['reaped_cpu_s']
+                children_cpu -= sum(counters['cpu_s'] or 0 for pid, counters in start['children'].items()
+                                    if pid not in end['children'])
+                record['children_cpu_s'] = round(children_cpu, 3)
+            record['read_bytes'] = _delta(start, end, 'read_bytes')
+            record['write_bytes'] = _delta(start, end, 'write_bytes')
+            # Пиковый RSS этапа (если сброс недоступен - не известен) текущего процесса и дочерних процессов
+            record['peak_rss_bytes'] = end['self']['peak_rss_bytes'] if rss_reset else None
+            children_peaks = [c['peak_rss_bytes'] for pid, c in end['children'].items()
+                              if c['peak_rss_bytes'] and pid not in children_not_reset]
+            record['children_peak_rss_bytes'] = max(children_peaks) if children_peaks else None
+            if self.trace_memory:
+                record['tracemalloc_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            self.stages.append(record)
+            logger.info(f"Этап {name}: {record['wall_s']} с, CPU {record['cpu_s']} с, "
+                        f"пиковый RSS {record['peak_rss_bytes']}, чтение {record['read_bytes']}, запись {record['write_bytes']}")
+
+    def as_dict(self):
+        """Профиль для сохранения (JSON): список этапов и общее время."""
+        return {
+            'stages': self.stages,
+            'total_wall_s': round(sum(stage['wall_s'] for stage in self.stages), 3),
+        }
+
+    def close(self):
+        """Останавливает tracemalloc, если он был запущен профилировщиком."""
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
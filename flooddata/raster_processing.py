@@ -0,0 +1,1511 @@
+"""
+Поблочная (оконная) обработка растров для анализа затоплений.
+Функции модуля не зависят от Django и работают только с numpy/rasterio,
+поэтому их можно вызывать как из фоновых задач, так и из вспомогательных скриптов.
+"""
+import json
+import logging
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from functools import partial
+import numpy as np
+import rasterio
+from affine import Affine
+from geopandas import GeoDataFrame, GeoSeries
+from rasterio import windows
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.features import shapes
+from rasterio.warp import reproject, transform_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+import shapely
+from pyproj import CRS, Transformer
+from scipy import ndimage
+from .shared_rasters import shared_raster
+
+logger = logging.getLogger(__name__)
+
+# Размер окна по умолчанию (в пикселях), если не задан в настройках
+DEFAULT_WINDOW_PIXELS = 4 * 1024 * 1024
+
+# Сдвиг центра пикселя в правиле nearest GDAL при чтении с out_shape
+GDAL_NEAREST_EPS = 1e-10
+
+# Коды классов растра сравнения масок
+CLASS_DRY = 0
+CLASS_ONLY_PW = 1      # Зона осушения: вода на пост. водах есть, на снимке нет
+CLASS_ONLY_MNDWI = 2   # Зона затопления: вода на пост. водах нет, на снимке есть
+CLASS_BOTH = 3         # Совпадающая вода
+ANALYSIS_CLASSES = {
+    'only_pw': CLASS_ONLY_PW,
+    'only_mndwi': CLASS_ONLY_MNDWI,
+    'both': CLASS_BOTH,
+}
+
+# Квантованный индекс MNDWI: код = ceil(MNDWI * 100) + 100 (0..200), 255 - нет данных.
+# Маска MNDWI > t (t кратно 0.01) - это код > t * 100 + 100, поэтому маску и площади
+# для любого порога можно получить из индекса без повторного расчета по каналам.
+MNDWI_INDEX_SCALE = 100
+MNDWI_INDEX_OFFSET = 100
+MNDWI_INDEX_BINS = 2 * MNDWI_INDEX_OFFSET + 1
+MNDWI_INDEX_NODATA = 255
+
+
+def iter_row_windows(height, width, max_pixels=None):
+    """
+    Разбивает растр на горизонтальные полосы во всю ширину.
+    Args:
+        height: число строк растра
+        width: число столбцов растра
+        max_pixels: максимальное число пикселей в одном окне
+    Returns:
+        генератор rasterio.windows.Window
+    """
+    max_pixels = max_pixels or DEFAULT_WINDOW_PIXELS
+    rows = max(1, int(max_pixels // max(width, 1)))
+    for row_off in range(0, height, rows):
+        yield Window(0, row_off, width, min(rows, height - row_off))
+
+
+def nearest_indices(src_size, dst_size):
+    """
+    Индексы исходных пикселей для ресемплинга nearest (как при чтении rasterio с out_shape).
+    Повторяет правило GDAL (GDALRasterBand::IRasterIO): шаг src/dst в double, центр пикселя
+    со сдвигом 1e-10 и отбрасывание дробной части. Без этого сдвига при нецелом отношении
+    размеров (например, 202 -> 403) часть индексов на границах отличается от GDAL на единицу.
+    Args:
+        src_size: размер исходной оси
+        dst_size: размер целевой оси
+    Returns:
+        numpy-массив индексов длиной dst_size
+    """
+    step = src_size / float(dst_size)
+    idx = ((np.arange(dst_size, dtype=np.float64) + 0.5) * step + GDAL_NEAREST_EPS).astype(np.int64)
+    return np.clip(idx, 0, src_size - 1)
+
+
+def read_window_resampled(src, window, target_shape, band=1, dtype=np.float32, out=None):
+    """
+    Читает окно канала в сетке target_shape (ресемплинг nearest).
+    Результат совпадает с соответствующим фрагментом src.read(band, out_shape=target_shape)
+    (индексы по правилу GDAL, см. nearest_indices), но в память читаются только нужные строки
+    исходного растра. При уменьшении растра с внутренними обзорами GDAL читал бы обзор,
+    поэтому в этом случае сохраняется чтение с out_shape по целой сетке.
+    Args:
+        src: открытый rasterio dataset
+        window: окно в координатах целевой сетки
+        target_shape: (height, width) целевой сетки
+        band: номер канала
+        dtype: тип результата
+        out: заранее выделенный массив размера окна (опционально)
+    Returns:
+        numpy-массив размера окна
+    """
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+    if out is None:
+        out = np.empty((height, width), dtype=dtype)
+    if (src.height, src.width) == tuple(target_shape):
+        # Преобразование типа выполняет GDAL при чтении, без промежуточной копии
+        return src.read(band, window=window, out=out)
+    shrinks = src.height > target_shape[0] or src.width > target_shape[1]
+    if shrinks and src.overviews(band):
+        data = src.read(band, out_shape=tuple(target_shape))
+        out[...] = data[row_off:row_off + height, col_off:col_off + width]
+        return out
+    rows = nearest_indices(src.height, target_shape[0])[row_off:row_off + height]
+    cols = nearest_indices(src.width, target_shape[1])[col_off:col_off + width]
+    src_window = Window(int(cols[0]), int(rows[0]),
+                        int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+    data = src.read(band, window=src_window)
+    out[...] = data[np.ix_(rows - rows[0], cols - cols[0])]
+    return out
+
+
+def band_window_max(path, target_shape, window, band=1):
+    """
+    Максимум канала в одном окне целевой сетки (задача для пула процессов).
+    Args:
+        path: путь к растру
+        target_shape: (height, width) целевой сетки
+        window: окно в координатах целевой сетки
+        band: номер канала
+    Returns:
+        максимум окна (np.float32)
+    """
+    with rasterio.open(path) as src:
+        return np.max(read_window_resampled(src, window, target_shape, band))
+
+
+def band_max(path, target_shape, band=1, max_pixels=None, executor=None):
+    """
+    Потоковый расчет максимума канала в сетке target_shape.
+    Args:
+        path: путь к растру
+        target_shape: (height, width) целевой сетки
+        band: номер канала
+        max_pixels: максимальное число пикселей в одном окне
+        executor: пул процессов (None - расчет в текущем процессе)
+    Returns:
+        максимум (np.float32), NaN распространяется как в np.max
+    """
+    blocks = iter_row_windows(target_shape[0], target_shape[1], max_pixels)
+    result = np.float32(-np.inf)
+    for block_max in parallel_map(executor, partial(band_window_max, path, target_shape, band=band), blocks):
+        result = np.maximum(result, block_max)
+    return result
+
+
+def compute_band_statistics(path, band=1, bins=256, percentiles=(2, 25, 50, 75, 98), max_pixels=None):
+    """
+    Потоковый расчет статистики канала: минимум, максимум, среднее, перцентили и гистограмма.
+    Растр читается окнами в два прохода (экстремумы, затем гистограмма), поэтому
+    память не зависит от размера снимка.
+    Args:
+        path: путь к растру
+        band: номер канала
+        bins: число интервалов гистограммы
+        percentiles: перцентили, оцениваемые по гистограмме
+        max_pixels: максимальное число пикселей в одном окне
+    Returns:
+        dict, пригодный для сохранения в JSONField
+    """
+    with rasterio.open(path) as src:
+        blocks = list(iter_row_windows(src.height, src.width, max_pixels))
+        # Максимум считаем по всем значениям (как np.max при нормализации), среднее - по конечным
+        band_min = band_max_value = None
+        has_nan = False
+        total = 0.0
+        count = 0
+        for window in blocks:
+            data = src.read(band, window=window)
+            block_min, block_max = np.min(data), np.max(data)
+            if np.isnan(block_min) or np.isnan(block_max):
+                has_nan = True
+                data = data[np.isfinite(data)]
+                if data.size == 0:
+                    continue
+                block_min, block_max = np.min(data), np.max(data)
+            band_min = block_min if band_min is None else min(band_min, block_min)
+            band_max_value = block_max if band_max_value is None else max(band_max_value, block_max)
+            total += float(np.sum(data, dtype=np.float64))
+            count += int(data.size)
+
+        counts = np.zeros(bins, dtype=np.int64)
+        edges = None
+        if count:
+            value_range = (float(band_min), float(band_max_value))
+            if value_range[0] == value_range[1]:
+                value_range = (value_range[0], value_range[0] + 1)
+            for window in blocks:
+                data = src.read(band, window=window)
+                if has_nan:
+                    data = data[np.isfinite(data)]
+                block_counts, edges = np.histogram(data, bins=bins, range=value_range)
+                counts += block_counts
+
+    stats = {
+        'band': band,
+        'min': None if band_min is None else float(band_min),
+        # Максимум с NaN не используется для нормализации, MNDWI посчитает его сам
+        'max': None if band_max_value is None or has_nan else float(band_max_value),
+        'mean': total / count if count else None,
+        'count': count,
+        'percentiles': {},
+        'histogram': {
+            'counts': counts.tolist(),
+            'edges': edges.tolist() if edges is not None else [],
+        },
+    }
+    if count:
+        # Перцентили по кумулятивной гистограмме с линейной интерполяцией внутри интервала
+        cumulative = np.cumsum(counts)
+        for q in percentiles:
+            target = count * q / 100.0
+            i = int(np.searchsorted(cumulative, target))
+            i = min(i, bins - 1)
+            prev = cumulative[i - 1] if i > 0 else 0
+            fraction = (target - prev) / counts[i] if counts[i] else 0.0
+            stats['percentiles'][str(q)] = float(edges[i] + fraction * (edges[i + 1] - edges[i]))
+    return stats
+
+
+def _update_summary(summary, values):
+    """Добавляет к сводной статистике значения блока (только конечные значения с данными)."""
+    if values.dtype.kind == 'f':
+        values = values[np.isfinite(values)]
+    if values.size == 0:
+        return summary
+    block_min, block_max = values.min(), values.max()
+    summary['min'] = float(block_min) if summary['min'] is None else min(summary['min'], float(block_min))
+    summary['max'] = float(block_max) if summary['max'] is None else max(summary['max'], float(block_max))
+    summary['sum'] += float(np.sum(values, dtype=np.float64))
+    summary['count'] += int(values.size)
+    return summary
+
+
+def _finish_summary(summary):
+    """Сводная статистика для сохранения (JSON): min, max, mean, count."""
+    return {
+        'min': summary['min'],
+        'max': summary['max'],
+        'mean': summary['sum'] / summary['count'] if summary['count'] else None,
+        'count': summary['count'],
+    }
+
+
+def array_summary(values, valid=None):
+    """
+    Сводная статистика массива в памяти: минимум, максимум, среднее и число значений с данными.
+    Args:
+        values: numpy-массив
+        valid: маска значений с данными (None - все значения)
+    Returns:
+        dict min, max, mean, count
+    """
+    summary = {'min': None, 'max': None, 'sum': 0.0, 'count': 0}
+    return _finish_summary(_update_summary(summary, values[valid] if valid is not None else values.ravel()))
+
+
+def raster_summary(path, band=1, max_pixels=None):
+    """
+    Поблочная сводная статистика растра (с учетом nodata): минимум, максимум, среднее и число значений.
+    Растр читается окнами, поэтому память не зависит от его размера.
+    Args:
+        path: путь к растру
+        band: номер канала
+        max_pixels: максимальное число пикселей в одном окне
+    Returns:
+        dict min, max, mean, count
+    """
+    summary = {'min': None, 'max': None, 'sum': 0.0, 'count': 0}
+    with rasterio.open(path) as src:
+        for window in iter_row_windows(src.height, src.width, max_pixels):
+            _update_summary(summary, src.read(band, window=window, masked=True).compressed())
+    return _finish_summary(summary)
+
+
+class RasterHandle:
+    """
+    Ленивая ссылка на растр результата: файл открывается и читается только по запросу
+    (целиком, окном или поблочной статистикой), поэтому вызывающему коду, которому нужны
+    только метаданные, не приходится загружать растр в память.
+    """
+
+    def __init__(self, path, band=1, stats=None):
+        self.path = path
+        self.band = band
+        self._stats = stats
+
+    def __repr__(self):
+        return f"RasterHandle({self.path!r})"
+
+    def open(self):
+        """Открывает растр (rasterio dataset, использовать в with)."""
+        return rasterio.open(self.path)
+
+    @property
+    def shape(self):
+        with self.open() as src:
+            return src.height, src.width
+
+    def read(self, window=None, masked=False):
+        """Чтение канала целиком или окна window."""
+        with self.open() as src:
+            return src.read(self.band, window=window, masked=masked)
+
+    def stats(self, max_pixels=None):
+        """Сводная статистика растра (считается поблочно при первом обращении, если не передана заранее)."""
+        if self._stats is None:
+            self._stats = raster_summary(self.path, self.band, max_pixels)
+        return self._stats
+
+
+def cached_band_max(path, target_shape, stats):
+    """
+    Максимум канала в сетке target_shape по сохраненной статистике.
+    Статистика считается по исходному растру, поэтому она подходит, только если при
+    ресемплинге nearest в target_shape используется каждый исходный пиксель
+    (размеры совпадают или растр увеличивается).
+    Returns:
+        np.float32 или None, если статистику использовать нельзя
+    """
+    if not stats or stats.get('max') is None:
+        return None
+    with rasterio.open(path) as src:
+        if src.height > target_shape[0] or src.width > target_shape[1]:
+            return None
+        return np.float32(np.asarray(stats['max'], dtype=src.dtypes[0]))
+
+
+def mndwi_normalization(green_path, swir2_path, target_shape, max_pixels=None, executor=None,
+                        green_stats=None, swir2_stats=None):
+    """
+    Глобальные нормировочные множители каналов Green и SWIR2 для MNDWI.
+    Если передана сохраненная статистика каналов, полный проход по растру не выполняется.
+    Args:
+        green_path: путь к каналу Green
+        swir2_path: путь к каналу SWIR2
+        target_shape: (height, width) сетки Green
+        max_pixels: максимальное число пикселей в одном окне
+        executor: пул процессов (None - расчет в текущем процессе)
+        green_stats, swir2_stats: результат compute_band_statistics (опционально)
+    Returns:
+        (max_green, max_swir2), нулевые максимумы заменяются на 1
+    """
+    max_green = cached_band_max(green_path, target_shape, green_stats)
+    if max_green is None:
+        max_green = band_max(green_path, target_shape, max_pixels=max_pixels, executor=executor)
+    max_green = max_green if max_green > 0 else 1  # Избегаем деления на ноль
+    max_swir2 = cached_band_max(swir2_path, target_shape, swir2_stats)
+    if max_swir2 is None:
+        max_swir2 = band_max(swir2_path, target_shape, max_pixels=max_pixels, executor=executor)
+    max_swir2 = max_swir2 if max_swir2 > 0 else 1
+    return max_green, max_swir2
+
+
+def normalized_difference(a, b, scale_a=None, scale_b=None, eps=1e-6, scratch=None):
+    """
+    Индекс нормированной разности (NDWI/MNDWI) на месте:
+    (a/scale_a - b/scale_b) / (a/scale_a + b/scale_b + eps).
+    Все операции выполняются на месте (ufunc с out=), поэтому помимо входных массивов
+    используется только один вспомогательный буфер.
+    Внимание: содержимое a и b перезаписывается, результат возвращается в a.
+    Args:
+        a, b: массивы float32 одинакового размера (например, Green и SWIR2)
+        scale_a, scale_b: нормировочные множители (None - без нормализации)
+        eps: добавка в знаменатель для устойчивости
+        scratch: заранее выделенный буфер float32 того же размера (опционально)
+    Returns:
+        массив a со значениями индекса
+    """
+    if scale_a is not None:
+        np.divide(a, scale_a, out=a)
+    if scale_b is not None:
+        np.divide(b, scale_b, out=b)
+    if scratch is None:
+        scratch = np.empty_like(a)
+    np.add(a, b, out=scratch)
+    np.add(scratch, eps, out=scratch)
+    np.subtract(a, b, out=a)
+    np.divide(a, scratch, out=a)
+    return a
+
+
+def normalized_difference_mask(a, b, threshold=0.0, scale_a=None, scale_b=None, eps=1e-6, out=None, scratch=None):
+    """
+    Слитое ядро индекса нормированной разности (NDWI/MNDWI) с бинаризацией:
+    (a/scale_a - b/scale_b) / (a/scale_a + b/scale_b + eps) > threshold.
+    Порядок операций и типы совпадают с поэлементной формулой, результат побитово идентичен.
+    Внимание: содержимое a и b перезаписывается.
+    Args:
+        a, b: массивы float32 одинакового размера (например, Green и SWIR2)
+        threshold: порог бинаризации
+        scale_a, scale_b: нормировочные множители (None - без нормализации)
+        eps: добавка в знаменатель для устойчивости
+        out: заранее выделенный массив uint8 для маски (опционально)
+        scratch: заранее выделенный буфер float32 того же размера (опционально)
+    Returns:
+        маска uint8 (1 - индекс выше порога, 0 - нет)
+    """
+    normalized_difference(a, b, scale_a, scale_b, eps, scratch)
+    if out is None:
+        out = np.empty(a.shape, dtype=np.uint8)
+    np.greater(a, threshold, out=out.view(np.bool_))
+    return out
+
+
+def allocate_window_buffers(max_pixels):
+    """
+    Буферы для поблочного расчета MNDWI, переиспользуемые между окнами.
+    Returns:
+        dict с плоскими массивами green, swir2, scratch (float32) и mask (uint8)
+    """
+    return {
+        'green': np.empty(max_pixels, dtype=np.float32),
+        'swir2': np.empty(max_pixels, dtype=np.float32),
+        'scratch': np.empty(max_pixels, dtype=np.float32),
+        'mask': np.empty(max_pixels, dtype=np.uint8),
+    }
+
+
+def mndwi_window_mask(green_src, swir2_src, window, target_shape, max_green, max_swir2, buffers=None):
+    """
+    Маска MNDWI > 0 для одного окна сетки Green.
+    Args:
+        green_src, swir2_src: открытые rasterio datasets каналов
+        window: окно в координатах сетки Green
+        target_shape: (height, width) сетки Green
+        max_green, max_swir2: нормировочные множители
+        buffers: буферы allocate_window_buffers не меньше размера окна (опционально)
+    Returns:
+        numpy-массив uint8 (1 - вода, 0 - суша); при переданных буферах - представление буфера
+    """
+    shape = (int(window.height), int(window.width))
+    if buffers is None:
+        buffers = allocate_window_buffers(shape[0] * shape[1])
+    size = shape[0] * shape[1]
+    green = read_window_resampled(green_src, window, target_shape, out=buffers['green'][:size].reshape(shape))
+    swir2 = read_window_resampled(swir2_src, window, target_shape, out=buffers['swir2'][:size].reshape(shape))
+    return normalized_difference_mask(
+        green, swir2, threshold=0, scale_a=max_green, scale_b=max_swir2, eps=1e-6,  # epsilon для стабильности
+        out=buffers['mask'][:size].reshape(shape), scratch=buffers['scratch'][:size].reshape(shape)
+    )
+
+
+def quantize_index(values, out=None):
+    """
+    Квантование индекса MNDWI: ceil(MNDWI * 100) + 100 с ограничением диапазоном 0..200,
+    NaN - MNDWI_INDEX_NODATA. Код больше t * 100 + 100 тогда и только тогда, когда MNDWI > t,
+    поэтому маска MNDWI > 0 по индексу совпадает с расчетом по вещественным значениям.
+    Внимание: содержимое values перезаписывается.
+    Args:
+        values: массив float32 значений индекса
+        out: заранее выделенный массив uint8 (опционально)
+    Returns:
+        индекс uint8
+    """
+    nodata = np.isnan(values)
+    np.multiply(values, MNDWI_INDEX_SCALE, out=values)
+    np.ceil(values, out=values)
+    np.clip(values, -MNDWI_INDEX_OFFSET, MNDWI_INDEX_OFFSET, out=values)
+    np.add(values, MNDWI_INDEX_OFFSET, out=values)
+    if out is None:
+        out = np.empty(values.shape, dtype=np.uint8)
+    np.copyto(out, values, casting='unsafe')
+    out[nodata] = MNDWI_INDEX_NODATA
+    return out
+
+
+def mndwi_threshold_code(threshold):
+    """Код квантованного индекса для порога MNDWI (порог округляется до 0.01)."""
+    step = int(round(float(threshold) * MNDWI_INDEX_SCALE))
+    return min(max(step, -MNDWI_INDEX_OFFSET), MNDWI_INDEX_OFFSET) + MNDWI_INDEX_OFFSET
+
+
+def index_mask(index, code):
+    """Маска uint8 индекса выше порога (код порога - mndwi_threshold_code), без пикселей nodata."""
+    return ((index > code) & (index != MNDWI_INDEX_NODATA)).view(np.uint8)
+
+
+def index_profile(shape, transform, crs):
+    """Профиль GeoTIFF для квантованного индекса MNDWI."""
+    profile = mask_profile(shape, transform, crs)
+    profile['nodata'] = MNDWI_INDEX_NODATA
+    return profile
+
+
+def mndwi_window_index(green_src, swir2_src, window, target_shape, max_green, max_swir2):
+    """
+    Квантованный индекс MNDWI (см. quantize_index) для одного окна сетки Green.
+    Args:
+        green_src, swir2_src: открытые rasterio datasets каналов
+        window: окно в координатах сетки Green
+        target_shape: (height, width) сетки Green
+        max_green, max_swir2: нормировочные множители
+    Returns:
+        индекс uint8 размера окна
+    """
+    green = read_window_resampled(green_src, window, target_shape)
+    swir2 = read_window_resampled(swir2_src, window, target_shape)
+    return quantize_index(normalized_difference(green, swir2, scale_a=max_green, scale_b=max_swir2, eps=1e-6))
+
+
+def compute_mndwi_mask(green_path, swir2_path, output_mask_path, max_pixels=None):
+    """
+    Поблочный расчет маски воды MNDWI > 0 по каналам Green и SWIR2.
+    Канал SWIR2 приводится к сетке Green (nearest). Нормализация выполняется по глобальным
+    максимумам каналов, а индексы ресемплинга SWIR2 вычисляются по правилу GDAL для nearest,
+    поэтому результат совпадает с расчетом по целым массивам (чтение SWIR2 с out_shape)
+    при любом отношении размеров каналов, а пиковое потребление памяти ограничено размером окна.
+    Args:
+        green_path: путь к каналу Green (GeoTIFF)
+        swir2_path: путь к каналу SWIR2 (GeoTIFF)
+        output_mask_path: путь для сохранения маски (uint8, 1 - вода, 0 - суша)
+        max_pixels: максимальное число пикселей в одном окне
+    Returns:
+        dict с transform, crs, shape маски и количеством пикселей воды
+    """
+    with rasterio.open(green_path) as green_src, rasterio.open(swir2_path) as swir2_src:
+        target_shape = (green_src.height, green_src.width)
+        green_transform = green_src.transform
+        green_crs = green_src.crs
+        max_green, max_swir2 = mndwi_normalization(green_path, swir2_path, target_shape, max_pixels)
+
+        profile = mask_profile(target_shape, green_transform, green_crs)
+        blocks = list(iter_row_windows(target_shape[0], target_shape[1], max_pixels))
+        buffers = allocate_window_buffers(max(int(w.height * w.width) for w in blocks))
+        water_pixels = 0
+        with rasterio.open(output_mask_path, 'w', **profile) as dst:
+            for window in blocks:
+                mask = mndwi_window_mask(green_src, swir2_src, window, target_shape, max_green, max_swir2, buffers)
+                water_pixels += int(np.count_nonzero(mask))
+                dst.write(mask, 1, window=window)
+
+    logger.info(f"Маска MNDWI рассчитана поблочно: {output_mask_path}, пикселей воды: {water_pixels}")
+    return {
+        'transform': green_transform,
+        'crs': green_crs,
+        'shape': target_shape,
+        'water_pixels': water_pixels
+    }
+
+
+def mask_profile(shape, transform, crs):
+    """Профиль GeoTIFF для бинарной маски uint8 со сжатием LZW."""
+    return {
+        'driver': 'GTiff',
+        'height': shape[0], 'width': shape[1], 'transform': transform, 'crs': crs,
+        'count': 1, 'dtype': 'uint8',
+        'compress': 'LZW'
+    }
+
+
+# --- Параллельная обработка по тайлам ---
+
+# Постоянный пул процессов, запущенный заранее рабочим процессом фоновых задач (см. run_flood_worker):
+# (пул, число процессов) или None
+_persistent_pool = None
+
+
+def warm_up_worker():
+    """
+    Инициализатор процесса пула: процесс импортирует модуль (rasterio/GDAL, geopandas, shapely, scipy)
+    и регистрирует драйверы GDAL при запуске пула, а не при первой задаче тайла.
+    Returns:
+        pid процесса
+    """
+    with rasterio.Env():
+        pass
+    return os.getpid()
+
+
+def start_persistent_pool(workers):
+    """
+    Запуск постоянного пула процессов с прогревом: пул переиспользуется всеми анализами
+    рабочего процесса (analysis_pool), поэтому задачи не платят за запуск процессов и импорт библиотек.
+    Args:
+        workers: число процессов (<= 1 - пул не нужен)
+    Returns:
+        ProcessPoolExecutor или None
+    """
+    global _persistent_pool
+    if not workers or workers <= 1:
+        return None
+    if _persistent_pool is None:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_up_worker)
+        # Процессы запускаются по мере отправки задач: отправляем по задаче на процесс
+        futures = [executor.submit(warm_up_worker) for _ in range(workers)]
+        pids = {future.result() for future in futures}
+        _persistent_pool = (executor, workers)
+        logger.info(f"Запущен постоянный пул процессов анализа: {len(pids)} процессов")
+    return _persistent_pool[0]
+
+
+@contextmanager
+def analysis_pool(workers):
+    """
+    Пул процессов для тайловой обработки анализа.
+    При workers <= 1 пул не создается и задачи выполняются в текущем процессе.
+    Если рабочий процесс запустил постоянный пул (start_persistent_pool) достаточного размера,
+    используется он, иначе создается временный пул на время блока.
+    Args:
+        workers: число процессов
+    Returns:
+        ProcessPoolExecutor или None
+    """
+    global _persistent_pool
+    if not workers or workers <= 1:
+        yield None
+        return
+    if _persistent_pool is not None and _persistent_pool[1] >= workers:
+        try:
+            yield _persistent_pool[0]
+        except BrokenProcessPool:
+            # Процесс пула аварийно завершился - следующий анализ запустит новый пул
+            logger.error("Постоянный пул процессов анализа поврежден и будет перезапущен")
+            workers = _persistent_pool[1]
+            _persistent_pool[0].shutdown(wait=False)
+            _persistent_pool = None
+            start_persistent_pool(workers)
+            raise
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up_worker) as executor:
+        yield executor
+
+
+def parallel_map(executor, func, items):
+    """Аналог map: в пуле процессов, если он задан, иначе в текущем процессе. Порядок сохраняется."""
+    if executor is None:
+        return map(func, items)
+    return executor.map(func, items)
+
+
+def tile_pixels(shape, workers, max_pixels=None):
+    """
+    Размер тайла (в пикселях) с учетом числа процессов: не больше max_pixels
+    и не меньше двух тайлов на процесс для равномерной загрузки.
+    """
+    max_pixels = max_pixels or DEFAULT_WINDOW_PIXELS
+    if workers and workers > 1:
+        per_worker = int(math.ceil(shape[0] * shape[1] / (workers * 2)))
+        max_pixels = max(shape[1], min(max_pixels, per_worker))
+    return max_pixels
+
+
+def read_aligned_window(src, window, dst_transform, dst_crs, target_shape, band=1):
+    """
+    Читает маску, приведенную к целевой сетке, только для одного окна.
+    Если CRS и размер совпадают с сеткой снимка, окно читается напрямую, иначе выполняется репроекция
+    (nearest) фрагмента исходного растра, покрывающего окно.
+    Args:
+        src: открытый rasterio dataset маски
+        window: окно в координатах целевой сетки
+        dst_transform, dst_crs: геопривязка целевой сетки
+        target_shape: (height, width) целевой сетки
+        band: номер канала
+    Returns:
+        numpy-массив uint8 размера окна (0 вне охвата маски)
+    """
+    height, width = int(window.height), int(window.width)
+    if src.crs == dst_crs and (src.height, src.width) == tuple(target_shape):
+        return src.read(band, window=window)
+
+    destination = np.zeros((height, width), dtype=np.uint8)
+    win_transform = windows.transform(window, dst_transform)
+    win_bounds = windows.bounds(window, dst_transform)
+    src_bounds = transform_bounds(dst_crs, src.crs, *win_bounds) if src.crs != dst_crs else win_bounds
+    src_window = windows.from_bounds(*src_bounds, src.transform)
+    # Запас в 2 пикселя на ресемплинг и обрезка по границам растра
+    src_window = Window(src_window.col_off - 2, src_window.row_off - 2,
+                        src_window.width + 4, src_window.height + 4).round_offsets().round_lengths()
+    try:
+        src_window = src_window.intersection(Window(0, 0, src.width, src.height))
+    except WindowError:
+        return destination  # Окно вне охвата маски
+    reproject(
+        source=src.read(band, window=src_window),
+        destination=destination,
+        src_transform=windows.transform(src_window, src.transform),
+        src_crs=src.crs,
+        dst_transform=win_transform,
+        dst_crs=dst_crs,
+        resampling=Resampling.nearest,
+        dst_nodata=0  # Пустые области остаются 0
+    )
+    return destination
+
+
+def read_shared_window(shared, window, dst_transform, dst_crs, target_shape):
+    """
+    Окно растра из разделяемой памяти (SharedRaster) в целевой сетке (nearest).
+    Если сетки совпадают, возвращается срез массива без копирования, иначе репроецируется
+    только фрагмент массива, покрывающий окно (как в read_aligned_window).
+    Returns:
+        массив размера окна; при приведении - float64, NaN вне охвата растра и в nodata
+    """
+    height, width = int(window.height), int(window.width)
+    src_crs = CRS.from_user_input(shared.crs)
+    same_crs = src_crs == CRS.from_user_input(dst_crs)
+    if same_crs and shared.transform == dst_transform and shared.shape == tuple(target_shape):
+        return shared.array[window.row_off:window.row_off + height, window.col_off:window.col_off + width]
+
+    destination = np.full((height, width), np.nan)
+    win_bounds = windows.bounds(window, dst_transform)
+    src_bounds = win_bounds if same_crs else transform_bounds(dst_crs, src_crs, *win_bounds)
+    src_window = windows.from_bounds(*src_bounds, shared.transform)
+    src_window = Window(src_window.col_off - 2, src_window.row_off - 2,
+                        src_window.width + 4, src_window.height + 4).round_offsets().round_lengths()
+    try:
+        src_window = src_window.intersection(Window(0, 0, shared.shape[1], shared.shape[0]))
+    except WindowError:
+        return destination
+    rows, cols = src_window.toslices()
+    reproject(
+        source=shared.array[rows, cols],
+        destination=destination,
+        src_transform=windows.transform(src_window, shared.transform),
+        src_crs=src_crs,
+        src_nodata=shared.nodata,
+        dst_transform=windows.transform(window, dst_transform),
+        dst_crs=dst_crs,
+        dst_nodata=np.nan,
+        resampling=Resampling.nearest
+    )
+    return destination
+
+
+def grid_signature(path):
+    """
+    Описание сетки растра (CRS, геопривязка, размер) для ключей кэша.
+    Returns:
+        dict с crs (WKT), transform (6 коэффициентов) и shape
+    """
+    with rasterio.open(path) as src:
+        return {
+            'crs': src.crs.to_wkt() if src.crs else None,
+            'transform': list(src.transform)[:6],
+            'shape': [src.height, src.width],
+        }
+
+
+def raster_footprint(path):
+    """
+    Охват растра в EPSG:4326: прямоугольник границ (при перепроецировании стороны уплотняются,
+    поэтому охват не меньше растра).
+    Returns:
+        shapely Polygon
+    """
+    with rasterio.open(path) as src:
+        bounds = src.bounds
+        if src.crs and CRS.from_user_input(src.crs) != CRS.from_epsg(4326):
+            bounds = transform_bounds(src.crs, 'EPSG:4326', *bounds, densify_pts=21)
+    return shapely.box(*bounds)
+
+
+def align_mask_to_grid(mask_path, output_path, transform, crs, shape, max_pixels=None):
+    """
+    Приведение маски к целевой сетке (nearest) по окнам, с записью в файл.
+    Результат совпадает с поблочным приведением маски при тайловой обработке сцены.
+    Args:
+        mask_path: путь к исходной маске
+        output_path: путь для сохранения маски в целевой сетке
+        transform, crs, shape: целевая сетка
+        max_pixels: максимальное число пикселей в одном окне
+    Returns:
+        output_path
+    """
+    with rasterio.open(mask_path) as src, rasterio.open(output_path, 'w', **mask_profile(shape, transform, crs)) as dst:
+        for window in iter_row_windows(shape[0], shape[1], max_pixels):
+            dst.write(read_aligned_window(src, window, transform, crs, shape), 1, window=window)
+    return output_path
+
+
+def threshold_mask_to_grid(raster_path, output_path, threshold, transform, crs, shape, max_pixels=None, shared=None):
+    """
+    Маска raster >= threshold сразу в целевой сетке: растр читается через WarpedVRT
+    (виртуальное приведение nearest), поэтому обрезка и перепроецирование не сохраняются
+    в промежуточные файлы, а читаются только нужные пиксели.
+    В той же CRS результат совпадает с репроекцией всего растра. При смене CRS координаты
+    приводятся приближенно (погрешность GDAL до 0.125 пикселя исходного растра), поэтому
+    для ячеек, центр которых почти на границе исходного пикселя, чтение через WarpedVRT
+    и из разделяемой памяти может выбрать соседний пиксель.
+    Args:
+        raster_path: путь к исходному растру (например, flow accumulation всего DEM)
+        output_path: путь для сохранения маски uint8 (1 - вода, 0 - нет)
+        threshold: пороговое значение
+        transform, crs, shape: целевая сетка
+        max_pixels: максимальное число пикселей в одном окне
+        shared: тот же растр в разделяемой памяти (SharedRaster) - читается из памяти без декодирования файла
+    Returns:
+        output_path
+    """
+    if shared is not None:
+        with rasterio.open(output_path, 'w', **mask_profile(shape, transform, crs)) as dst:
+            for window in iter_row_windows(shape[0], shape[1], max_pixels):
+                values = read_shared_window(shared, window, transform, crs, shape)
+                valid = ~np.isnan(values) if values.dtype.kind == 'f' else True
+                if shared.nodata is not None and not np.isnan(shared.nodata):
+                    valid = valid & (values != shared.nodata)
+                dst.write(((values >= threshold) & valid).astype(np.uint8), 1, window=window)
+        return output_path
+    with rasterio.open(raster_path) as src, \
+            WarpedVRT(src, crs=crs, transform=transform, width=shape[1], height=shape[0],
+                      resampling=Resampling.nearest) as vrt, \
+            rasterio.open(output_path, 'w', **mask_profile(shape, transform, crs)) as dst:
+        for window in iter_row_windows(shape[0], shape[1], max_pixels):
+            # Пиксели вне растра и nodata маскируются и в маску не попадают
+            values = vrt.read(1, window=window, masked=True)
+            dst.write(np.ma.filled(values >= threshold, False).view(np.uint8), 1, window=window)
+    return output_path
+
+
+def halo_window(window, halo, height):
+    """Окно-полоса, расширенное на halo строк сверху и снизу в пределах растра."""
+    top = max(0, window.row_off - halo)
+    bottom = min(height, window.row_off + window.height + halo)
+    return Window(window.col_off, top, window.width, bottom - top)
+
+
+def sieve_mask(mask, min_pixels, keep_top=False, keep_bottom=False):
+    """
+    Удаление мелких областей (шума) маски до векторизации: связные области (4-связность,
+    как у shapes()) размером не более min_pixels пикселей зануляются.
+    При обработке по окнам маска читается с перекрытием в min_pixels строк; области,
+    касающиеся обрезанного края перекрытия, сохраняются - их полный размер заведомо больше порога.
+    Args:
+        mask: маска (ненулевые значения - объект), изменяется на месте
+        min_pixels: максимальный размер удаляемой области в пикселях
+        keep_top, keep_bottom: верхний/нижний край окна - граница перекрытия, а не растра
+    Returns:
+        маска без мелких областей
+    """
+    labels, count = ndimage.label(mask)
+    if count == 0:
+        return mask
+    small = np.bincount(labels.ravel()) <= min_pixels
+    small[0] = False
+    if keep_top:
+        small[labels[0]] = False
+    if keep_bottom:
+        small[labels[-1]] = False
+    mask[small[labels]] = 0
+    return mask
+
+
+def read_sieved_window(read, window, min_pixels, height):
+    """
+    Чтение окна маски с удалением мелких областей (с перекрытием соседних окон).
+    Args:
+        read: функция read(window), возвращающая маску окна
+        window: окно-полоса
+        min_pixels: максимальный размер удаляемой области (0 - без удаления)
+        height: число строк растра
+    Returns:
+        маска окна
+    """
+    if not min_pixels:
+        return read(window)
+    extended = halo_window(window, min_pixels, height)
+    mask = sieve_mask(read(extended), min_pixels, keep_top=extended.row_off > 0,
+                      keep_bottom=extended.row_off + extended.height < height)
+    offset = window.row_off - extended.row_off
+    return mask[offset:offset + window.height]
+
+
+def classify_masks(pw_mask, mndwi_mask, out=None):
+    """
+    Растр классов сравнения масок за один проход:
+    0 - суша, 1 - только постоянные воды, 2 - только снимок, 3 - совпадающая вода.
+    Код класса - битовая маска: бит 0 - постоянные воды, бит 1 - вода по снимку.
+    Args:
+        pw_mask: маска постоянных вод (> 0 - вода)
+        mndwi_mask: маска MNDWI (0/1)
+        out: заранее выделенный массив uint8 (опционально)
+    Returns:
+        растр классов uint8
+    """
+    if out is None:
+        out = np.empty(mndwi_mask.shape, dtype=np.uint8)
+    np.greater(pw_mask, 0, out=out.view(np.bool_))
+    np.bitwise_or(out, np.left_shift(mndwi_mask, 1, dtype=np.uint8), out=out)
+    return out
+
+
+def process_analysis_tile(params, window):
+    """
+    Обработка одного тайла анализа (задача для пула процессов):
+    квантованный индекс MNDWI, маска MNDWI по порогу, маска постоянных вод в сетке снимка,
+    растр классов сравнения и гистограмма индекса.
+    Args:
+        params: dict с путями к каналам (или к готовому индексу) и маске постоянных вод,
+            сеткой Green, нормировкой, кодом порога и площадями пикселей по строкам
+        window: окно в координатах сетки Green
+    Returns:
+        dict с окном, индексом, маской mndwi, растром классов (uint8) и гистограммой индекса
+    """
+    target_shape = params['shape']
+    with ExitStack() as stack:
+        if params.get('index_path'):
+            # Индекс уже рассчитан (например, взят из кэша) - читаем окна, без расчета по каналам
+            index_src = stack.enter_context(rasterio.open(params['index_path']))
+            read_index = lambda w: index_src.read(1, window=w)
+        else:
+            green_src = stack.enter_context(rasterio.open(params['green_path']))
+            swir2_src = stack.enter_context(rasterio.open(params['swir2_path']))
+            read_index = lambda w: mndwi_window_index(green_src, swir2_src, w, target_shape,
+                                                      params['max_green'], params['max_swir2'])
+        index = read_index(window)
+        if params.get('min_region_pixels'):
+            mndwi_mask = read_sieved_window(lambda w: index_mask(read_index(w), params['threshold_code']),
+                                            window, params['min_region_pixels'], target_shape[0])
+        else:
+            mndwi_mask = index_mask(index, params['threshold_code'])
+    pw_mask = None
+    if params.get('pw_mask_path'):
+        try:
+            # Маска постоянных вод общая для анализов на одном тайле снимка - берется из разделяемой памяти узла
+            shared = None
+            if params.get('shared_index_dir'):
+                shared = shared_raster(params['pw_mask_path'], params['shared_index_dir'], params['shared_max_bytes'])
+            if shared is not None:
+                pw_mask = np.nan_to_num(read_shared_window(shared, window, params['transform'], params['crs'], target_shape)).astype(np.uint8)
+            else:
+                with rasterio.open(params['pw_mask_path']) as pw_src:
+                    pw_mask = read_aligned_window(pw_src, window, params['transform'], params['crs'], target_shape)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении маски постоянных вод для окна {window}: {e}")
+    if pw_mask is None:
+        pw_mask = np.zeros_like(mndwi_mask)
+
+    rows = slice(window.row_off, window.row_off + window.height)
+    return {
+        'window': window,
+        'index': index,
+        'mndwi': mndwi_mask,
+        'classes': classify_masks(pw_mask, mndwi_mask),
+        'histogram': index_histogram(index, pw_mask, params['row_areas'][rows]),
+    }
+
+
+def index_histogram(index, pw_mask, row_areas):
+    """
+    Гистограмма квантованного индекса MNDWI отдельно вне и на постоянных водах.
+    Args:
+        index: квантованный индекс окна
+        pw_mask: маска постоянных вод окна (> 0 - вода)
+        row_areas: площадь пикселя (м²) для каждой строки окна
+    Returns:
+        (число пикселей, площадь в м²) - массивы (2, MNDWI_INDEX_BINS):
+        строка 0 - вне постоянных вод, строка 1 - на постоянных водах;
+        затем число пикселей и площадь (м²) постоянных вод без индекса (MNDWI_INDEX_NODATA) - в растре классов это only_pw
+    """
+    keys = (np.greater(pw_mask, 0).astype(np.int32) * 256 + index).ravel()
+    weights = np.broadcast_to(np.asarray(row_areas, dtype=np.float64)[:, None], index.shape).ravel()
+    pixels = np.bincount(keys, minlength=512).reshape(2, 256)
+    areas = np.bincount(keys, weights=weights, minlength=512).reshape(2, 256)
+    return (pixels[:, :MNDWI_INDEX_BINS], areas[:, :MNDWI_INDEX_BINS],
+            int(pixels[1, MNDWI_INDEX_NODATA]), float(areas[1, MNDWI_INDEX_NODATA]))
+
+
+def mark_unsieved(result, min_region_pixels):
+    """
+    Помечает площади, рассчитанные по гистограмме индекса, если в анализе удалялись мелкие области.
+    Гистограмма строится до удаления областей (min_region_pixels), поэтому площади воды по ней
+    могут быть больше площадей в растре классов анализа.
+    Args:
+        result: dict с площадями (результат threshold_areas или threshold_area_curve)
+        min_region_pixels: параметр удаления мелких областей анализа
+    Returns:
+        result с полем sieved и, если области удалялись, пояснением note
+    """
+    result['sieved'] = bool(min_region_pixels)
+    if min_region_pixels:
+        result['note'] = (f'Удаление областей воды не больше {min_region_pixels} пикс. не учитывается: '
+                          'площади рассчитаны по гистограмме индекса до удаления и могут быть завышены')
+    return result
+
+
+def threshold_areas(histogram, threshold, min_region_pixels=0):
+    """
+    Площади классов для порога MNDWI по сохраненной гистограмме индекса, без чтения растров.
+    Удаление мелких областей (min_region_pixels) в гистограмме не учитывается, см. mark_unsieved.
+    Args:
+        histogram: гистограмма индекса анализа (результат run_analysis_tiles['mndwi_histogram'])
+        threshold: порог MNDWI (округляется до 0.01)
+        min_region_pixels: параметр удаления мелких областей анализа
+    Returns:
+        dict с порогом, площадями (км²) only_pw, only_mndwi, both и flooded (only_mndwi + both)
+        и признаком sieved
+    """
+    areas = np.asarray(histogram['areas_sqkm'])
+    code = mndwi_threshold_code(threshold)
+    only_mndwi = float(areas[0, code + 1:].sum())
+    both = float(areas[1, code + 1:].sum())
+    return mark_unsieved({
+        'threshold': (code - MNDWI_INDEX_OFFSET) / MNDWI_INDEX_SCALE,
+        # Постоянные воды без индекса (nodata снимка) - only_pw, как в растре классов
+        'only_pw': float(areas[1, :code + 1].sum()) + histogram.get('pw_nodata_areas_sqkm', 0.0),
+        'only_mndwi': only_mndwi,
+        'both': both,
+        'flooded': only_mndwi + both,
+    }, min_region_pixels)
+
+
+def threshold_area_curve(histogram, min_region_pixels=0):
+    """
+    Зависимость площади затопления от порога MNDWI (шаг 0.01) по гистограмме индекса.
+    Удаление мелких областей (min_region_pixels) не учитывается, см. mark_unsieved.
+    Returns:
+        dict со списками thresholds, only_mndwi, both, flooded (площади в км²) и признаком sieved
+    """
+    areas = np.asarray(histogram['areas_sqkm'])
+    # Площадь выше кода k - сумма столбцов k+1..200 (обратная накопленная сумма со сдвигом)
+    above = np.zeros_like(areas)
+    above[:, :-1] = np.cumsum(areas[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    codes = np.arange(MNDWI_INDEX_BINS)
+    return mark_unsieved({
+        'thresholds': ((codes - MNDWI_INDEX_OFFSET) / MNDWI_INDEX_SCALE).tolist(),
+        'only_mndwi': above[0].tolist(),
+        'both': above[1].tolist(),
+        'flooded': (above[0] + above[1]).tolist(),
+    }, min_region_pixels)
+
+
+def pixel_row_areas(transform, crs, shape):
+    """
+    Площадь пикселя (м²) для каждой строки растра на эллипсоиде CRS.
+    Углы пикселя в середине строки переводятся в геодезические координаты,
+    площадь четырехугольника считается геодезически (pyproj.Geod), без проекции Меркатора.
+    Args:
+        transform, crs: геопривязка растра
+        shape: (height, width)
+    Returns:
+        numpy-массив площадей пикселя по строкам
+    """
+    height, width = shape
+    if crs is None:
+        logger.warning("CRS растра не задана, площадь пикселя берется из геопривязки.")
+        return np.full(height, abs(transform.a * transform.e - transform.b * transform.d))
+    proj_crs = CRS.from_user_input(crs)
+    geod = proj_crs.get_geod()
+    to_lonlat = Transformer.from_crs(proj_crs, proj_crs.geodetic_crs, always_xy=True)
+    cols, rows = np.meshgrid([width // 2, width // 2 + 1], np.arange(height + 1))
+    lon, lat = to_lonlat.transform(*(transform * (cols.astype(np.float64), rows.astype(np.float64))))
+    areas = np.empty(height)
+    for row in range(height):
+        area, _ = geod.polygon_area_perimeter(
+            [lon[row, 0], lon[row, 1], lon[row + 1, 1], lon[row + 1, 0]],
+            [lat[row, 0], lat[row, 1], lat[row + 1, 1], lat[row + 1, 0]]
+        )
+        areas[row] = abs(area)
+    return areas
+
+
+def run_analysis_tiles(green_path, swir2_path, pw_mask_path, index_path, mndwi_mask_path, classes_path, max_pixels=None,
+                       executor=None, workers=1, green_stats=None, swir2_stats=None, bit_packed=True,
+                       min_region_pixels=0, index_ready=False, mndwi_threshold=0.0, shared_index_dir=None,
+                       shared_max_bytes=0):
+    """
+    Тайловое выполнение расчета MNDWI, приведения маски постоянных вод и сравнения масок.
+    Тайлы обрабатываются в пуле процессов; квантованный индекс MNDWI, маска MNDWI и растр классов
+    (0 - суша, 1 - только пост. воды, 2 - только снимок, 3 - совпадающая вода)
+    записываются в файлы по окнам, без сборки масок всей сцены в памяти.
+    Args:
+        green_path, swir2_path: пути к каналам Green и SWIR2
+        pw_mask_path: путь к маске постоянных вод (или None)
+        index_path: путь к квантованному индексу MNDWI (для сохранения или готовый, см. index_ready)
+        mndwi_mask_path: путь для сохранения маски MNDWI
+        classes_path: путь для сохранения растра классов
+        max_pixels: максимальное число пикселей в одном тайле
+        executor: пул процессов (None - расчет в текущем процессе)
+        workers: число процессов пула (для выбора размера тайла)
+        green_stats, swir2_stats: сохраненная статистика каналов для нормализации (опционально)
+        bit_packed: хранить растр классов упакованным по 2 бита на пиксель (NBITS=2)
+        min_region_pixels: области воды MNDWI не больше этого размера (в пикселях) удаляются до сравнения масок
+        index_ready: индекс по пути index_path уже рассчитан - он читается, а не пересчитывается по каналам
+        mndwi_threshold: порог MNDWI для маски воды (округляется до 0.01)
+        shared_index_dir, shared_max_bytes: кэш растров в разделяемой памяти для маски постоянных вод
+            (см. shared_rasters.py; None - маска читается из файла)
+    Returns:
+        dict с transform, crs, shape, числом пикселей воды MNDWI, числом пикселей и площадью (км²) каждого класса
+        и гистограммой индекса (mndwi_histogram) для расчета площадей при других порогах
+    """
+    with rasterio.open(green_path) as green_src:
+        target_shape = (green_src.height, green_src.width)
+        green_transform = green_src.transform
+        green_crs = green_src.crs
+    tile_size = tile_pixels(target_shape, workers, max_pixels)
+    row_areas = pixel_row_areas(green_transform, green_crs, target_shape)
+    max_green = max_swir2 = None
+    if not index_ready:
+        max_green, max_swir2 = mndwi_normalization(green_path, swir2_path, target_shape, tile_size, executor,
+                                                   green_stats=green_stats, swir2_stats=swir2_stats)
+
+    params = {
+        'green_path': green_path,
+        'swir2_path': swir2_path,
+        'pw_mask_path': pw_mask_path,
+        'shape': target_shape,
+        'transform': green_transform,
+        'crs': green_crs,
+        'max_green': max_green,
+        'max_swir2': max_swir2,
+        'min_region_pixels': min_region_pixels,
+        'index_path': index_path if index_ready else None,
+        'threshold_code': mndwi_threshold_code(mndwi_threshold),
+        'row_areas': row_areas,
+        'shared_index_dir': shared_index_dir if shared_max_bytes else None,
+        'shared_max_bytes': shared_max_bytes,
+    }
+    classes_profile = mask_profile(target_shape, green_transform, green_crs)
+    if bit_packed:
+        classes_profile['nbits'] = 2
+    # Число пикселей каждого класса по строкам: площадь считается по растру, без векторизации
+    row_counts = np.zeros((target_shape[0], 4), dtype=np.int64)
+    water_pixels = 0
+    hist_pixels = np.zeros((2, MNDWI_INDEX_BINS), dtype=np.int64)
+    hist_areas = np.zeros((2, MNDWI_INDEX_BINS))
+    pw_nodata_pixels = 0
+    pw_nodata_area = 0.0
+    tiles = iter_row_windows(target_shape[0], target_shape[1], tile_size)
+    with ExitStack() as stack:
+        index_dst = None
+        if not index_ready:
+            index_dst = stack.enter_context(
+                rasterio.open(index_path, 'w', **index_profile(target_shape, green_transform, green_crs)))
+        mndwi_dst = stack.enter_context(
+            rasterio.open(mndwi_mask_path, 'w', **mask_profile(target_shape, green_transform, green_crs)))
+        classes_dst = stack.enter_context(rasterio.open(classes_path, 'w', **classes_profile))
+        for tile in parallel_map(executor, partial(process_analysis_tile, params), tiles):
+            window = tile['window']
+            if index_dst is not None:
+                index_dst.write(tile['index'], 1, window=window)
+            mndwi_dst.write(tile['mndwi'], 1, window=window)
+            classes_dst.write(tile['classes'], 1, window=window)
+            hist_pixels += tile['histogram'][0]
+            hist_areas += tile['histogram'][1]
+            pw_nodata_pixels += tile['histogram'][2]
+            pw_nodata_area += tile['histogram'][3]
+            water_pixels += int(np.count_nonzero(tile['mndwi']))
+            rows = slice(window.row_off, window.row_off + window.height)
+            for value in ANALYSIS_CLASSES.values():
+                row_counts[rows, value] = np.count_nonzero(tile['classes'] == value, axis=1)
+
+    return {
+        'transform': green_transform,
+        'crs': green_crs,
+        'shape': target_shape,
+        'water_pixels': water_pixels,
+        'class_counts': {name: int(row_counts[:, value].sum()) for name, value in ANALYSIS_CLASSES.items()},
+        'class_areas_sqkm': class_areas_sqkm(row_counts, green_transform, green_crs, target_shape, row_areas),
+        # Строка 0 - вне постоянных вод, строка 1 - на постоянных водах; столбец - код индекса
+        'mndwi_histogram': {
+            'scale': MNDWI_INDEX_SCALE,
+            'offset': MNDWI_INDEX_OFFSET,
+            'pixels': hist_pixels.tolist(),
+            'areas_sqkm': (hist_areas / 1e6).tolist(),
+            # Постоянные воды без значения индекса: относятся к only_pw при любом пороге
+            'pw_nodata_pixels': pw_nodata_pixels,
+            'pw_nodata_areas_sqkm': pw_nodata_area / 1e6,
+        },
+    }
+
+
+def class_areas_sqkm(row_counts, transform, crs, shape, row_areas=None):
+    """
+    Площади классов (км²) по числу пикселей в строках и площади пикселя каждой строки.
+    Args:
+        row_counts: массив (height, 4) с числом пикселей каждого класса по строкам
+        transform, crs, shape: геопривязка и размер растра классов
+        row_areas: площади пикселя по строкам (pixel_row_areas), если уже рассчитаны
+    Returns:
+        dict {имя класса: площадь в км²}
+    """
+    if row_areas is None:
+        row_areas = pixel_row_areas(transform, crs, shape)
+    areas = row_counts.T @ row_areas / 1e6
+    return {name: float(areas[value]) for name, value in ANALYSIS_CLASSES.items()}
+
+
+def shapes_to_geometries(features):
+    """
+    Векторное построение полигонов shapely из результатов rasterio.features.shapes.
+    Вместо вызова shape() для каждого объекта координаты всех колец собираются
+    в один массив, а кольца и полигоны создаются одним вызовом shapely.
+    Args:
+        features: итератор пар (GeoJSON-геометрия, значение)
+    Returns:
+        (массив полигонов shapely, массив значений)
+    """
+    ring_coords = []
+    ring_sizes = []
+    ring_polygons = []
+    values = []
+    for i, (geom, value) in enumerate(features):
+        for ring in geom['coordinates']:
+            ring_coords.extend(ring)
+            ring_sizes.append(len(ring))
+            ring_polygons.append(i)
+        values.append(value)
+    if not values:
+        return np.empty(0, dtype=object), np.empty(0)
+    coords = np.asarray(ring_coords, dtype=np.float64)
+    rings = shapely.linearrings(coords, indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes))
+    # Первое кольцо каждого полигона - внешняя граница, остальные - дырки
+    polygons = shapely.polygons(rings, indices=np.asarray(ring_polygons))
+    return polygons, np.asarray(values)
+
+
+def polygonize_tile(raster_path, window, values=None, min_region_pixels=0):
+    """
+    Полигонизация одного тайла (полосы строк) в пиксельных координатах всей сцены.
+    Полигоны, касающиеся внутренних границ тайла (швов), возвращаются отдельно:
+    их нужно склеить с соседними тайлами.
+    Args:
+        raster_path: путь к растру (классы или маска)
+        window: окно тайла во всю ширину растра
+        values: векторизуемые значения (по умолчанию все ненулевые)
+        min_region_pixels: области не больше этого размера (в пикселях) не векторизуются
+    Returns:
+        dict с ключами interior и seam - пары (массив полигонов, массив значений)
+    """
+    def read_mask(w):
+        data = src.read(1, window=w)
+        return data > 0 if values is None else np.isin(data, values)
+
+    with rasterio.open(raster_path) as src:
+        data = src.read(1, window=window)
+        mask = read_sieved_window(read_mask, window, min_region_pixels, src.height)
+        height = src.height
+    empty = (np.empty(0, dtype=object), np.empty(0))
+    if not mask.any():
+        return {'interior': empty, 'seam': empty}
+    # Целочисленные пиксельные координаты: совпадение границ на швах проверяется точно
+    transform = Affine.translation(window.col_off, window.row_off)
+    polygons, vals = shapes_to_geometries(shapes(data, mask=mask, transform=transform))
+    bounds = shapely.bounds(polygons)
+    top, bottom = window.row_off, window.row_off + window.height
+    seam = ((bounds[:, 1] == top) & (top > 0)) | ((bounds[:, 3] == bottom) & (bottom < height))
+    return {'interior': (polygons[~seam], vals[~seam]), 'seam': (polygons[seam], vals[seam])}
+
+
+def stitch_seam_polygons(polygons, values):
+    """
+    Склейка полигонов соседних тайлов, имеющих общий отрезок границы на шве
+    (4-связность, как у однопроходного shapes()). Касание в одной точке не склеивается.
+    Args:
+        polygons: массив полигонов, касающихся швов (в пиксельных координатах)
+        values: значения полигонов
+    Returns:
+        (массив полигонов, массив значений)
+    """
+    if len(polygons) == 0:
+        return polygons, values
+    left, right = shapely.STRtree(polygons).query(polygons, predicate='touches')
+    pairs = (left < right) & (values[left] == values[right])
+    left, right = left[pairs], right[pairs]
+    shared = shapely.length(shapely.intersection(polygons[left], polygons[right])) > 0
+    parent = np.arange(len(polygons))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(left[shared], right[shared]):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    roots = np.array([find(i) for i in range(len(polygons))])
+    merged = []
+    for root in np.unique(roots):
+        group = polygons[roots == root]
+        # simplify(0) убирает лишние вершины, оставшиеся на линии шва после объединения
+        merged.append(group[0] if len(group) == 1 else shapely.simplify(shapely.union_all(group), 0))
+    return np.array(merged, dtype=object), values[np.unique(roots)]
+
+
+def pixel_to_crs(polygons, transform):
+    """Переводит полигоны из пиксельных координат в координаты растра."""
+    return shapely.transform(polygons, lambda c: np.column_stack(transform * (c[:, 0], c[:, 1])))
+
+
+def iter_tiled_polygons(raster_path, values=None, max_pixels=None, executor=None, workers=1, min_region_pixels=0):
+    """
+    Тайловая полигонизация растра в пуле процессов с потоковой выдачей результатов.
+    Внутренние полигоны тайла выдаются сразу по готовности тайла, в памяти копятся
+    только полигоны на швах, которые склеиваются и выдаются последним пакетом.
+    Args:
+        raster_path: путь к растру
+        values: векторизуемые значения (по умолчанию все ненулевые)
+        max_pixels: максимальный размер тайла в пикселях
+        executor: пул процессов (None - последовательная обработка)
+        workers: число процессов (для выбора размера тайла)
+        min_region_pixels: области не больше этого размера (в пикселях) удаляются до векторизации
+    Returns:
+        генератор пар (массив полигонов в CRS растра, массив значений)
+    """
+    with rasterio.open(raster_path) as src:
+        transform = src.transform
+        tiles = list(iter_row_windows(src.height, src.width, tile_pixels(src.shape, workers, max_pixels)))
+    task = partial(polygonize_tile, raster_path, values=values, min_region_pixels=min_region_pixels)
+    seam_polygons, seam_values = [], []
+    for result in parallel_map(executor, task, tiles):
+        polygons, vals = result['interior']
+        if len(polygons):
+            yield pixel_to_crs(polygons, transform), vals
+        seam_polygons.append(result['seam'][0])
+        seam_values.append(result['seam'][1])
+    polygons, vals = stitch_seam_polygons(np.concatenate(seam_polygons), np.concatenate(seam_values))
+    if len(polygons):
+        logger.info(f"Склеено полигонов на швах тайлов: {len(polygons)}")
+        yield pixel_to_crs(polygons, transform), vals
+
+
+def to_wgs84(geometries, crs):
+    """
+    Перевод геометрий в EPSG:4326 для сохранения в GeoJSON.
+    Args:
+        geometries: массив геометрий shapely
+        crs: исходная система координат
+    Returns:
+        GeoSeries в EPSG:4326 (или в исходной CRS, если конвертация не удалась)
+    """
+    series = GeoSeries(geometries, crs=crs)
+    if series.crs and series.crs.to_epsg() != 4326 and not series.empty:
+        try:
+            series = series.to_crs(epsg=4326)
+        except Exception as e:
+            logger.error(f"Ошибка при конвертации CRS в EPSG:4326: {e}")
+            # Оставляем геометрии в исходном CRS, если конвертация не удалась
+    return series
+
+
+def iter_class_polygons(classes_path, max_pixels=None, executor=None, workers=1):
+    """
+    Тайловая векторизация растра классов с разбиением каждого пакета по классам.
+    Args:
+        classes_path: путь к растру классов
+        max_pixels, executor, workers: параметры тайловой обработки
+    Returns:
+        генератор пар (имя класса, GeoSeries в EPSG:4326)
+    """
+    with rasterio.open(classes_path) as src:
+        crs = src.crs
+    names = {value: name for name, value in ANALYSIS_CLASSES.items()}
+    for polygons, vals in iter_tiled_polygons(classes_path, max_pixels=max_pixels, executor=executor, workers=workers):
+        series = to_wgs84(polygons, crs)
+        for value in np.unique(vals):
+            yield names[int(value)], series[vals == value].reset_index(drop=True)
+
+
+def coverage_union_wkb(geometries):
+    """
+    Объединение полигонов векторизации в мультиполигон с выдачей в WKB.
+    Полигоны shapes() не перекрываются и совпадают по общим границам (образуют покрытие),
+    поэтому используется coverage_union вместо общего union; при ошибке - обычный union_all.
+    Args:
+        geometries: массив полигонов shapely
+    Returns:
+        WKB мультиполигона (bytes)
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    try:
+        merged = shapely.coverage_union_all(geometries)
+    except shapely.errors.GEOSException as e:
+        logger.warning(f"Ошибка coverage_union ({e}), используется union_all.")
+        merged = shapely.union_all(geometries)
+    if merged.geom_type == 'Polygon':
+        merged = shapely.multipolygons([merged])
+    return shapely.to_wkb(merged)
+
+
+@contextmanager
+def geojson_writer(path):
+    """
+    Потоковая запись GeoJSON FeatureCollection: объекты пишутся пакетами, без накопления в памяти.
+    Args:
+        path: путь к файлу GeoJSON
+    Returns:
+        функция write(geometries, properties=None), добавляющая геометрии (и атрибуты - dict на объект) в файл
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        count = 0
+
+        def write(geometries, properties=None):
+            nonlocal count
+            for i, geojson in enumerate(shapely.to_geojson(np.asarray(geometries, dtype=object))):
+                f.write(',\n' if count else '\n')
+                props = json.dumps(properties[i]) if properties is not None else '{}'
+                f.write(f'{{"type": "Feature", "properties": {props}, "geometry": {geojson}}}')
+                count += 1
+
+        yield write
+        f.write('\n]}\n')
+
+
+def vectorize_classes(classes_path, max_pixels=None, executor=None, workers=1):
+    """
+    Векторизация растра классов с разбиением результата по классам.
+    Args:
+        classes_path: путь к растру классов
+        max_pixels, executor, workers: параметры тайловой обработки
+    Returns:
+        dict {имя класса: GeoDataFrame в EPSG:4326}
+    """
+    parts = {name: [] for name in ANALYSIS_CLASSES}
+    for name, series in iter_class_polygons(classes_path, max_pixels, executor, workers):
+        parts[name].append(series)
+    result = {}
+    for name, series in parts.items():
+        if not series:
+            logger.warning(f"Векторизация: не найдено полигонов класса {name}.")
+            result[name] = GeoDataFrame(geometry=GeoSeries([], crs='EPSG:4326'))
+            continue
+        result[name] = GeoDataFrame(geometry=GeoSeries(np.concatenate([s.to_numpy() for s in series]), crs=series[0].crs))
+    logger.info(f"Векторизация завершена: {sum(len(gdf) for gdf in result.values())} полигонов всех классов.")
+    return result
+
+
+# --- HAND (высота над ближайшим водотоком) ---
+
+def hand_stage_index(hand_path, step=0.1, max_stage=50.0, max_pixels=None):
+    """
+    Индекс "уровень воды - площадь затопления" по растру HAND.
+    При подъеме воды на уровень h затапливаются пиксели с HAND <= h. Значения HAND округляются
+    вверх до шага step, геодезические площади пикселей (по строкам) накапливаются по кодам,
+    поэтому площадь для любого уровня - одно обращение к накопленному массиву (см. stage_area).
+    Args:
+        hand_path: путь к растру HAND (м)
+        step: шаг уровня воды (м)
+        max_stage: максимальный уровень индекса (м); пиксели с большим HAND в индекс не попадают
+        max_pixels: максимальное число пикселей в одном окне
+    Returns:
+        dict со step, max_stage и накопленными по уровням 0, step, 2*step, ... площадью (км²) и числом пикселей
+    """
+    bins = int(math.ceil(max_stage / step)) + 1
+    pixels = np.zeros(bins + 1, dtype=np.int64)
+    areas = np.zeros(bins + 1)
+    with rasterio.open(hand_path) as src:
+        row_areas = pixel_row_areas(src.transform, src.crs, (src.height, src.width))
+        for window in iter_row_windows(src.height, src.width, max_pixels):
+            values = np.ma.masked_invalid(src.read(1, window=window, masked=True).astype(np.float64))
+            # Код уровня ceil(HAND / step); nodata и HAND выше max_stage - в последний (неучитываемый) код
+            codes = np.ma.filled(np.minimum(np.ceil(np.maximum(values, 0) / step), bins), bins).astype(np.int64).ravel()
+            weights = np.broadcast_to(row_areas[window.row_off:window.row_off + window.height, None],
+                                      (int(window.height), int(window.width))).ravel()
+            pixels += np.bincount(codes, minlength=bins + 1)
+            areas += np.bincount(codes, weights=weights, minlength=bins + 1)
+    return {
+        'step': step,
+        'max_stage': (bins - 1) * step,
+        'areas_sqkm': (np.cumsum(areas[:bins]) / 1e6).tolist(),
+        'pixels': np.cumsum(pixels[:bins]).tolist(),
+    }
+
+
+def stage_level(index, stage):
+    """Номер уровня индекса HAND для уровня воды stage (округление вниз до шага индекса, None - ниже нуля)."""
+    if stage < 0:
+        return None
+    return min(int(math.floor(stage / index['step'] + 1e-9)), len(index['areas_sqkm']) - 1)
+
+
+def stage_area(index, stage):
+    """
+    Площадь затопления (км²) при подъеме воды на stage метров по индексу hand_stage_index.
+    Уровень округляется вниз до шага индекса и ограничивается его максимальным уровнем.
+    """
+    level = stage_level(index, stage)
+    return 0.0 if level is None else index['areas_sqkm'][level]
+
+
+def stage_extent_mask(hand_path, output_path, stage, max_pixels=None, shared=None):
+    """
+    Маска затопления HAND <= stage по окнам (пиксели nodata не затапливаются).
+    Args:
+        hand_path: путь к растру HAND
+        output_path: путь для сохранения маски uint8 (1 - затоплено, 0 - нет)
+        stage: уровень воды (м)
+        max_pixels: максимальное число пикселей в одном окне
+        shared: тот же растр HAND в разделяемой памяти (SharedRaster), опционально
+    Returns:
+        output_path
+    """
+    with rasterio.open(hand_path) as src, \
+            rasterio.open(output_path, 'w', **mask_profile(src.shape, src.transform, src.crs)) as dst:
+        for window in iter_row_windows(src.height, src.width, max_pixels):
+            if shared is not None:
+                values = shared.array[window.row_off:window.row_off + window.height]
+                values = np.ma.masked_invalid(np.ma.masked_equal(values, shared.nodata) if shared.nodata is not None else values)
+            else:
+                values = src.read(1, window=window, masked=True)
+            dst.write(np.ma.filled(values <= stage, False).view(np.uint8), 1, window=window)
+    return output_path
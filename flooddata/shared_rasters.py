@@ -0,0 +1,198 @@
+"""
+Кэш декодированных растров в разделяемой памяти узла (DEM, заполненный DEM, аккумуляция, маски водоёмов).
+Растр декодируется один раз в сегмент multiprocessing.shared_memory; фоновые задачи и процессы пула
+на том же узле подключаются к сегменту по имени и читают массив без повторного декодирования и копирования.
+Сегменты переживают задачи; их описания (meta) хранятся в каталоге индекса, время изменения описания -
+время последнего использования, по нему давно не использованные сегменты вытесняются (LRU).
+Модуль не зависит от Django.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from multiprocessing import shared_memory
+import numpy as np
+import rasterio
+from affine import Affine
+
+logger = logging.getLogger(__name__)
+
+# Сегменты, подключенные в текущем процессе: имя -> (SharedMemory, SharedRaster)
+_attached = {}
+
+
+class SharedRaster:
+    """Растр в разделяемой памяти: массив только для чтения и геопривязка."""
+
+    def __init__(self, array, transform, crs, nodata):
+        self.array = array
+        self.transform = transform
+        self.crs = crs
+        self.nodata = nodata
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+
+def segment_name(path, band=1):
+    """Имя сегмента растра: хэш пути, размера и времени изменения файла (новая версия файла - новый сегмент)."""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{band}"
+    # Короткое имя: на macOS длина имени сегмента ограничена 31 символом
+    return 'flood_' + hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+def _untrack(shm):
+    """
+    Отключает удаление сегмента resource_tracker при завершении процесса:
+    сегменты кэша должны переживать задачу и процесс, который их создал или подключил.
+    """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _close(shm):
+    """Закрывает сегмент в текущем процессе (если на буфер еще есть ссылки, он закроется при сборке мусора)."""
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+def _meta_path(index_dir, name):
+    return os.path.join(index_dir, f"{name}.json")
+
+
+def _attach(name, meta):
+    """Подключение к сегменту по описанию meta."""
+    shm = shared_memory.SharedMemory(name=name)
+    _untrack(shm)
+    array = np.ndarray(tuple(meta['shape']), dtype=meta['dtype'], buffer=shm.buf)
+    array.flags.writeable = False
+    raster = SharedRaster(array, Affine(*meta['transform']), meta['crs'], meta['nodata'])
+    _attached[name] = (shm, raster)
+    return raster
+
+
+def _shm_free_bytes():
+    """Свободное место в /dev/shm (Linux) или None: запись сверх него завершает процесс по SIGBUS."""
+    if not os.path.isdir('/dev/shm'):
+        return None
+    return shutil.disk_usage('/dev/shm').free
+
+
+def shared_raster(path, index_dir, max_bytes, band=1):
+    """
+    Растр из кэша в разделяемой памяти; при отсутствии растр декодируется в новый сегмент.
+    Args:
+        path: путь к GeoTIFF
+        index_dir: каталог индекса сегментов (общий для процессов узла)
+        max_bytes: ограничение общего размера сегментов кэша
+        band: номер канала
+    Returns:
+        SharedRaster или None, если растр больше ограничения, в /dev/shm нет места
+        или сегмент в этот момент создается другим процессом (тогда растр читается из файла)
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    name = segment_name(path, band)
+    meta_path = _meta_path(index_dir, name)
+    if os.path.exists(meta_path):
+        try:
+            # Время изменения описания - время последнего использования (для вытеснения LRU)
+            os.utime(meta_path)
+            if name in _attached:
+                return _attached[name][1]
+            with open(meta_path, encoding='utf-8') as f:
+                return _attach(name, json.load(f))
+        except FileNotFoundError:
+            # Сегмент вытеснен другим процессом - создаем заново
+            _attached.pop(name, None)
+
+    with rasterio.open(path) as src:
+        dtype = np.dtype(src.dtypes[band - 1])
+        shape = (src.height, src.width)
+        size = shape[0] * shape[1] * dtype.itemsize
+        free = _shm_free_bytes()
+        if size > max_bytes or (free is not None and size > free):
+            return None
+        evict_shared_rasters(index_dir, max_bytes - size)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            return None
+        try:
+            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            src.read(band, out=array)
+            meta = {
+                'path': os.path.abspath(path),
+                'shape': list(shape),
+                'dtype': dtype.str,
+                'transform': list(src.transform)[:6],
+                'crs': src.crs.to_wkt() if src.crs else None,
+                'nodata': src.nodatavals[band - 1],
+                'bytes': size,
+            }
+        except Exception:
+            _close(shm)
+            shm.unlink()
+            raise
+    _untrack(shm)
+    # Описание публикуется атомарно после заполнения сегмента: его наличие - признак готовности
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", dir=index_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+    array.flags.writeable = False
+    raster = SharedRaster(array, Affine(*meta['transform']), meta['crs'], meta['nodata'])
+    _attached[name] = (shm, raster)
+    logger.info(f"Растр {path} загружен в разделяемую память ({size} байт)")
+    return raster
+
+
+def evict_shared_rasters(index_dir, max_bytes):
+    """
+    Вытеснение давно не использованных сегментов (LRU), пока их общий размер больше max_bytes.
+    Процессы, уже подключенные к вытесненному сегменту, дочитывают его (память освобождается после отключения всех).
+    Returns:
+        число вытесненных сегментов
+    """
+    entries = []
+    total = 0
+    for entry in os.scandir(index_dir):
+        if entry.name.startswith('.') or not entry.name.endswith('.json'):
+            continue
+        try:
+            with open(entry.path, encoding='utf-8') as f:
+                size = json.load(f)['bytes']
+            entries.append((entry.stat().st_mtime, entry.name[:-len('.json')], size))
+        except (OSError, ValueError, KeyError):
+            continue
+        total += size
+    evicted = 0
+    for _, name, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(_meta_path(index_dir, name))
+        except FileNotFoundError:
+            continue  # Уже вытеснен другим процессом
+        if name in _attached:
+            _close(_attached.pop(name)[0])
+        try:
+            # Подключение регистрирует сегмент в resource_tracker, unlink снимает регистрацию
+            shm = shared_memory.SharedMemory(name=name)
+            _close(shm)
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(f"Кэш растров в разделяемой памяти: вытеснено сегментов: {evicted}")
+    return evicted
@@ -13,4 +13,25 @@
 # @receiver(post_delete, sender=FloodEvent)
 # @receiver(post_delete, sender=FloodZone)
 # def update_geoserver_on_delete(sender, instance, **kwargs):
-#     pass
\ No newline at end of file
+#     pass
+
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .models import WaterbodyVector
+
+
+@receiver(post_save, sender=WaterbodyVector)
+def import_waterbody_features_on_save(sender, instance, created, update_fields=None, **kwargs):
+    """Ставит в очередь загрузку объектов слоя водоёмов в PostGIS: для нового слоя и при замене shapefile"""
+    if not instance.shp_file_path:
+        return
+    if not (created or update_fields is None or 'shp_file_path' in update_fields):
+        return
+    from .tasks import import_waterbody_features_bg, waterbody_features_stale
+    if instance.features_imported and not waterbody_features_stale(instance):
+        return
+    if instance.features_imported:
+        # До повторной загрузки растеризуется сам shapefile, а не устаревшие объекты в БД
+        WaterbodyVector.objects.filter(id=instance.id).update(features_imported=False)
+        instance.features_imported = False
+    import_waterbody_features_bg(instance.id)
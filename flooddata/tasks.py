@@ -1,32 +1,323 @@
 from background_task import background
-from django.utils import timezone
-from .models import FloodAnalysis
-from .utils import process_satellite_image, create_flood_mask_vector, rasterize_waterbody_vector, create_permanent_water_mask_from_accumulation, hydrological_dem_correction
+from background_task.models import Task
+from .models import DEMFile, FloodAnalysis, SatelliteImage, WaterbodyFeature, WaterbodyFeatureProjection, WaterbodyVector
+from django.db import transaction
+from .utils import process_satellite_image, rasterize_waterbody_vector, hydrological_dem_correction, compute_hand, build_virtual_mosaic
+from .raster_processing import ANALYSIS_CLASSES, mndwi_threshold_code, grid_signature, threshold_mask_to_grid, analysis_pool, run_analysis_tiles, iter_class_polygons, geojson_writer, coverage_union_wkb, compute_band_statistics, hand_stage_index, stage_level, stage_extent_mask, iter_tiled_polygons, to_wgs84, raster_footprint
+from .profiling import StageProfiler
+from .shared_rasters import shared_raster
+from .cache import cached_stage, discard_stage, evict_stage, file_digest, link_artifact, load_stage, publish_stage, stage_key, stage_path
+import glob
 import os
+from contextlib import ExitStack
 from django.conf import settings
-from django.contrib.gis.geos import GEOSGeometry, MultiPolygon as GEOSMultiPolygon
-import json
+from django.contrib.gis.geos import GEOSGeometry
 import logging
 import rasterio
 import numpy as np
-from rasterio.enums import Resampling
-from skimage.measure import label
-from shapely.geometry import shape, mapping
 import geopandas as gpd
 import traceback
-from rasterio.warp import transform_bounds
-from rasterio.windows import from_bounds
+from affine import Affine
 
 logger = logging.getLogger(__name__)
 
+def get_band_statistics(image):
+    """
+    Возвращает сохраненную статистику канала SatelliteImage.
+    Если статистика еще не рассчитана, считает ее потоковым проходом и сохраняет.
+    """
+    if not image.band_stats:
+        image.band_stats = compute_band_statistics(
+            image.file.path, max_pixels=getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None)
+        )
+        image.save(update_fields=['band_stats'])
+        logger.info(f"Рассчитана статистика канала для снимка {image.id}: min={image.band_stats['min']}, max={image.band_stats['max']}")
+    return image.band_stats
+
+@background(schedule=1)
+def compute_band_statistics_bg(image_id):
+    """Фоновый расчет статистики канала после загрузки снимка"""
+    try:
+        image = SatelliteImage.objects.get(id=image_id)
+        get_band_statistics(image)
+    except Exception as e:
+        logger.error(f"Ошибка при расчете статистики снимка {image_id}: {e}")
+
+def get_shared_raster(path):
+    """
+    Растр из кэша декодированных растров в разделяемой памяти узла (см. shared_rasters.py).
+    Returns:
+        SharedRaster или None (кэш отключен, растр не помещается - тогда растр читается из файла)
+    """
+    max_bytes = getattr(settings, 'FLOOD_SHARED_RASTER_CACHE_BYTES', 0)
+    if not max_bytes:
+        return None
+    try:
+        return shared_raster(path, settings.FLOOD_SHARED_RASTER_INDEX_DIR, max_bytes)
+    except Exception as e:
+        logger.warning(f"Растр {path} не загружен в разделяемую память, чтение из файла: {e}")
+        return None
+
+def get_dem_hydrology(dem, force=False):
+    """
+    Возвращает путь к растру flow accumulation для всего DEMFile.
+    Заполнение DEM и аккумуляция считаются один раз для файла целиком (без краевых эффектов обрезки)
+    и сохраняются в модели; анализы читают из них только нужное окно.
+    """
+    if force or not (dem.processed and dem.accumulation_file and os.path.exists(dem.accumulation_file.path)):
+        base_name = os.path.splitext(os.path.basename(dem.file.name))[0]
+        corrected_path = f"dem_results/{base_name}_corrected.tif"
+        acc_path = f"dem_results/{base_name}_accumulation.tif"
+        abs_corrected = os.path.join(settings.MEDIA_ROOT, corrected_path)
+        abs_acc = os.path.join(settings.MEDIA_ROOT, acc_path)
+        os.makedirs(os.path.dirname(abs_corrected), exist_ok=True)
+        logger.info(f"Гидрологическая коррекция DEM {dem.file.name} (базовый слой: {dem.is_base_layer})")
+        # Базовый слой DEM уже заполнен (filled), fill_depressions не выполняется
+        hydrological_dem_correction(dem.file.path, abs_corrected, abs_acc, already_filled=dem.is_base_layer,
+                                    lazy=True)
+        dem.corrected_file.name = corrected_path
+        dem.accumulation_file.name = acc_path
+        dem.processed = True
+        # HAND зависит от заполненного DEM и аккумуляции - после пересчета он строится заново
+        dem.hand_index = None
+        dem.save(update_fields=['corrected_file', 'accumulation_file', 'processed', 'hand_index'])
+    return dem.accumulation_file.path
+
+def get_dem_hand(dem, force=False):
+    """
+    Возвращает путь к растру HAND для всего DEMFile.
+    HAND и индекс "уровень воды - площадь" считаются один раз по заполненному DEM и аккумуляции
+    и сохраняются в модели; площадь затопления для любого уровня воды берется из индекса.
+    """
+    if force or not (dem.hand_index and dem.hand_file and os.path.exists(dem.hand_file.path)):
+        acc_path = get_dem_hydrology(dem)
+        base_name = os.path.splitext(os.path.basename(dem.file.name))[0]
+        hand_path = f"dem_results/{base_name}_hand.tif"
+        abs_hand = os.path.join(settings.MEDIA_ROOT, hand_path)
+        stream_threshold = getattr(settings, 'HAND_STREAM_THRESHOLD', 1000)
+        logger.info(f"Расчет HAND для DEM {dem.file.name} (порог водотоков: {stream_threshold})")
+        compute_hand(dem.corrected_file.path, acc_path, abs_hand, stream_threshold)
+        dem.hand_file.name = hand_path
+        dem.hand_index = hand_stage_index(
+            abs_hand,
+            step=getattr(settings, 'HAND_INDEX_STEP', 0.1),
+            max_stage=getattr(settings, 'HAND_INDEX_MAX_STAGE', 50.0),
+            max_pixels=getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None)
+        )
+        dem.hand_index['stream_threshold'] = stream_threshold
+        dem.save(update_fields=['hand_file', 'hand_index'])
+    return dem.hand_file.path
+
+def get_hand_extent(dem, stage, build=True):
+    """
+    Контур затопления (GeoJSON, EPSG:4326) по HAND при подъеме воды на stage метров.
+    Уровень округляется до шага индекса HAND; контуры кэшируются по HAND и уровню.
+    build=False - только поиск готового контура в кэше (построение - в фоне, см. build_hand_extent_bg).
+    Returns:
+        путь к GeoJSON в кэше или None, если HAND еще не рассчитан (или контур не построен при build=False)
+    """
+    if not (dem.hand_index and dem.hand_file and os.path.exists(dem.hand_file.path)):
+        return None
+    hand_path = dem.hand_file.path
+    level = stage_level(dem.hand_index, stage)
+    stage_m = -1.0 if level is None else level * dem.hand_index['step']
+    inputs = {'hand': file_digest(hand_path), 'stage': level}
+    if not build:
+        key = stage_key('hand_extent', inputs)
+        return stage_path('hand_extent', key, 'extent.geojson') if load_stage('hand_extent', key) is not None else None
+    window_pixels = getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None)
+    workers = getattr(settings, 'FLOOD_ANALYSIS_WORKERS', 1)
+
+    def build_extent(tmp_dir):
+        mask_path = stage_extent_mask(hand_path, os.path.join(tmp_dir, 'mask.tif'), stage_m, max_pixels=window_pixels,
+                                      shared=get_shared_raster(hand_path))
+        with rasterio.open(mask_path) as src:
+            crs = src.crs
+        count = 0
+        with geojson_writer(os.path.join(tmp_dir, 'extent.geojson')) as write, analysis_pool(workers) as executor:
+            for polygons, _ in iter_tiled_polygons(mask_path, values=(1,), max_pixels=window_pixels, executor=executor, workers=workers):
+                write(to_wgs84(polygons, crs).to_numpy())
+                count += len(polygons)
+        os.remove(mask_path)
+        return {'stage': stage_m, 'features': count}
+
+    key, _ = cached_stage('hand_extent', inputs, build_extent,
+                          max_bytes=getattr(settings, 'HAND_EXTENT_CACHE_MAX_BYTES', None))
+    return stage_path('hand_extent', key, 'extent.geojson')
+
+def get_dem_footprint(dem):
+    """Охват DEMFile (EPSG:4326); рассчитывается по границам растра при первом обращении и сохраняется в модели."""
+    if dem.footprint is None:
+        dem.footprint = GEOSGeometry(raster_footprint(dem.file.path).wkt, srid=4326)
+        dem.save(update_fields=['footprint'])
+    return dem.footprint
+
+def index_dem_footprints():
+    """Заполняет охваты активных DEMFile, загруженных до появления каталога листов. Returns: число DEM"""
+    count = 0
+    for dem in DEMFile.objects.filter(is_active=True, footprint__isnull=True):
+        try:
+            get_dem_footprint(dem)
+            count += 1
+        except Exception as e:
+            logger.error(f"Не удалось определить охват DEM {dem.id}: {e}")
+    if count:
+        logger.info(f"Каталог листов DEM: рассчитано охватов: {count}")
+    return count
+
+def get_dem_mosaic(scene_footprint, crs, layer='file', preferred=None):
+    """
+    Виртуальная мозаика (VRT) листов DEM, пересекающих охват сцены: активные DEMFile выбираются
+    по пространственному индексу охватов, объединенный растр на диск не пишется - при чтении окна
+    мозаики читаются только пересекающие его листы.
+    Args:
+        scene_footprint: охват сцены (shapely, EPSG:4326)
+        crs: CRS мозаики (CRS снимка; листы в другой CRS перепроецируются виртуально)
+        layer: 'file' - исходные DEM, 'accumulation' - растры flow accumulation листов
+        preferred: DEMFile анализа; в перекрытиях листов берутся его значения
+    Returns:
+        (путь к растру, пути к листам мозаики); для одного листа - путь к нему самому
+    """
+    index_dem_footprints()
+    dems = list(DEMFile.objects.filter(is_active=True, footprint__intersects=GEOSGeometry(scene_footprint.wkt, srid=4326))
+                .order_by('upload_date'))
+    if preferred is not None:
+        # Листы, загруженные позже, перекрывают ранние; лист анализа - поверх всех
+        dems = [dem for dem in dems if dem.id != preferred.id] + [preferred]
+    if not dems:
+        raise Exception("Нет активных DEM, пересекающих снимок")
+    if layer == 'accumulation':
+        sources = [get_dem_hydrology(dem) for dem in dems]
+    else:
+        sources = [dem.file.path for dem in dems]
+    if len(sources) == 1:
+        return sources[0], sources
+    logger.info(f"Мозаика DEM ({layer}) из листов: {[dem.id for dem in dems]}")
+
+    def build_mosaic(tmp_dir):
+        build_virtual_mosaic(sources, os.path.join(tmp_dir, 'mosaic.vrt'), crs=crs)
+        return {'sources': sources}
+
+    # VRT ссылается на листы по путям: ключ - пути и версии файлов листов (без хэширования содержимого)
+    versions = [[os.path.abspath(path), os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in sources]
+    key, _ = cached_stage('dem_mosaic', {'layer': layer, 'sources': versions, 'crs': crs}, build_mosaic,
+                          max_bytes=getattr(settings, 'FLOOD_STAGE_CACHE_MAX_BYTES', None))
+    return stage_path('dem_mosaic', key, 'mosaic.vrt'), sources
+
+@background(schedule=1)
+def build_hand_extent_bg(dem_id, stage):
+    """Фоновое построение контура затопления по HAND для уровня stage (запросы API не строят контур сами)"""
+    try:
+        get_hand_extent(DEMFile.objects.get(id=dem_id), stage)
+    except Exception as e:
+        logger.error(f"Ошибка построения контура затопления по HAND для DEM {dem_id} (уровень {stage}): {e}")
+
+def enqueue_once(task, *args, **kwargs):
+    """
+    Ставит фоновую задачу в очередь, если такая же задача (имя и параметры) еще не ожидает выполнения
+    и не выполняется (повторные запросы не создают дублей).
+    Returns:
+        True, если задача поставлена в очередь
+    """
+    if Task.objects.get_task(task.name, args, kwargs).exists():
+        return False
+    task(*args, **kwargs)
+    return True
+
+@background(schedule=1)
+def process_satellite_image_bg(image_id):
+    """Фоновое выделение воды на снимке (действие администратора)"""
+    image = SatelliteImage.objects.get(id=image_id)
+    try:
+        image_path = image.file.path
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        output_dir = os.path.join(settings.MEDIA_ROOT, 'satellite_results')
+        os.makedirs(output_dir, exist_ok=True)
+        mask_path = os.path.join(output_dir, f"{base_name}_water_mask.tif")
+        # Обрабатываем снимок для выделения воды
+        process_satellite_image(image_path, mask_path, method='simple')
+        image.status = 'completed'
+        image.save(update_fields=['status'])
+        logger.info(f"Обработан снимок: {image.name}")
+    except Exception as e:
+        logger.error(f"Ошибка при обработке снимка {image.name}: {e}")
+        image.status = 'error'
+        image.save(update_fields=['status'])
+
+@background(schedule=1)
+def process_dem_hydrology_bg(dem_id, force=False):
+    """
+    Фоновая гидрологическая коррекция DEM и расчет HAND после загрузки или назначения базовым слоем.
+    force=True - пересчет (действие администратора).
+    """
+    try:
+        dem = DEMFile.objects.get(id=dem_id)
+        get_dem_footprint(dem)
+        if force:
+            get_dem_hydrology(dem, force=True)
+        get_dem_hand(dem)
+    except Exception as e:
+        logger.error(f"Ошибка гидрологической коррекции DEM {dem_id}: {e}")
+
+def waterbody_shapefile_files(layer):
+    """Все файлы shapefile слоя водоёмов (.shp, .dbf, .shx, .prj, ...)."""
+    vector_file_path = os.path.join(settings.MEDIA_ROOT, layer.shp_file_path)
+    return sorted(glob.glob(f"{os.path.splitext(vector_file_path)[0]}.*"))
+
+def waterbody_features_stale(layer):
+    """Объекты слоя в БД загружены не из текущего shapefile (файл заменен после загрузки)."""
+    files = waterbody_shapefile_files(layer)
+    return bool(layer.features_imported and files and layer.features_digest != file_digest(*files))
+
+def import_waterbody_features(layer):
+    """
+    Загружает объекты слоя водоёмов в PostGIS (WGS84, индекс GiST) и создает
+    перепроецированные копии в CRS из WATERBODY_PROJECTED_SRIDS (зоны UTM).
+    Хэш загруженного shapefile сохраняется в слое (features_digest).
+    """
+    vector_file_path = os.path.join(settings.MEDIA_ROOT, layer.shp_file_path)
+    digest = file_digest(*waterbody_shapefile_files(layer))
+    gdf = gpd.read_file(vector_file_path)
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(epsg=4326)
+    gdf = gdf[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    projected = {srid: gdf.geometry.to_crs(epsg=srid).to_wkb().values for srid in getattr(settings, 'WATERBODY_PROJECTED_SRIDS', [])}
+    batch_size = 1000
+    with transaction.atomic():
+        layer.features.all().delete()
+        for start in range(0, len(gdf), batch_size):
+            wkbs = gdf.geometry.iloc[start:start + batch_size].to_wkb().values
+            features = WaterbodyFeature.objects.bulk_create([
+                WaterbodyFeature(layer=layer, geometry=GEOSGeometry(memoryview(wkb), srid=4326)) for wkb in wkbs
+            ])
+            WaterbodyFeatureProjection.objects.bulk_create([
+                WaterbodyFeatureProjection(feature=feature, srid=srid, wkb=wkbs_srid[start + i])
+                for srid, wkbs_srid in projected.items()
+                for i, feature in enumerate(features)
+            ])
+        layer.features_imported = True
+        layer.features_digest = digest
+        layer.save(update_fields=['features_imported', 'features_digest'])
+    logger.info(f"Слой водоёмов {layer.name}: загружено объектов в БД: {len(gdf)}, проекций: {list(projected)}")
+
+@background(schedule=1)
+def import_waterbody_features_bg(layer_id):
+    """Фоновая загрузка объектов слоя водоёмов в PostGIS"""
+    try:
+        import_waterbody_features(WaterbodyVector.objects.get(id=layer_id))
+    except Exception as e:
+        logger.error(f"Ошибка загрузки объектов слоя водоёмов {layer_id} в БД: {e}")
+
 @background(schedule=1)
 def process_flood_analysis_bg(analysis_id):
     analysis = None
+    # Профиль этапов (время, CPU, пиковая память, ввод-вывод) сохраняется в analysis.profile
+    profiler = StageProfiler(trace_memory=getattr(settings, 'FLOOD_ANALYSIS_TRACEMALLOC', False))
+    debug_diagnostics = getattr(settings, 'FLOOD_ANALYSIS_DEBUG_DIAGNOSTICS', False)
     try:
         analysis = FloodAnalysis.objects.get(id=analysis_id)
         analysis.status = 'processing'
         analysis.save()
-        dem_path = analysis.dem_file.file.path
         # Проверяем только нужные поля
         if not analysis.green_band_image or not analysis.swir2_band_image:
             raise Exception("Не выбраны оба снимка для анализа (Green и SWIR2)")
@@ -37,110 +328,103 @@ def process_flood_analysis_bg(analysis_id):
         base_name = f"{analysis.id}_{analysis.name.replace(' ', '_')}"
 
         # --- 0. Маска постоянных вод (по выбору пользователя) ---
+        # Результаты этапов кэшируются по хэшу входов (см. cache.py): если входы этапа не изменились
+        # (например, при повторном запуске или изменении только порога), этап берется из кэша.
         permanent_water_method = analysis.permanent_water_method
         waterbody_vector = analysis.waterbody_vector
         accumulation_threshold = analysis.accumulation_threshold or 1000
         permanent_water_mask_path = None
+        pw_key = None
+        pw_stage = None
+        # Маски постоянных вод кэшируются в сетке снимка: ключ - версия источника и сетка (CRS, геопривязка, размер),
+        # поэтому повторные анализы на том же тайле снимка не растеризуют и не перепроецируют маску
+        target_grid = grid_signature(green_path)
+        pw_cache_bytes = getattr(settings, 'FLOOD_PW_MASK_CACHE_MAX_BYTES', None)
 
         if permanent_water_method == 'accumulation':
-            # --- Обрезка DEM по границе снимка для flow accumulation ---
-            with rasterio.open(green_path) as green_src:
-                green_bounds = green_src.bounds
-                green_crs = green_src.crs
-            with rasterio.open(dem_path) as dem_src: # Используем оригинальный DEM для обрезки
-                dem_crs = dem_src.crs
-                # Трансформируем bounds снимка в CRS DEM, если нужно
-                if green_crs != dem_crs:
-                    dem_bounds = transform_bounds(green_crs, dem_crs, *green_bounds)
-                else:
-                    dem_bounds = green_bounds
-                
-                # Округляем окно, чтобы избежать ошибок
-                window = from_bounds(*dem_bounds, dem_src.transform).round_offsets().round_lengths()
-
-                # Проверяем, что окно допустимо
-                if window.width <= 0 or window.height <= 0 or window.col_off < 0 or window.row_off < 0:
-                     raise ValueError("Недопустимые границы или окно для обрезки DEM.")
-
-                dem_cropped = dem_src.read(1, window=window)
-                dem_transform = rasterio.windows.transform(window, dem_src.transform)
-                
-                # Проверяем, что обрезанный DEM не пустой
-                if dem_cropped.size == 0:
-                     raise ValueError("Обрезанный DEM пустой.")
-
-                dem_profile = dem_src.profile.copy()
-                dem_profile.update({
-                    'height': dem_cropped.shape[0],
-                    'width': dem_cropped.shape[1],
-                    'transform': dem_transform,
-                    'compress': 'LZW' # Добавляем сжатие
-                })
-                cropped_dem_path = os.path.join(output_dir, f"{base_name}_dem_cropped.tif")
-                dem_profile.update({'count': 1, 'dtype': 'float32'})
-                with rasterio.open(cropped_dem_path, 'w', **dem_profile) as dst:
-                    dst.write(dem_cropped, 1)
-            
-            # Используем обрезанный DEM и сохраняем accumulation в ту же папку analysis_results
-            acc_path_output = os.path.join(output_dir, f"{base_name}_accumulation.tif")
-            
-            logger.info(f"Запуск hydrological_dem_correction для обрезанного DEM: {cropped_dem_path}")
-            try:
-                # Получаем объект DEMFile и определяем already_filled по is_base_layer
-                dem_file_obj = analysis.dem_file
-                already_filled = getattr(dem_file_obj, 'is_base_layer', False)
-                # Передаем обрезанный DEM в hydrological_dem_correction с нужным флагом
-                hydrological_dem_correction(cropped_dem_path, None, acc_path_output, already_filled=already_filled)
-                logger.info(f"Создан файл аккумуляции: {acc_path_output}")
-            except Exception as e:
-                 logger.error(f"Ошибка при hydrological_dem_correction для {cropped_dem_path}: {e}")
-                 raise # Перебрасываем ошибку дальше
-
-            permanent_water_mask_path = os.path.join(output_dir, f"{base_name}_permanent_water_acc.tif")
-            logger.info(f"Запуск create_permanent_water_mask_from_accumulation для {acc_path_output} с порогом {accumulation_threshold}")
-            try:
-                # Используем созданный файл аккумуляции для создания маски
-                create_permanent_water_mask_from_accumulation(acc_path_output, permanent_water_mask_path, threshold=accumulation_threshold)
-                logger.info(f"Создан файл растровой маски постоянных вод: {permanent_water_mask_path}")
-                
-                # Дополнительная проверка содержимого растровой маски
-                if os.path.exists(permanent_water_mask_path):
-                    with rasterio.open(permanent_water_mask_path) as src:
-                         mask_data = src.read(1)
-                         unique_values = np.unique(mask_data)
-                         logger.info(f"Уникальные значения в маске постоянных вод {os.path.basename(permanent_water_mask_path)}: {unique_values}")
-                         if len(unique_values) == 1 and unique_values[0] == 0:
-                              logger.warning(f"Маска постоянных вод {os.path.basename(permanent_water_mask_path)} содержит только нули. Возможно, порог аккумуляции ({accumulation_threshold}) слишком высокий или данные DEM не подходят.")
-
-            except Exception as e:
-                 logger.error(f"Ошибка при create_permanent_water_mask_from_accumulation для {acc_path_output}: {e}")
-                 raise # Перебрасываем ошибку дальше
+            # Flow accumulation считается один раз для каждого листа DEM (см. get_dem_hydrology).
+            # Если снимок выходит за лист анализа, аккумуляция читается из виртуальной мозаики
+            # пересекающих снимок листов (см. get_dem_mosaic). Для анализа она читается через WarpedVRT
+            # сразу в сетке снимка: обрезка и приведение виртуальные, читаются только пиксели, попадающие в снимок
+            with profiler.stage('hydro_correction'):
+                acc_path, acc_sources = get_dem_mosaic(raster_footprint(green_path), target_grid['crs'],
+                                                       layer='accumulation', preferred=analysis.dem_file)
+
+            def build_pw_accumulation(tmp_dir):
+                mask_path = os.path.join(tmp_dir, 'mask.tif')
+                logger.info(f"Построение маски постоянных вод по аккумуляции {acc_path} с порогом {accumulation_threshold}")
+                try:
+                    threshold_mask_to_grid(acc_path, mask_path, accumulation_threshold, Affine(*target_grid['transform']),
+                                           target_grid['crs'], tuple(target_grid['shape']),
+                                           max_pixels=getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None),
+                                           shared=get_shared_raster(acc_path) if len(acc_sources) == 1 else None)
+
+                    # Дополнительная (отладочная, полный проход по маске) проверка содержимого растровой маски
+                    if debug_diagnostics:
+                        with rasterio.open(mask_path) as src:
+                             mask_data = src.read(1)
+                             unique_values = np.unique(mask_data)
+                             logger.info(f"Уникальные значения в маске постоянных вод: {unique_values}")
+                             if len(unique_values) == 1 and unique_values[0] == 0:
+                                  logger.warning(f"Маска постоянных вод содержит только нули. Возможно, порог аккумуляции ({accumulation_threshold}) слишком высокий или данные DEM не подходят.")
+
+                except Exception as e:
+                     logger.error(f"Ошибка при построении маски постоянных вод по аккумуляции {acc_path}: {e}")
+                     raise # Перебрасываем ошибку дальше
+
+            with profiler.stage('permanent_water'):
+                pw_key, _ = cached_stage('pw_accumulation', {
+                    'accumulation': file_digest(*acc_sources),
+                    'threshold': accumulation_threshold,
+                    'grid': target_grid,
+                }, build_pw_accumulation, max_bytes=pw_cache_bytes)
+            pw_stage = 'pw_accumulation'
+            permanent_water_mask_path = link_artifact('pw_accumulation', pw_key, 'mask.tif', os.path.join(output_dir, f"{base_name}_permanent_water_acc.tif"))
+            logger.info(f"Файл растровой маски постоянных вод: {permanent_water_mask_path}")
 
             permanent_water_mask_type = 'accumulation' # Тип источника
 
         elif permanent_water_method == 'vector' and waterbody_vector:
             # Используем shp_file_path из модели WaterbodyVector
             vector_file_path = os.path.join(settings.MEDIA_ROOT, waterbody_vector.shp_file_path)
-            permanent_water_mask_path = os.path.join(output_dir, f"{base_name}_permanent_water_vector.tif")
-            logger.info(f"Запуск растеризации векторного слоя {vector_file_path}")
-            try:
-                # При растеризации вектора используем снимок как эталон по охвату и разрешению
-                # Передаем путь к основному .shp файлу
-                rasterize_waterbody_vector(vector_file_path, green_path, permanent_water_mask_path)
-                logger.info(f"Создан файл растровой маски постоянных вод из вектора: {permanent_water_mask_path}")
-
-                 # Дополнительная проверка содержимого растровой маски
-                if os.path.exists(permanent_water_mask_path):
-                    with rasterio.open(permanent_water_mask_path) as src:
-                         mask_data = src.read(1)
-                         unique_values = np.unique(mask_data)
-                         logger.info(f"Уникальные значения в маске постоянных вод {os.path.basename(permanent_water_mask_path)}: {unique_values}")
-                         if len(unique_values) == 1 and unique_values[0] == 0:
-                              logger.warning(f"Растеризованная маска постоянных вод {os.path.basename(permanent_water_mask_path)} содержит только нули. Возможно, векторный слой пуст или не попадает в область снимка.")
-
-            except Exception as e:
-                 logger.error(f"Ошибка при растеризации векторного слоя {vector_file_path}: {e}")
-                 raise # Перебрасываем ошибку дальше
+            # Shapefile заменен после загрузки объектов в БД - объекты загружаются заново до растеризации
+            if waterbody_features_stale(waterbody_vector):
+                logger.info(f"Shapefile слоя водоёмов {waterbody_vector.name} изменен, повторная загрузка объектов в БД")
+                import_waterbody_features(waterbody_vector)
+            # Ключ - то, что растеризуется: объекты в БД (хэш shapefile, из которого они загружены)
+            # или сам shapefile (все его файлы .shp, .dbf, .shx, .prj, ...), если объекты не загружены
+            if waterbody_vector.features_imported:
+                vector_source = {'features': waterbody_vector.features_digest}
+            else:
+                vector_source = {'vector': file_digest(*waterbody_shapefile_files(waterbody_vector))}
+
+            def build_pw_vector(tmp_dir):
+                mask_path = os.path.join(tmp_dir, 'mask.tif')
+                logger.info(f"Запуск растеризации векторного слоя {vector_file_path}")
+                try:
+                    # При растеризации вектора используем снимок как эталон по охвату и разрешению
+                    # Передаем путь к основному .shp файлу
+                    rasterize_waterbody_vector(vector_file_path, green_path, mask_path, waterbody=waterbody_vector)
+
+                    # Дополнительная (отладочная, полный проход по маске) проверка содержимого растровой маски
+                    if debug_diagnostics:
+                        with rasterio.open(mask_path) as src:
+                             mask_data = src.read(1)
+                             unique_values = np.unique(mask_data)
+                             logger.info(f"Уникальные значения в растеризованной маске постоянных вод: {unique_values}")
+                             if len(unique_values) == 1 and unique_values[0] == 0:
+                                  logger.warning(f"Растеризованная маска постоянных вод содержит только нули. Возможно, векторный слой пуст или не попадает в область снимка.")
+
+                except Exception as e:
+                     logger.error(f"Ошибка при растеризации векторного слоя {vector_file_path}: {e}")
+                     raise # Перебрасываем ошибку дальше
+
+            with profiler.stage('permanent_water'):
+                pw_key, _ = cached_stage('pw_vector', {**vector_source, 'grid': target_grid},
+                                         build_pw_vector, max_bytes=pw_cache_bytes)
+            pw_stage = 'pw_vector'
+            permanent_water_mask_path = link_artifact('pw_vector', pw_key, 'mask.tif', os.path.join(output_dir, f"{base_name}_permanent_water_vector.tif"))
+            logger.info(f"Файл растровой маски постоянных вод из вектора: {permanent_water_mask_path}")
 
             permanent_water_mask_type = 'vector' # Тип источника
         else:
@@ -148,293 +432,186 @@ def process_flood_analysis_bg(analysis_id):
              permanent_water_mask_type = 'none'
 
 
-        # --- 1. Маска воды по снимку (MNDWI > 0) ---
-        # Этот шаг должен выполняться перед обработкой маски постоянных вод,
-        # чтобы определить целевые размеры и CRS.
-        logger.info("Начало расчета маски MNDWI")
-        try:
-            with rasterio.open(green_path) as green_src:
-                green = green_src.read(1).astype(np.float32)
-                green_transform = green_src.transform
-                green_crs = green_src.crs
-                target_shape = green.shape
-            with rasterio.open(swir2_path) as swir2_src:
-                # Ресемплинг снимка SWIR2 к размеру снимка Green
-                swir2 = swir2_src.read(1, out_shape=target_shape, resampling=Resampling.nearest).astype(np.float32)
-            
-            # Нормализация снимков перед расчетом MNDWI
-            max_green = np.max(green) if np.max(green) > 0 else 1 # Избегаем деления на ноль
-            max_swir2 = np.max(swir2) if np.max(swir2) > 0 else 1 # Избегаем деления на ноль
-            green_norm = green / max_green
-            swir2_norm = swir2 / max_swir2
-
-            mndwi = (green_norm - swir2_norm) / (green_norm + swir2_norm + 1e-6) # Добавляем epsilon для стабильности
-
-            mndwi_mask = (mndwi > 0).astype(np.uint8)
-            mndwi_mask_path = os.path.join(output_dir, f"{base_name}_mndwi_mask.tif")
-            mndwi_profile = {
-                'height': target_shape[0], 'width': target_shape[1], 'transform': green_transform, 'crs': green_crs, 'count': 1, 'dtype': 'uint8',
-                 'compress': 'LZW' # Добавляем сжатие
-            }
-            with rasterio.open(mndwi_mask_path, 'w', **mndwi_profile) as dst:
-                dst.write(mndwi_mask, 1)
-            logger.info(f"Создана маска MNDWI: {mndwi_mask_path}")
-            
-            # Проверка содержимого маски MNDWI
-            unique_mndwi_values = np.unique(mndwi_mask)
-            logger.info(f"Уникальные значения в маске MNDWI: {unique_mndwi_values}")
-
-        except Exception as e:
-             logger.error(f"Ошибка при расчете маски MNDWI: {e}")
-             raise # Перебрасываем ошибку дальше
-
-
-        # --- 2. Маска постоянных вод (приведение к сетке снимка) ---
-        # Теперь mndwi_mask определена и имеет нужные размеры и CRS.
-        # Инициализируем pw_mask нулевой маской такого же размера, как mndwi_mask.
-        pw_mask = np.zeros_like(mndwi_mask, dtype=np.uint8) 
-        
-        logger.info(f"Обработка маски постоянных вод. Источник: {permanent_water_mask_path}, Тип: {permanent_water_mask_type}")
-
-        if permanent_water_mask_path and os.path.exists(permanent_water_mask_path):
-            try:
-                with rasterio.open(permanent_water_mask_path) as pw_src:
-                    logger.info(f"Чтение растровой маски постоянных вод: {permanent_water_mask_path}")
-                    
-                    # Проверяем, что CRS совпадают или трансформируем
-                    if pw_src.crs != green_crs:
-                        logger.warning(f"CRS маски постоянных вод ({pw_src.crs}) не совпадает с CRS снимка ({green_crs}). Выполняем репроекцию.")
-                        # Репроекция и ресемплинг маски постоянных вод к сетке снимка
-                        reprojected_pw_mask = np.zeros_like(mndwi_mask, dtype=np.uint8)
-                        from rasterio.warp import reproject
-                        reproject(
-                            source=pw_src.read(1),
-                            destination=reprojected_pw_mask,
-                            src_transform=pw_src.transform,
-                            src_crs=pw_src.crs,
-                            dst_transform=green_transform,
-                            dst_crs=green_crs,
-                            resampling=Resampling.nearest,
-                            # Добавляем nodata, чтобы пустые области оставались 0
-                            dst_nodata=0 
-                        )
-                        pw_mask = reprojected_pw_mask # Присваиваем значение
-                        logger.info("Репроекция и ресемплинг маски постоянных вод завершены.")
-                    elif pw_src.shape != mndwi_mask.shape:
-                         logger.warning(f"Размер маски постоянных вод ({pw_src.shape}) не совпадает с размером снимка ({mndwi_mask.shape}). Выполняем ресемплинг.")
-                         # Только ресемплинг, если CRS совпадает, но размер нет
-                         resampled_pw_mask = np.zeros_like(mndwi_mask, dtype=np.uint8)
-                         from rasterio.warp import reproject
-                         reproject(
-                            source=pw_src.read(1),
-                            destination=resampled_pw_mask,
-                            src_transform=pw_src.transform,
-                            src_crs=pw_src.crs, # CRS совпадает
-                            dst_transform=green_transform,
-                            dst_crs=green_crs, # CRS совпадает
-                            resampling=Resampling.nearest,
-                            # Добавляем nodata
-                            dst_nodata=0
-                         )
-                         pw_mask = resampled_pw_mask # Присваиваем значение
-                         logger.info("Ресемплинг маски постоянных вод завершен.")
-                    else:
-                         # Размеры и CRS совпадают, просто читаем
-                         pw_mask = pw_src.read(1) # Присваиваем значение
-                         logger.info("Маска постоянных вод соответствует сетке снимка.")
-
-                    # Проверка значений после приведения к сетке снимка
-                    unique_pw_aligned_values = np.unique(pw_mask)
-                    logger.info(f"Уникальные значения в маске постоянных вод после приведения к сетке снимка: {unique_pw_aligned_values}")
-
-            except Exception as e:
-                 logger.error(f"Ошибка при обработке маски постоянных вод {permanent_water_mask_path} после создания: {e}")
-                 # В случае ошибки pw_mask останется нулевой, как инициализировано выше
-                 pass # Не нужно присваивать pw_mask = np.zeros_like(...) здесь повторно
-
-
-        # --- 3. Сравнение масок ---
+        # --- 1-3. MNDWI, приведение маски постоянных вод к сетке снимка и сравнение масок ---
+        # Сцена делится на тайлы (полосы строк), которые обрабатываются в пуле процессов.
+        # Квантованный индекс MNDWI, маска MNDWI по порогу и растр классов пишутся в файлы по окнам. Классы растра:
         # 1 - вода только на постоянных водах (vector/accumulation) - ЗОНА ОСУШЕНИЯ (Пост. вода есть, снимок нет)
         # 2 - вода только на снимке (новая) - ЗОНА ЗАТОПЛЕНИЯ (Снимок есть, Пост. вода нет)
         # 3 - вода и там, и там (совпадает) - СОВПАДАЮЩАЯ ВОДА
-        # Инвертируем pw_mask для корректного сравнения: 1 - пост. вода, 0 - не пост. вода
-        # Теперь pw_mask гарантированно инициализирована
-        pw_mask_binary = (pw_mask > 0).astype(np.uint8)
-        mndwi_mask_binary = (mndwi_mask > 0).astype(np.uint8)
-
-        logger.info("Выполнение сравнения масок: only_pw, only_mndwi, both")
-        logger.info(f"Shape pw_mask_binary: {pw_mask_binary.shape}, Shape mndwi_mask_binary: {mndwi_mask_binary.shape}")
-
-        # Зона осушения: Вода на пост. водах есть (1), на снимке нет (0)
-        only_pw = np.logical_and(pw_mask_binary == 1, mndwi_mask_binary == 0).astype(np.uint8)
-        logger.info(f"Уникальные значения в маске only_pw: {np.unique(only_pw)}")
-
-        # Зона затопления: Вода на пост. водах нет (0), на снимке есть (1)
-        only_mndwi = np.logical_and(pw_mask_binary == 0, mndwi_mask_binary == 1).astype(np.uint8)
-        logger.info(f"Уникальные значения в маске only_mndwi: {np.unique(only_mndwi)}")
-
-        # Совпадающая вода: Вода есть и там, и там (1 и 1)
-        both = np.logical_and(pw_mask_binary == 1, mndwi_mask_binary == 1).astype(np.uint8)
-        logger.info(f"Уникальные значения в маске both: {np.unique(both)}")
-
-
-        # Функция для векторизации маски в GeoDataFrame
-        def mask_to_gdf(mask_array, transform, crs):
-            """Векторизует бинарную маску в GeoDataFrame."""
-            from rasterio.features import shapes
-            from shapely.geometry import shape
-            from geopandas import GeoDataFrame
-
-            logger.info(f"Начало векторизации маски с уникальными значениями: {np.unique(mask_array)}")
-
-            # Получаем фигуры (полигоны) из маски, где значение пикселя > 0
-            # Убедимся, что mask_array>0 действительно находит что-то
-            if np.any(mask_array > 0):
-                 all_shapes = shapes(mask_array, mask=mask_array > 0, transform=transform)
-            else:
-                 logger.warning("Векторизация: Маска содержит только нули.")
-                 all_shapes = [] # Пустой итератор
-
-            polygons = []
-            for geom, value in all_shapes:
-                if value > 0: # Учитываем только пиксели со значением > 0 (т.е. 1)
-                    polygons.append(shape(geom))
-
-            if not polygons:
-                logger.warning("Векторизация: Не найдено полигонов для создания GeoDataFrame.")
-                # Возвращаем пустой GeoDataFrame с правильным CRS
-                return GeoDataFrame({'geometry': []}, crs=crs)
-
-            # Создаем GeoDataFrame
-            gdf = GeoDataFrame({'geometry': polygons}, crs=crs)
-
-            # Если CRS не WGS84 (EPSG:4326), конвертируем для корректного сохранения в GeoJSON
-            if gdf.crs and gdf.crs.to_epsg() != 4326:
-                 try:
-                     gdf = gdf.to_crs(epsg=4326)
-                     logger.info("GeoDataFrame сконвертирован в EPSG:4326.")
-                 except Exception as e:
-                     logger.error(f"Ошибка при конвертации CRS в EPSG:4326: {e}")
-                     # Попробуем сохранить в исходном CRS, если конвертация не удалась
-                     pass # Оставляем gdf как есть
-
-            logger.info(f"Векторизация завершена. Создан GeoDataFrame с {len(polygons)} полигонами.")
-            return gdf
-
-
-        # Векторизуем каждую маску
-        # Используем transform и crs от снимка (green_transform, green_crs)
-        logger.info("Векторизация маски only_pw...")
-        gdf_only_pw = mask_to_gdf(only_pw, green_transform, green_crs)
-        logger.info("Векторизация маски only_mndwi...")
-        gdf_only_mndwi = mask_to_gdf(only_mndwi, green_transform, green_crs)
-        logger.info("Векторизация маски both...")
-        gdf_both = mask_to_gdf(both, green_transform, green_crs)
-
-        # Сохраняем в GeoJSON
-        # Используем суффикс _pw для постоянных вод, чтобы не путать со старым only_dem
-        only_pw_path_geojson = os.path.join(output_dir, f"{base_name}_only_pw.geojson") # Зона осушения
-        only_mndwi_path_geojson = os.path.join(output_dir, f"{base_name}_only_mndwi.geojson") # Зона затопления
-        both_path_geojson = os.path.join(output_dir, f"{base_name}_both.geojson") # Совпадающая вода
-
-        logger.info(f"Сохранение GeoJSON: only_pw ({len(gdf_only_pw)} features), only_mndwi ({len(gdf_only_mndwi)} features), both ({len(gdf_both)} features)")
-
-        try:
-            gdf_only_pw.to_file(only_pw_path_geojson, driver='GeoJSON')
-            logger.info(f"GeoJSON only_pw сохранен: {only_pw_path_geojson}")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении only_pw GeoJSON: {e}")
-            analysis.error_message += f"\nОшибка при сохранении only_pw GeoJSON: {e}"
-
-
-        try:
-            gdf_only_mndwi.to_file(only_mndwi_path_geojson, driver='GeoJSON')
-            logger.info(f"GeoJSON only_mndwi сохранен: {only_mndwi_path_geojson}")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении only_mndwi GeoJSON: {e}")
-            analysis.error_message += f"\nОшибка при сохранении only_mndwi GeoJSON: {e}"
-
-        try:
-            gdf_both.to_file(both_path_geojson, driver='GeoJSON')
-            logger.info(f"GeoJSON both сохранен: {both_path_geojson}")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении both GeoJSON: {e}")
-            analysis.error_message += f"\nОшибка при сохранении both GeoJSON: {e}"
-
-
-        # Функция для расчета площади
-        def area_sqkm(gdf):
-            """Рассчитывает площадь GeoDataFrame в км², конвертируя в проекционную CRS."""
-            if gdf.empty:
-                logger.info("Расчет площади для пустого GeoDataFrame: 0.0 км²")
-                return 0.0
-            
-            # Попытка использовать проекционную CRS, если gdf имеет CRS
-            projected_gdf = gdf
-            if gdf.crs and gdf.crs.is_geographic:
+        # Индекс MNDWI зависит только от снимков, поэтому при смене порога MNDWI, источника постоянных вод
+        # или порога аккумуляции он берется из кэша, а маска и растр классов строятся по нему без расчета по каналам.
+        workers = getattr(settings, 'FLOOD_ANALYSIS_WORKERS', 1)
+        window_pixels = getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None)
+        bit_packed = getattr(settings, 'FLOOD_CLASS_RASTER_BIT_PACKED', True)
+        stage_cache_bytes = getattr(settings, 'FLOOD_STAGE_CACHE_MAX_BYTES', None)
+        mndwi_index_path = os.path.join(output_dir, f"{base_name}_mndwi_index.tif")
+        mndwi_mask_path = os.path.join(output_dir, f"{base_name}_mndwi_mask.tif")
+        classes_path = os.path.join(output_dir, f"{base_name}_classes.tif")
+        if not (permanent_water_mask_path and os.path.exists(permanent_water_mask_path)):
+            permanent_water_mask_path = None
+            pw_key = None
+        # Процессы пула читают маску из кэша этапа, а не из ссылки анализа: сегмент разделяемой памяти
+        # именуется по пути файла, поэтому анализы с одной маской используют один сегмент
+        pw_source_path = permanent_water_mask_path
+        if pw_key and os.path.exists(stage_path(pw_stage, pw_key, 'mask.tif')):
+            pw_source_path = stage_path(pw_stage, pw_key, 'mask.tif')
+        logger.info(f"Тайловая обработка сцены ({workers} процессов). Маска постоянных вод: {permanent_water_mask_path}, Тип: {permanent_water_mask_type}")
+        index_key = stage_key('mndwi_index', {
+            'green': file_digest(green_path),
+            'swir2': file_digest(swir2_path),
+        })
+
+        with analysis_pool(workers) as executor:
+            def build_classes(tmp_dir):
+                index_ready = load_stage('mndwi_index', index_key) is not None
+                stage_index_path = stage_path('mndwi_index', index_key, 'index.tif') if index_ready else os.path.join(tmp_dir, 'mndwi_index.tif')
+                # Нормализация MNDWI по сохраненной статистике каналов (без лишних проходов по снимкам)
+                green_stats = swir2_stats = None
+                if not index_ready:
+                    green_stats = get_band_statistics(analysis.green_band_image)
+                    swir2_stats = get_band_statistics(analysis.swir2_band_image)
                 try:
-                    # Используем Web Mercator (EPSG:3857) как универсальную проекцию для площади
-                    projected_gdf = gdf.to_crs(epsg=3857) 
-                    logger.info("GeoDataFrame сконвертирован в EPSG:3857 для расчета площади.")
+                    tiles_result = run_analysis_tiles(
+                        green_path, swir2_path, pw_source_path, stage_index_path,
+                        os.path.join(tmp_dir, 'mndwi_mask.tif'), os.path.join(tmp_dir, 'classes.tif'),
+                        max_pixels=window_pixels, executor=executor, workers=workers,
+                        green_stats=green_stats, swir2_stats=swir2_stats,
+                        bit_packed=bit_packed,
+                        min_region_pixels=analysis.min_region_pixels,
+                        index_ready=index_ready,
+                        mndwi_threshold=analysis.mndwi_threshold,
+                        # Маска постоянных вод читается процессами пула из разделяемой памяти узла
+                        shared_index_dir=getattr(settings, 'FLOOD_SHARED_RASTER_INDEX_DIR', None),
+                        shared_max_bytes=getattr(settings, 'FLOOD_SHARED_RASTER_CACHE_BYTES', 0)
+                    )
                 except Exception as e:
-                    logger.warning(f"Не удалось сконвертировать в EPSG:3857 для расчета площади: {e}. Расчет площади может быть неточным.")
-                    # Если конвертация не удалась, считаем площадь в исходных координатах (будет неточно для WGS84)
-                    pass
-
-            # Рассчитываем сумму площадей всех полигонов и конвертируем в км²
-            area = float(projected_gdf.area.sum() / 1e6)
-            logger.info(f"Рассчитана площадь: {area:.2f} км²")
-            return area
+                    logger.error(f"Ошибка при тайловой обработке сцены (MNDWI/сравнение масок): {e}")
+                    raise # Перебрасываем ошибку дальше
+                if not index_ready:
+                    publish_stage('mndwi_index', index_key, {'index.tif': stage_index_path})
+                    if stage_cache_bytes:
+                        evict_stage('mndwi_index', stage_cache_bytes, keep=index_key)
+                return {
+                    'water_pixels': tiles_result['water_pixels'],
+                    'class_counts': tiles_result['class_counts'],
+                    'class_areas_sqkm': tiles_result['class_areas_sqkm'],
+                    'mndwi_histogram': tiles_result['mndwi_histogram'],
+                }
+
+            # MNDWI, приведение маски постоянных вод, сравнение и площади выполняются за один тайловый проход
+            classes_inputs = {
+                'mndwi_index': index_key,
+                'mndwi_threshold': mndwi_threshold_code(analysis.mndwi_threshold),
+                'min_region_pixels': analysis.min_region_pixels,
+                'permanent_water': pw_key,
+                'bit_packed': bit_packed,
+            }
+            # Индекс MNDWI выкладывается из кэша вместе с классами: если он вытеснен, классы рассчитываются заново
+            if load_stage('mndwi_index', index_key) is None:
+                discard_stage('classes', stage_key('classes', classes_inputs))
+            with profiler.stage('classes'):
+                classes_key, tiles_result = cached_stage('classes', classes_inputs, build_classes,
+                                                         max_bytes=stage_cache_bytes)
+            link_artifact('mndwi_index', index_key, 'index.tif', mndwi_index_path)
+            link_artifact('classes', classes_key, 'mndwi_mask.tif', mndwi_mask_path)
+            link_artifact('classes', classes_key, 'classes.tif', classes_path)
+            class_counts = tiles_result['class_counts']
+            logger.info(f"Маска MNDWI: {mndwi_mask_path}, пикселей воды: {tiles_result['water_pixels']}")
+            logger.info(f"Растр классов: {classes_path}, пикселей в классах: {class_counts}")
+
+            # Площади считаются по растру классов: число пикселей в строке на площадь пикселя строки
+            areas = tiles_result['class_areas_sqkm']
+            area_only_pw = areas['only_pw']
+            area_only_mndwi = areas['only_mndwi']
+            area_both = areas['both']
+            logger.info(f"Площади: only_pw={area_only_pw}, only_mndwi={area_only_mndwi}, both={area_both}")
+
+            # Векторизуем растр классов по тайлам (полигоны на швах тайлов склеиваются)
+            # и пишем GeoJSON потоково, по мере готовности тайлов.
+            def build_polygons(tmp_dir):
+                feature_counts = {name: 0 for name in ANALYSIS_CLASSES}
+                both_parts = []
+                logger.info("Векторизация классов only_pw, only_mndwi, both...")
+                with ExitStack() as stack:
+                    writers = {
+                        name: stack.enter_context(geojson_writer(os.path.join(tmp_dir, f"{name}.geojson")))
+                        for name in ANALYSIS_CLASSES
+                    }
+                    for name, series in iter_class_polygons(classes_path, max_pixels=window_pixels, executor=executor, workers=workers):
+                        writers[name](series.to_numpy())
+                        feature_counts[name] += len(series)
+                        if name == 'both':
+                            both_parts.append(series)
+                logger.info(f"Сохранены GeoJSON: only_pw ({feature_counts['only_pw']} features), only_mndwi ({feature_counts['only_mndwi']} features), both ({feature_counts['both']} features)")
+
+                # Объединение совпадающей воды для flood_vector сохраняется в WKB вместе с GeoJSON
+                if both_parts:
+                    gdf_both = gpd.GeoSeries(np.concatenate([part.to_numpy() for part in both_parts]), crs=both_parts[0].crs)
+                    if gdf_both.crs and gdf_both.crs.to_string() != 'EPSG:4326':
+                        gdf_both = gdf_both.to_crs(epsg=4326)
+                    with open(os.path.join(tmp_dir, 'flood_vector.wkb'), 'wb') as f:
+                        f.write(coverage_union_wkb(gdf_both.values))
+                return {'feature_counts': feature_counts}
+
+            with profiler.stage('vectorization'):
+                polygons_key, _ = cached_stage('polygons', {'classes': classes_key}, build_polygons,
+                                               max_bytes=stage_cache_bytes)
 
-        logger.info("Расчет площадей...")
-        area_only_pw = area_sqkm(gdf_only_pw)
-        area_only_mndwi = area_sqkm(gdf_only_mndwi)
-        area_both = area_sqkm(gdf_both)
-        logger.info(f"Площади: only_pw={area_only_pw}, only_mndwi={area_only_mndwi}, both={area_both}")
+        # Используем суффикс _pw для постоянных вод, чтобы не путать со старым only_dem
+        only_pw_path_geojson = link_artifact('polygons', polygons_key, 'only_pw.geojson', os.path.join(output_dir, f"{base_name}_only_pw.geojson")) # Зона осушения
+        only_mndwi_path_geojson = link_artifact('polygons', polygons_key, 'only_mndwi.geojson', os.path.join(output_dir, f"{base_name}_only_mndwi.geojson")) # Зона затопления
+        both_path_geojson = link_artifact('polygons', polygons_key, 'both.geojson', os.path.join(output_dir, f"{base_name}_both.geojson")) # Совпадающая вода
 
         # --- 4. Сохраняем результаты в FloodAnalysis ---
-        analysis.status = 'completed'
-        analysis.error_message = ''
-        analysis.flooded_area_sqkm = area_only_mndwi + area_both
-        analysis.dem_mask_path = None
-        analysis.mndwi_mask_path = mndwi_mask_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
-        analysis.only_dem_path = only_pw_path_geojson.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
-        analysis.only_mndwi_path = only_mndwi_path_geojson.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
-        analysis.both_path = both_path_geojson.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
-        analysis.area_only_dem = area_only_pw
-        analysis.area_only_mndwi = area_only_mndwi
-        analysis.area_both = area_both
-        # Сохраняем flood_vector (совпадающая вода) в поле модели
-        if not gdf_both.empty:
-            if gdf_both.crs and gdf_both.crs.to_string() != 'EPSG:4326':
-                gdf_both = gdf_both.to_crs(epsg=4326)
-            multipoly = gdf_both.unary_union
-            from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
-            if multipoly.geom_type == 'Polygon':
-                multipoly = MultiPolygon(GEOSGeometry(multipoly.wkt))
+        with profiler.stage('persist'):
+            analysis.status = 'completed'
+            analysis.error_message = ''
+            analysis.flooded_area_sqkm = area_only_mndwi + area_both
+            analysis.dem_mask_path = None
+            analysis.mndwi_mask_path = mndwi_mask_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+            analysis.mndwi_index_path = mndwi_index_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+            # Гистограмма индекса: площади для любого порога MNDWI без повторного анализа (см. threshold_areas)
+            analysis.mndwi_histogram = tiles_result['mndwi_histogram']
+            analysis.class_mask_path = classes_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+            analysis.only_dem_path = only_pw_path_geojson.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+            analysis.only_mndwi_path = only_mndwi_path_geojson.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+            analysis.both_path = both_path_geojson.replace(settings.MEDIA_ROOT, settings.MEDIA_URL)
+            analysis.area_only_dem = area_only_pw
+            analysis.area_only_mndwi = area_only_mndwi
+            analysis.area_both = area_both
+            # Сохраняем flood_vector (совпадающая вода) в поле модели
+            flood_vector_wkb = stage_path('polygons', polygons_key, 'flood_vector.wkb')
+            if os.path.exists(flood_vector_wkb):
+                # Полигоны передаются в GEOS в бинарном виде (WKB), без промежуточного WKT
+                with open(flood_vector_wkb, 'rb') as f:
+                    analysis.flood_vector = GEOSGeometry(memoryview(f.read()), srid=4326)
             else:
-                multipoly = GEOSGeometry(multipoly.wkt)
-            analysis.flood_vector = multipoly
-        else:
-            analysis.flood_vector = None
-        analysis.save()
+                analysis.flood_vector = None
+            analysis.save()
 
         # --- 5. Генерируем PNG-карту с масками и сохраняем bounds ---
         from .utils import render_analysis_masks_png
         png_path = os.path.join(output_dir, f"{base_name}_map.png")
         bounds_json_path = os.path.join(output_dir, f"{base_name}_map_bounds.json")
-        render_analysis_masks_png(
-            only_pw_geojson=only_pw_path_geojson,
-            only_mndwi_geojson=only_mndwi_path_geojson,
-            both_geojson=both_path_geojson,
-            output_png_path=png_path,
-            bounds_json_path=bounds_json_path
-        )
+        with profiler.stage('render'):
+            render_analysis_masks_png(
+                only_pw_geojson=only_pw_path_geojson,
+                only_mndwi_geojson=only_mndwi_path_geojson,
+                both_geojson=both_path_geojson,
+                output_png_path=png_path,
+                bounds_json_path=bounds_json_path
+            )
         logger.info(f"PNG-карта с масками сохранена: {png_path}, bounds: {bounds_json_path}")
+        analysis.profile = profiler.as_dict()
+        analysis.save(update_fields=['profile'])
     except Exception as e:
         error_message = f"Ошибка при обработке анализа затопления:\n{traceback.format_exc()}"
         logger.error(error_message)
         if analysis:
             analysis.status = 'error'
             analysis.error_message = error_message
-            analysis.save()
\ No newline at end of file
+            # Профиль выполненных этапов сохраняется и при ошибке
+            analysis.profile = profiler.as_dict()
+            analysis.save()
+    finally:
+        profiler.close()
\ No newline at end of file
@@ -0,0 +1,23 @@
+"""
+Проверки поблочных и тайловых алгоритмов на синтетических растрах: результат должен
+совпадать с расчетом по целым массивам. Django и GDAL Python bindings (osgeo) не нужны,
+запуск: python -m pytest flooddata/tests
+"""
+import rasterio
+
+
+def write_raster(path, array, transform, crs='EPSG:32637', nodata=None):
+    """Сохраняет двумерный массив в одноканальный GeoTIFF."""
+    profile = {
+        'driver': 'GTiff',
+        'height': array.shape[0],
+        'width': array.shape[1],
+        'count': 1,
+        'dtype': array.dtype.name,
+        'transform': transform,
+        'crs': crs,
+        'nodata': nodata,
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(array, 1)
+    return path
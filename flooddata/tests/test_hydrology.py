@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from scipy import ndimage
+from flooddata.hydrology import ACC_NODATA, cell_size, fill_and_accumulate, tiled_fill_and_accumulate
+from flooddata.tests import write_raster
+
+
+def synthetic_dem(rng, dtype, nodata):
+    """DEM с понижениями, плоскими участками (ступени по 5 м) и областью nodata."""
+    dem = np.round(ndimage.gaussian_filter(rng.random((300, 300)), 6) * 2000 / 5) * 5
+    dem[100:140, 50:90] = dem[100:140, 50:90].min()  # Большой плоский участок на швах тайлов
+    dem = dem.astype(dtype)
+    dem[200:230, 200:260] = nodata
+    return dem
+
+
+def native_correction(dem_path, already_filled):
+    """Заполнение и аккумуляция всего DEM в памяти (как native_dem_correction)."""
+    with rasterio.open(dem_path) as src:
+        dem = src.read(1, masked=True)
+        dx, dy = cell_size(src.transform, src.crs, src.height)
+    valid = ~np.ma.getmaskarray(dem) & np.isfinite(dem.data)
+    filled, acc = fill_and_accumulate(dem.data, valid, dx, dy)
+    if already_filled:
+        filled = dem.data
+    else:
+        if dem.dtype.kind in 'iu':
+            filled = np.floor(filled)
+        filled = filled.astype(dem.dtype)
+        filled[~valid] = dem.data[~valid]
+    acc = acc.astype(np.float32)
+    acc[~valid] = ACC_NODATA
+    return filled, acc
+
+
+class TiledHydrologyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.rng = np.random.default_rng(3)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def check_engines(self, dem, nodata, crs, transform):
+        dem_path = write_raster(self.path('dem.tif'), dem, transform, crs=crs, nodata=nodata)
+        for already_filled in (False, True):
+            expected_filled, expected_acc = native_correction(dem_path, already_filled)
+            # Тайлы меньше DEM, в том числе не кратные его размеру
+            for tile_size in (64, 97):
+                tiled_fill_and_accumulate(dem_path, self.path('filled.tif'), self.path('acc.tif'),
+                                          tile_size=tile_size, already_filled=already_filled,
+                                          scratch_dir=self.tmp.name)
+                message = f'{dem.dtype}, already_filled={already_filled}, tile_size={tile_size}'
+                with rasterio.open(self.path('filled.tif')) as src:
+                    np.testing.assert_array_equal(src.read(1), expected_filled, err_msg=message)
+                with rasterio.open(self.path('acc.tif')) as src:
+                    self.assertEqual(src.nodata, ACC_NODATA)
+                    np.testing.assert_array_equal(src.read(1), expected_acc, err_msg=message)
+
+    def test_float_dem_projected(self):
+        dem = synthetic_dem(self.rng, 'float32', -9999.0)
+        self.check_engines(dem, -9999.0, 'EPSG:32637', from_origin(500000, 6000000, 30, 30))
+
+    def test_integer_dem_geographic(self):
+        dem = synthetic_dem(self.rng, 'int16', -32768)
+        self.check_engines(dem, -32768, 'EPSG:4326', from_origin(37, 56, 0.0003, 0.0003))
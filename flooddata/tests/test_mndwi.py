@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from flooddata.raster_processing import compute_mndwi_mask, read_window_resampled
+from flooddata.tests import write_raster
+
+
+def full_mndwi_mask(green_path, swir2_path):
+    """Маска MNDWI > 0 по целым массивам: SWIR2 читается в сетке Green через out_shape."""
+    with rasterio.open(green_path) as green_src, rasterio.open(swir2_path) as swir2_src:
+        green = green_src.read(1).astype(np.float32)
+        swir2 = swir2_src.read(1, out_shape=green.shape).astype(np.float32)
+    green = green / np.float32(green.max())
+    swir2 = swir2 / np.float32(swir2.max())
+    return ((green - swir2) / (green + swir2 + np.float32(1e-6)) > 0).astype(np.uint8)
+
+
+class WindowedMndwiTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.rng = np.random.default_rng(1)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_nearest_matches_out_shape_read(self):
+        # Нецелые отношения размеров, увеличение и уменьшение
+        for src_shape, target_shape in (((202, 202), (403, 403)), ((403, 401), (202, 203)), ((97, 131), (250, 77))):
+            data = self.rng.random(src_shape).astype(np.float32)
+            path = write_raster(self.path('band.tif'), data, from_origin(0, 1000, 1, 1))
+            with rasterio.open(path) as src:
+                expected = src.read(1, out_shape=target_shape)
+                for row in range(0, target_shape[0], 37):
+                    for col in range(0, target_shape[1], 41):
+                        window = Window(col, row, min(41, target_shape[1] - col), min(37, target_shape[0] - row))
+                        np.testing.assert_array_equal(
+                            read_window_resampled(src, window, target_shape),
+                            expected[row:row + window.height, col:col + window.width])
+
+    def test_windowed_mask_matches_full_arrays(self):
+        for green_size, swir2_size in ((400, 200), (403, 202)):
+            green = self.rng.integers(1, 10000, (green_size, green_size)).astype(np.uint16)
+            swir2 = self.rng.integers(1, 10000, (swir2_size, swir2_size)).astype(np.uint16)
+            green_path = write_raster(self.path('green.tif'), green, from_origin(500000, 6000000, 10, 10))
+            swir2_path = write_raster(self.path('swir2.tif'), swir2,
+                                      from_origin(500000, 6000000, 10 * green_size / swir2_size,
+                                                  10 * green_size / swir2_size))
+            mask_path = self.path('mask.tif')
+            # Окна по 7 строк: границы окон не совпадают с границами пикселей SWIR2
+            result = compute_mndwi_mask(green_path, swir2_path, mask_path, max_pixels=7 * green_size)
+            expected = full_mndwi_mask(green_path, swir2_path)
+            with rasterio.open(mask_path) as src:
+                np.testing.assert_array_equal(src.read(1), expected)
+            self.assertEqual(result['water_pixels'], int(expected.sum()))
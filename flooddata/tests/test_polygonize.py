@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import shapely
+from rasterio.features import shapes
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from scipy import ndimage
+from flooddata.raster_processing import iter_tiled_polygons, iter_row_windows, read_sieved_window, sieve_mask
+from flooddata.tests import write_raster
+
+
+def class_raster(rng, shape):
+    """Растр классов 0..3 с областями разного размера, пересекающими швы тайлов."""
+    noise = ndimage.gaussian_filter(rng.random(shape), 2)
+    classes = np.digitize(noise, np.quantile(noise, [0.55, 0.7, 0.85])).astype(np.uint8)
+    classes[rng.random(shape) < 0.02] = 2  # Одиночные пиксели (шум)
+    return classes
+
+
+def assert_same_polygons(test, expected, polygons, values):
+    """Полигоны и их значения совпадают без учета порядка и начальных вершин колец."""
+    test.assertEqual(len(polygons), len(expected))
+    unmatched = list(expected)
+    for polygon, value in zip(polygons, values):
+        for i, (other, other_value) in enumerate(unmatched):
+            if other_value == value and shapely.equals(polygon, other):
+                del unmatched[i]
+                break
+        else:
+            test.fail(f'Полигон со значением {value} не найден в результате shapes(): {polygon.wkt}')
+
+
+class TiledPolygonizeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.rng = np.random.default_rng(7)
+        self.transform = from_origin(500000, 6000000, 10, 10)
+
+    def polygonize(self, classes, min_region_pixels=0):
+        path = write_raster(os.path.join(self.tmp.name, 'classes.tif'), classes, self.transform)
+        polygons, values = [], []
+        # Тайлы по 9 строк: большинство областей пересекает швы
+        for batch, vals in iter_tiled_polygons(path, max_pixels=9 * classes.shape[1],
+                                               min_region_pixels=min_region_pixels):
+            polygons.extend(batch)
+            values.extend(vals)
+        return polygons, values
+
+    def test_tiles_match_single_pass(self):
+        classes = class_raster(self.rng, (120, 90))
+        expected = [(shapely.geometry.shape(geom), value)
+                    for geom, value in shapes(classes, mask=classes > 0, transform=self.transform)]
+        polygons, values = self.polygonize(classes)
+        assert_same_polygons(self, expected, polygons, values)
+
+    def test_sieved_tiles_match_single_pass(self):
+        classes = class_raster(self.rng, (120, 90))
+        sieved = sieve_mask(classes > 0, 5)
+        expected = [(shapely.geometry.shape(geom), value)
+                    for geom, value in shapes(classes, mask=sieved, transform=self.transform)]
+        polygons, values = self.polygonize(classes, min_region_pixels=5)
+        assert_same_polygons(self, expected, polygons, values)
+
+
+class WindowedSieveTest(unittest.TestCase):
+    def test_windows_match_full_sieve(self):
+        rng = np.random.default_rng(11)
+        mask = ndimage.gaussian_filter(rng.random((200, 60)), 1.5) > 0.52
+        # Вертикальная полоса длиннее перекрытия окон: ее нельзя удалить ни в одном окне
+        mask[:, 30] = True
+        for min_pixels in (1, 4, 12, 40):
+            expected = sieve_mask(mask.copy(), min_pixels)
+            for rows in (1, 5, 16):
+                result = np.vstack([
+                    read_sieved_window(lambda w: mask[w.toslices()].copy(), window, min_pixels, mask.shape[0])
+                    for window in iter_row_windows(mask.shape[0], mask.shape[1], rows * mask.shape[1])
+                ])
+                np.testing.assert_array_equal(result, expected, err_msg=f'min_pixels={min_pixels}, rows={rows}')
+
+    def test_disabled_sieve_reads_window_unchanged(self):
+        mask = np.eye(10, dtype=bool)
+        window = Window(0, 2, 10, 3)
+        np.testing.assert_array_equal(read_sieved_window(lambda w: mask[w.toslices()], window, 0, 10), mask[2:5])
+
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from pyproj import Transformer
+from rasterio.warp import reproject
+from flooddata.hydrology import ACC_NODATA
+from flooddata.raster_processing import threshold_mask_to_grid
+from flooddata.shared_rasters import SharedRaster
+from flooddata.tests import write_raster
+
+SOURCE_TRANSFORM = from_origin(500000, 6000000, 30, 30)
+SOURCE_CRS = 'EPSG:32637'
+# Погрешность приближенного преобразования координат GDAL (пикселей исходного растра)
+WARP_TOLERANCE = 0.125
+
+
+def reprojected_mask(source, threshold, transform, crs, shape):
+    """Маска source >= threshold после репроекции всего растра (nearest) в целевую сетку."""
+    destination = np.full(shape, np.nan, dtype=np.float32)
+    reproject(source=source, destination=destination, src_transform=SOURCE_TRANSFORM, src_crs=SOURCE_CRS,
+              src_nodata=ACC_NODATA, dst_transform=transform, dst_crs=crs, dst_nodata=np.nan,
+              resampling=Resampling.nearest)
+    return ((destination >= threshold) & ~np.isnan(destination)).astype(np.uint8)
+
+
+def exact_nearest(source, transform, crs, shape):
+    """
+    Точный nearest: исходный пиксель под центром каждой ячейки целевой сетки.
+    Returns:
+        (значения, NaN вне растра и в nodata; расстояние центра до ближайшей границы исходного пикселя)
+    """
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]]
+    x, y = transform * (cols + 0.5, rows + 0.5)
+    x, y = Transformer.from_crs(crs, SOURCE_CRS, always_xy=True).transform(x, y)
+    col, row = ~SOURCE_TRANSFORM * (x, y)
+    col_index, row_index = np.floor(col).astype(int), np.floor(row).astype(int)
+    inside = (col_index >= 0) & (col_index < source.shape[1]) & (row_index >= 0) & (row_index < source.shape[0])
+    values = np.full(shape, np.nan, dtype=np.float32)
+    values[inside] = source[row_index[inside], col_index[inside]]
+    values[values == ACC_NODATA] = np.nan
+    edge = np.minimum.reduce([col - np.floor(col), np.ceil(col) - col, row - np.floor(row), np.ceil(row) - row])
+    return values, edge
+
+
+class WarpedGridTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        rng = np.random.default_rng(5)
+        self.source = rng.gamma(0.5, 200, (200, 240)).astype(np.float32)
+        self.source[150:180, 20:90] = ACC_NODATA
+        self.source_path = write_raster(os.path.join(self.tmp.name, 'acc.tif'), self.source, SOURCE_TRANSFORM,
+                                        crs=SOURCE_CRS, nodata=ACC_NODATA)
+
+    def grid_masks(self, transform, crs, shape, threshold):
+        """Маски threshold_mask_to_grid при чтении через WarpedVRT и из разделяемой памяти."""
+        shared = SharedRaster(self.source, SOURCE_TRANSFORM, SOURCE_CRS, ACC_NODATA)
+        for name, source in (('vrt', None), ('shared', shared)):
+            output_path = os.path.join(self.tmp.name, f'{name}.tif')
+            # Окна по 11 строк: приведение выполняется по частям
+            threshold_mask_to_grid(self.source_path, output_path, threshold, transform, crs, shape,
+                                   max_pixels=11 * shape[1], shared=source)
+            with rasterio.open(output_path) as src:
+                yield name, src.read(1)
+
+    def test_same_crs_matches_full_reprojection(self):
+        # Сетка снимка 10 м со сдвигом, частично за пределами растра
+        transform, shape = from_origin(501005, 5998995, 10, 10), (450, 700)
+        expected = reprojected_mask(self.source, 100, transform, SOURCE_CRS, shape)
+        self.assertTrue(expected.any())
+        for name, mask in self.grid_masks(transform, SOURCE_CRS, shape, 100):
+            np.testing.assert_array_equal(mask, expected, err_msg=name)
+
+    def test_geographic_grid_within_warp_tolerance(self):
+        # Сетка в EPSG:4326, выходящая за западную границу растра
+        transform, shape = from_origin(38.98, 54.14, 0.0002, 0.0002), (260, 700)
+        values, edge = exact_nearest(self.source, transform, 'EPSG:4326', shape)
+        expected = (values >= 100).astype(np.uint8)
+        self.assertTrue(expected.any())
+        for name, mask in self.grid_masks(transform, 'EPSG:4326', shape, 100):
+            differ = mask != expected
+            # Отличия только там, где центр ячейки ближе погрешности преобразования к границе пикселя
+            self.assertLess(differ.mean(), 0.05, msg=name)
+            self.assertTrue((edge[differ] <= WARP_TOLERANCE).all(), msg=name)
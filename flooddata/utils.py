@@ -8,8 +8,15 @@ from datetime import datetime
 import rasterio
 from rasterio.features import shapes
 import geopandas as gpd
+import shapely
 from shapely.geometry import shape, mapping
 import json
+import shutil
+from contextlib import ExitStack
+from .raster_processing import (normalized_difference_mask, analysis_pool, iter_tiled_polygons, iter_row_windows,
+                                RasterHandle, array_summary, raster_summary, geojson_writer, to_wgs84)
+from .hydrology import ACC_NODATA, JIT_AVAILABLE, cell_size, fill_and_accumulate, tiled_fill_and_accumulate
+from .workspace import atomic_output, scratch_workspace
 
 logger = logging.getLogger(__name__)
 
@@ -199,49 +206,215 @@ def export_flood_data(start_date, end_date, format='geojson'):
         logger.error(f"Ошибка при экспорте данных: {str(e)}")
         raise
 
-def hydrological_dem_correction(dem_path, output_dem_path=None, output_acc_path=None, already_filled=False):
+def hydrological_dem_correction(dem_path, output_dem_path=None, output_acc_path=None, already_filled=False, engine=None,
+                                lazy=False):
     """
-    Гидрологическая коррекция ЦМП (DEM) с помощью WhiteboxTools.
-    Если already_filled=True, пропускает fill_depressions и сразу считает аккумуляцию.
+    Гидрологическая коррекция ЦМП (DEM): заполнение понижений и аккумуляция стока D8.
+    Движок 'native' считает в процессе по массиву в памяти (flooddata.hydrology), 'whitebox' - через WhiteboxTools.
+    DEM больше HYDRO_IN_MEMORY_MAX_PIXELS (или при engine='tiled') обрабатывается по тайлам HYDRO_TILE_SIZE
+    с записью результатов в тайловые GeoTIFF: пиковая память определяется размером тайла.
+    Промежуточные файлы пишутся в собственный рабочий каталог задачи (в FLOOD_SCRATCH_DIR), который удаляется
+    по завершении; результаты заменяют output_dem_path и output_acc_path атомарно. Поэтому задачи над DEM
+    из одного каталога (и даже над одним DEM) можно выполнять параллельно.
+    Если already_filled=True, DEM уже заполнен: он не изменяется, считается только аккумуляция.
     Args:
         dem_path: путь к исходному DEM (GeoTIFF)
         output_dem_path: путь для сохранения скорректированного DEM (опционально)
         output_acc_path: путь для сохранения карты аккумуляции (опционально)
         already_filled: если True, DEM уже заполнен (filled), не выполнять fill_depressions
+        engine: 'native', 'tiled' или 'whitebox' (по умолчанию настройка HYDRO_ENGINE)
+        lazy: не загружать результаты в память: вернуть ленивые ссылки на сохраненные растры (RasterHandle,
+            None для растров без пути сохранения) и поблочную сводную статистику (stats: min, max, mean, count)
     Returns:
         dict с numpy-массивами скорректированного DEM и аккумуляции
+        (при lazy=True - с RasterHandle и статистикой stats['corrected_dem'], stats['accumulation'])
+    """
+    engine = engine or getattr(settings, 'HYDRO_ENGINE', 'native')
+    if engine not in ('native', 'tiled', 'whitebox'):
+        raise ValueError(f"Неизвестный движок гидрологической коррекции: {engine}")
+    try:
+        with rasterio.open(dem_path) as src:
+            pixels = src.width * src.height
+        if engine == 'native' and pixels > getattr(settings, 'HYDRO_IN_MEMORY_MAX_PIXELS', 100_000_000):
+            engine = 'tiled'
+        with scratch_workspace(getattr(settings, 'FLOOD_SCRATCH_DIR', None), 'hydro') as workdir, ExitStack() as outputs:
+            # Результаты пишутся во временные файлы рядом с файлами назначения и заменяют их по завершении
+            filled_path = outputs.enter_context(atomic_output(output_dem_path)) if output_dem_path else None
+            acc_path = outputs.enter_context(atomic_output(output_acc_path)) if output_acc_path else None
+            if engine == 'native':
+                result = native_dem_correction(dem_path, filled_path, acc_path, already_filled)
+                stats = result.pop('stats')
+            else:
+                filled_path = filled_path or os.path.join(workdir, 'filled_dem.tif')
+                acc_path = acc_path or os.path.join(workdir, 'accumulation.tif')
+                if engine == 'tiled':
+                    logger.info(f"Гидрологическая коррекция DEM {dem_path} по тайлам ({pixels} пикселей)")
+                    tiled_fill_and_accumulate(dem_path, filled_path, acc_path,
+                                              tile_size=getattr(settings, 'HYDRO_TILE_SIZE', 4096),
+                                              already_filled=already_filled, scratch_dir=workdir)
+                else:
+                    whitebox_dem_correction(dem_path, filled_path, acc_path, already_filled, workdir=workdir)
+                window_pixels = getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None)
+                if lazy:
+                    # Статистика считается поблочно до удаления рабочего каталога (растры могут быть в нем)
+                    stats = {
+                        'corrected_dem': raster_summary(filled_path, max_pixels=window_pixels),
+                        'accumulation': raster_summary(acc_path, max_pixels=window_pixels),
+                    }
+                else:
+                    with rasterio.open(filled_path) as src:
+                        filled = src.read(1)
+                    with rasterio.open(acc_path) as src:
+                        acc = src.read(1)
+                    result = {
+                        'corrected_dem': filled,
+                        'accumulation': acc
+                    }
+        if lazy:
+            return {
+                'corrected_dem': RasterHandle(output_dem_path, stats=stats['corrected_dem']) if output_dem_path else None,
+                'accumulation': RasterHandle(output_acc_path, stats=stats['accumulation']) if output_acc_path else None,
+                'stats': stats,
+            }
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка гидрологической коррекции DEM: {str(e)}")
+        raise
+
+def native_dem_correction(dem_path, output_dem_path=None, output_acc_path=None, already_filled=False):
+    """
+    Гидрологическая коррекция DEM в процессе по массиву в памяти (flooddata.hydrology), без промежуточных файлов.
+    Args:
+        dem_path: путь к исходному DEM (GeoTIFF)
+        output_dem_path: путь для сохранения скорректированного DEM (опционально)
+        output_acc_path: путь для сохранения карты аккумуляции (опционально)
+        already_filled: если True, DEM уже заполнен (filled) и сохраняется без изменений
+    Returns:
+        dict с numpy-массивами скорректированного DEM и аккумуляции и их сводной статистикой (stats)
+    """
+    with rasterio.open(dem_path) as src:
+        profile = src.profile.copy()
+        dem = src.read(1, masked=True)
+        dx, dy = cell_size(src.transform, src.crs, src.height)
+    valid = ~np.ma.getmaskarray(dem) & np.isfinite(dem.data)
+    filled, acc = fill_and_accumulate(dem.data, valid, dx, dy)
+    if already_filled:
+        # DEM уже заполнен: сохраняется как есть, заполнение нужно только для порядка обхода аккумуляции
+        filled = dem.data
+    else:
+        if dem.dtype.kind in 'iu':
+            filled = np.floor(filled)  # Приращения epsilon отбрасываются (как при обработке по тайлам)
+        filled = filled.astype(dem.dtype)
+        filled[~valid] = dem.data[~valid]
+    acc = acc.astype(np.float32)
+    acc[~valid] = ACC_NODATA
+    logger.info(f"Гидрологическая коррекция DEM {dem_path} (native, JIT: {JIT_AVAILABLE}): "
+                f"{int(valid.sum())} ячеек, максимальная аккумуляция {float(acc.max())}")
+    profile.update(driver='GTiff', count=1)
+    if output_dem_path:
+        with rasterio.open(output_dem_path, 'w', **profile) as dst:
+            dst.write(filled, 1)
+    if output_acc_path:
+        profile.update(dtype='float32', nodata=ACC_NODATA)
+        with rasterio.open(output_acc_path, 'w', **profile) as dst:
+            dst.write(acc, 1)
+    return {
+        'corrected_dem': filled,
+        'accumulation': acc,
+        'stats': {
+            'corrected_dem': array_summary(filled, valid),
+            'accumulation': array_summary(acc, valid),
+        },
+    }
+
+def whitebox_dem_correction(dem_path, output_dem_path, output_acc_path, already_filled=False, workdir=None):
+    """
+    Гидрологическая коррекция ЦМП (DEM) с помощью WhiteboxTools (внешний процесс, файлы на диске).
+    Если already_filled=True, пропускает fill_depressions и сразу считает аккумуляцию.
+    Args:
+        dem_path: путь к исходному DEM (GeoTIFF)
+        output_dem_path: путь для сохранения скорректированного DEM
+        output_acc_path: путь для сохранения карты аккумуляции
+        already_filled: если True, DEM уже заполнен (filled), не выполнять fill_depressions
+        workdir: рабочий каталог WhiteboxTools (по умолчанию каталог output_dem_path)
+    """
+    from whitebox.whitebox_tools import WhiteboxTools
+    wbt = WhiteboxTools()
+    wbt.set_working_dir(workdir or os.path.dirname(os.path.abspath(output_dem_path)))
+    if already_filled:
+        # DEM уже заполнен, просто копируем файл
+        shutil.copyfile(dem_path, output_dem_path)
+    else:
+        wbt.fill_depressions(dem=dem_path, output=output_dem_path)
+    wbt.d8_flow_accumulation(i=output_dem_path, output=output_acc_path)
+
+def compute_hand(filled_dem_path, acc_path, output_hand_path, stream_threshold=1000):
+    """
+    Растр HAND (Height Above Nearest Drainage) с помощью WhiteboxTools: высота каждой ячейки
+    над ближайшим по направлению стока водотоком. Водотоки - ячейки с аккумуляцией не меньше порога.
+    Промежуточный растр водотоков пишется в собственный рабочий каталог задачи, HAND заменяет
+    output_hand_path атомарно.
+    Args:
+        filled_dem_path: путь к заполненному DEM
+        acc_path: путь к карте flow accumulation (число ячеек)
+        output_hand_path: путь для сохранения HAND (м)
+        stream_threshold: порог аккумуляции для выделения водотоков
+    Returns:
+        output_hand_path
     """
     try:
         from whitebox.whitebox_tools import WhiteboxTools
-        import numpy as np
-        import rasterio
-        import os
         wbt = WhiteboxTools()
-        workdir = os.path.dirname(output_dem_path or dem_path)
-        wbt.set_working_dir(workdir)
-        filled_dem = output_dem_path or os.path.join(workdir, 'filled_dem_tmp.tif')
-        acc_path = output_acc_path or os.path.join(workdir, 'accumulation_tmp.tif')
-        if already_filled:
-            # DEM уже заполнен, просто копируем файл если нужно
-            if output_dem_path and dem_path != output_dem_path:
-                import shutil
-                shutil.copyfile(dem_path, output_dem_path)
-            filled_dem = dem_path if not output_dem_path else output_dem_path
-        else:
-            wbt.fill_depressions(dem=dem_path, output=filled_dem)
-        wbt.d8_flow_accumulation(i=filled_dem, output=acc_path)
-        with rasterio.open(filled_dem) as src:
-            filled = src.read(1)
-        with rasterio.open(acc_path) as src:
-            acc = src.read(1)
-        return {
-            'corrected_dem': filled,
-            'accumulation': acc
-        }
+        with scratch_workspace(getattr(settings, 'FLOOD_SCRATCH_DIR', None), 'hand') as workdir, \
+                atomic_output(output_hand_path) as hand_path:
+            wbt.set_working_dir(workdir)
+            streams_path = os.path.join(workdir, 'streams.tif')
+            wbt.extract_streams(flow_accum=acc_path, output=streams_path, threshold=stream_threshold)
+            wbt.elevation_above_stream(dem=filled_dem_path, streams=streams_path, output=hand_path)
+        return output_hand_path
     except Exception as e:
-        logger.error(f"Ошибка гидрологической коррекции DEM (whitebox): {str(e)}")
+        logger.error(f"Ошибка расчета HAND (whitebox): {str(e)}")
         raise
 
+def build_virtual_mosaic(paths, output_vrt_path, crs=None):
+    """
+    Виртуальная мозаика растров (GDAL VRT): пиксели не копируются, при чтении окна мозаики
+    GDAL читает только пересекающие его исходные растры. Растры в другой CRS подключаются через
+    виртуальное перепроецирование (gdal.Warp в VRT рядом с мозаикой). Перекрытия заполняются
+    последними растрами списка.
+    Args:
+        paths: пути к исходным растрам (одинаковое число каналов)
+        output_vrt_path: путь к файлу мозаики (.vrt)
+        crs: CRS мозаики (WKT, 'EPSG:...'; по умолчанию CRS первого растра)
+    Returns:
+        output_vrt_path
+    """
+    directory = os.path.dirname(os.path.abspath(output_vrt_path))
+    target = osr.SpatialReference()
+    if crs:
+        target.SetFromUserInput(crs)
+    sources = []
+    for i, path in enumerate(paths):
+        ds = gdal.Open(path)
+        if ds is None:
+            raise ValueError(f"Растр мозаики не открывается: {path}")
+        source_srs = osr.SpatialReference(wkt=ds.GetProjection())
+        if not crs and not sources:
+            target = source_srs
+        if source_srs.IsSame(target):
+            sources.append(path)
+        else:
+            warped_path = os.path.join(directory, f"source_{i}.vrt")
+            gdal.Warp(warped_path, ds, format='VRT', dstSRS=target.ExportToWkt(), resampleAlg='near')
+            sources.append(warped_path)
+        ds = None
+    vrt = gdal.BuildVRT(output_vrt_path, sources, resolution='highest')
+    if vrt is None:
+        raise ValueError(f"Не удалось построить мозаику из {len(sources)} растров")
+    vrt = None  # Запись VRT на диск
+    logger.info(f"Виртуальная мозаика {output_vrt_path}: растров {len(sources)}")
+    return output_vrt_path
+
 def compare_dem_with_satellite(dem_path, satellite_mask_path, threshold=2.0, diff_output_path=None):
     """
     Сравнение DEM (скорректированного) с маской затопления по ДЗЗ.
@@ -318,23 +491,19 @@ def process_satellite_image(satellite_image_path, output_mask_path=None, method=
             if method == 'ndwi':
                 if num_bands < 2:
                     raise ValueError("Для NDWI требуются 2 канала (зеленый и ближний ИК)")
-                green = src.read(1).astype(np.float32)
-                nir = src.read(2).astype(np.float32)
-                # Вычисляем NDWI
-                ndwi = (green - nir) / (green + nir + 1e-10)
-                # Бинаризация
-                water_mask = (ndwi > threshold).astype(np.uint8)
+                green = src.read(1, out_dtype=np.float32)
+                nir = src.read(2, out_dtype=np.float32)
+                # Вычисляем NDWI и бинаризуем слитым ядром (без промежуточных массивов)
+                water_mask = normalized_difference_mask(green, nir, threshold=threshold, eps=1e-10)
             
             # Метод MNDWI требует зеленый и средний ИК каналы
             elif method == 'mndwi':
                 if num_bands < 3:
                     raise ValueError("Для MNDWI требуются 3 канала (зеленый и средний ИК)")
-                green = src.read(1).astype(np.float32)
-                swir = src.read(3).astype(np.float32)
-                # Вычисляем MNDWI
-                mndwi = (green - swir) / (green + swir + 1e-10)
-                # Бинаризация
-                water_mask = (mndwi > threshold).astype(np.uint8)
+                green = src.read(1, out_dtype=np.float32)
+                swir = src.read(3, out_dtype=np.float32)
+                # Вычисляем MNDWI и бинаризуем слитым ядром (без промежуточных массивов)
+                water_mask = normalized_difference_mask(green, swir, threshold=threshold, eps=1e-10)
             
             # Простой метод для RGB снимков
             elif method == 'simple':
@@ -348,13 +517,14 @@ def process_satellite_image(satellite_image_path, output_mask_path=None, method=
                         raise ValueError("Для простого метода требуется 1 или 3 канала")
                 else:
                     # Используем RGB и вычисляем яркость
-                    r = src.read(1).astype(np.float32)
-                    g = src.read(2).astype(np.float32)
-                    b = src.read(3).astype(np.float32)
-                    # Средняя яркость
-                    brightness = (r + g + b) / 3.0
+                    brightness = src.read(1, out_dtype=np.float32)
+                    # Средняя яркость, накапливаем на месте в буфере первого канала
+                    np.add(brightness, src.read(2, out_dtype=np.float32), out=brightness)
+                    np.add(brightness, src.read(3, out_dtype=np.float32), out=brightness)
+                    np.divide(brightness, 3.0, out=brightness)
                     # Темные участки обычно вода
-                    water_mask = (brightness < threshold * 255).astype(np.uint8)
+                    water_mask = np.empty(brightness.shape, dtype=np.uint8)
+                    np.less(brightness, threshold * 255, out=water_mask.view(np.bool_))
             else:
                 raise ValueError(f"Неподдерживаемый метод выделения воды: {method}")
             
@@ -392,71 +562,66 @@ def process_satellite_image(satellite_image_path, output_mask_path=None, method=
 def create_flood_mask_vector(mask_path, output_vector_path=None, min_area=100):
     """
     Создает векторный слой из растровой маски затопления.
+    Полигоны каждого тайла пишутся в GeoJSON сразу по готовности тайла, без накопления в памяти.
     Args:
         mask_path: путь к растровой маске затопления (GeoTIFF, 1 - вода, 0 - суша)
         output_vector_path: путь для сохранения векторного слоя (опционально)
         min_area: минимальная площадь полигона в пикселях
     Returns:
-        dict с GeoJSON, площадью, количеством полигонов и путем к файлу
+        dict с площадью, количеством полигонов, путем к файлу и GeoJSON
+        (текст GeoJSON - только если output_vector_path не указан)
     """
     try:
-        with rasterio.open(mask_path) as src:
-            image = src.read(1)
-            mask = (image == 1)
-            # Проверка на пустую маску
-            if not np.any(mask):
-                logger.warning(f"Маска {mask_path} содержит только нули, векторизация невозможна.")
-                return {
-                    'vector_data': None,
-                    'total_area_sqkm': 0.0,
-                    'num_polygons': 0,
-                    'vector_path': None
-                }
-            # Векторизация
-            results = (
-                {'properties': {'value': value}, 'geometry': s}
-                for s, value in shapes(image, mask=mask, transform=src.transform)
-                if value == 1
-            )
-            geoms = list(results)
-            if not geoms:
-                logger.warning(f"Векторизация: не найдено полигонов для {mask_path}")
-                return {
-                    'vector_data': None,
-                    'total_area_sqkm': 0.0,
-                    'num_polygons': 0,
-                    'vector_path': None
-                }
-            gdf = gpd.GeoDataFrame.from_features(geoms, crs=src.crs)
-            # Фильтрация по площади
-            if 'geometry' in gdf.columns:
-                gdf['area_px'] = gdf.geometry.area / abs(src.transform.a * src.transform.e)
-                gdf = gdf[gdf.area_px > min_area]
-            if gdf.empty:
-                logger.warning(f"Векторизация: все полигоны меньше min_area для {mask_path}")
+        with ExitStack() as stack:
+            with rasterio.open(mask_path) as src:
+                crs = src.crs
+                pixel_area = abs(src.transform.a * src.transform.e)
+            if output_vector_path:
+                vector_path = stack.enter_context(atomic_output(output_vector_path))
+            else:
+                workdir = stack.enter_context(scratch_workspace(getattr(settings, 'FLOOD_SCRATCH_DIR', None), 'vector'))
+                vector_path = os.path.join(workdir, 'mask.geojson')
+            # Векторизация по тайлам в пуле процессов; полигоны на швах тайлов склеиваются
+            workers = getattr(settings, 'FLOOD_ANALYSIS_WORKERS', 1)
+            num_polygons = 0
+            total_area_sqkm = 0.0
+            with geojson_writer(vector_path) as write, analysis_pool(workers) as executor:
+                for polygons, values in iter_tiled_polygons(
+                    mask_path, values=(1,), executor=executor, workers=workers,
+                    max_pixels=getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None),
+                    # Области не больше min_area удаляются до векторизации, а не после
+                    min_region_pixels=min_area
+                ):
+                    # Фильтрация по площади; площадь - в CRS маски (до приведения к EPSG:4326)
+                    areas = shapely.area(polygons)
+                    keep = areas / pixel_area > min_area
+                    if not keep.any():
+                        continue
+                    areas = areas[keep]
+                    write(to_wgs84(polygons[keep], crs).values, [
+                        {'value': int(value), 'area_px': float(area / pixel_area), 'area_sqkm': float(area / 1_000_000)}
+                        for value, area in zip(values[keep], areas)
+                    ])
+                    num_polygons += len(areas)
+                    total_area_sqkm += float(areas.sum()) / 1_000_000
+            if not num_polygons:
+                logger.warning(f"Маска {mask_path} не содержит полигонов воды больше min_area, векторизация невозможна.")
                 return {
                     'vector_data': None,
                     'total_area_sqkm': 0.0,
                     'num_polygons': 0,
                     'vector_path': None
                 }
-            # Приведение CRS к EPSG:4326
-            if gdf.crs and gdf.crs.to_epsg() != 4326:
-                try:
-                    gdf = gdf.to_crs(epsg=4326)
-                except Exception as e:
-                    logger.error(f"Ошибка CRS при сохранении векторного слоя: {e}")
-            gdf['area_sqkm'] = gdf.geometry.area / 1_000_000
-            if output_vector_path:
-                gdf.to_file(output_vector_path, driver='GeoJSON')
-            total_area_sqkm = gdf['area_sqkm'].sum()
-            geojson_str = gdf.to_json()
-            return {
-                'vector_data': geojson_str,
-                'total_area_sqkm': float(total_area_sqkm),
-                'num_polygons': len(gdf),
-                'vector_path': output_vector_path
-            }
+            vector_data = None
+            if not output_vector_path:
+                with open(vector_path, encoding='utf-8') as f:
+                    vector_data = f.read()
+        return {
+            'vector_data': vector_data,
+            'total_area_sqkm': total_area_sqkm,
+            'num_polygons': num_polygons,
+            'vector_path': output_vector_path
+        }
     except Exception as e:
         logger.error(f"Ошибка при создании векторного слоя затопления: {str(e)}")
         raise
@@ -524,7 +689,38 @@ def calculate_flood_statistics(flood_vector_path, admin_boundaries_path=None):
         logger.error(f"Ошибка при расчете статистики затопления: {str(e)}")
         raise
 
-def rasterize_waterbody_vector(vector_path, reference_raster_path, output_mask_path):
+def load_waterbody_geometries(waterbody, bounds, crs):
+    """
+    Объекты слоя водоёмов из PostGIS, пересекающие охват снимка.
+    Выборка идет по пространственному индексу (оператор && по bbox), геометрии передаются в WKB;
+    если для CRS снимка есть заранее перепроецированные копии, перепроецирование не выполняется.
+    Args:
+        waterbody: объект WaterbodyVector (объекты загружены в БД)
+        bounds: охват снимка в его CRS
+        crs: CRS снимка
+    Returns:
+        GeoDataFrame в CRS снимка
+    """
+    import geopandas as gpd
+    import shapely
+    from django.contrib.gis.db.models.functions import AsWKB
+    from django.contrib.gis.geos import Polygon
+    from rasterio.warp import transform_bounds
+    from .models import WaterbodyFeature, WaterbodyFeatureProjection
+    bbox = Polygon.from_bbox(transform_bounds(crs, 'EPSG:4326', *bounds))
+    bbox.srid = 4326
+    features = WaterbodyFeature.objects.filter(layer=waterbody, geometry__bboxoverlaps=bbox)
+    epsg = crs.to_epsg()
+    if epsg and epsg in getattr(settings, 'WATERBODY_PROJECTED_SRIDS', []):
+        wkbs = list(WaterbodyFeatureProjection.objects.filter(feature__in=features, srid=epsg).values_list('wkb', flat=True))
+        # Копии есть, только если CRS была в списке на момент загрузки слоя
+        if len(wkbs) == features.count():
+            return gpd.GeoDataFrame(geometry=shapely.from_wkb([bytes(wkb) for wkb in wkbs]), crs=crs)
+    wkbs = list(features.annotate(wkb=AsWKB('geometry')).values_list('wkb', flat=True))
+    gdf = gpd.GeoDataFrame(geometry=shapely.from_wkb([bytes(wkb) for wkb in wkbs]), crs='EPSG:4326')
+    return gdf.to_crs(crs)
+
+def rasterize_waterbody_vector(vector_path, reference_raster_path, output_mask_path, waterbody=None):
     """
     Растеризация векторного слоя водоёмов (shp/geojson) в бинарную маску (1 — вода, 0 — суша)
     Улучшено: CRS приводится к CRS снимка, обрезка по bbox снимка, логирование.
@@ -532,6 +728,7 @@ def rasterize_waterbody_vector(vector_path, reference_raster_path, output_mask_p
         vector_path: путь к shp/geojson
         reference_raster_path: путь к растру-эталону (DEM или снимок)
         output_mask_path: путь для сохранения маски
+        waterbody: объект WaterbodyVector; если его объекты загружены в БД, читаются только объекты в охвате снимка
     Returns:
         output_mask_path
     """
@@ -543,12 +740,16 @@ def rasterize_waterbody_vector(vector_path, reference_raster_path, output_mask_p
         out_shape = (ref.height, ref.width)
         crs = ref.crs
         bounds = ref.bounds
-    gdf = gpd.read_file(vector_path)
-    logger.info(f"Векторный слой: {vector_path}, CRS: {gdf.crs}, Число полигонов: {len(gdf)}")
-    # Приведение CRS
-    if gdf.crs != crs:
-        gdf = gdf.to_crs(crs)
-        logger.info(f"Векторный слой приведён к CRS снимка: {crs}")
+    if waterbody is not None and waterbody.features_imported:
+        gdf = load_waterbody_geometries(waterbody, bounds, crs)
+        logger.info(f"Векторный слой из БД: {waterbody.name}, объектов в охвате снимка: {len(gdf)}")
+    else:
+        gdf = gpd.read_file(vector_path)
+        logger.info(f"Векторный слой: {vector_path}, CRS: {gdf.crs}, Число полигонов: {len(gdf)}")
+        # Приведение CRS
+        if gdf.crs != crs:
+            gdf = gdf.to_crs(crs)
+            logger.info(f"Векторный слой приведён к CRS снимка: {crs}")
     # Обрезка по bbox снимка
     bbox = (bounds.left, bounds.bottom, bounds.right, bounds.top)
     gdf_clip = gdf.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
@@ -576,28 +777,45 @@ def rasterize_waterbody_vector(vector_path, reference_raster_path, output_mask_p
         transform=transform
     ) as dst:
         dst.write(mask, 1)
-    logger.info(f"Маска водоёмов сохранена: {output_mask_path}, уникальные значения: {np.unique(mask)}")
+    logger.info(f"Маска водоёмов сохранена: {output_mask_path}")
+    if getattr(settings, 'FLOOD_ANALYSIS_DEBUG_DIAGNOSTICS', False):
+        logger.info(f"Уникальные значения маски водоёмов: {np.unique(mask)}")
     return output_mask_path
 
-def create_permanent_water_mask_from_accumulation(accumulation_path, output_mask_path, threshold=1000):
+def create_permanent_water_mask_from_accumulation(accumulation_path, output_mask_path, threshold=1000, window=None,
+                                                  max_pixels=None):
     """
     Создаёт маску постоянных вод (реки/озёра) по flow accumulation.
+    Растр читается и записывается полосами, пиковая память определяется max_pixels, а не размером растра.
     Args:
         accumulation_path: путь к растру аккумуляции (GeoTIFF)
         output_mask_path: путь для сохранения маски
         threshold: пороговое значение аккумуляции
+        window: окно растра аккумуляции (опционально, по умолчанию весь растр)
+        max_pixels: максимальное число пикселей в одной полосе (по умолчанию FLOOD_ANALYSIS_WINDOW_PIXELS)
     Returns:
         output_mask_path
     """
-    import rasterio
-    import numpy as np
+    max_pixels = max_pixels or getattr(settings, 'FLOOD_ANALYSIS_WINDOW_PIXELS', None)
     with rasterio.open(accumulation_path) as src:
-        acc = src.read(1)
-        mask = (acc >= threshold).astype(np.uint8)
+        if window is None:
+            window = rasterio.windows.Window(0, 0, src.width, src.height)
+        window = window.round_offsets().round_lengths()
         profile = src.profile.copy()
-        profile.update({'count': 1, 'dtype': 'uint8', 'nodata': 0})  # Явно задаём nodata для uint8
+        profile.update({
+            'height': window.height,
+            'width': window.width,
+            'transform': rasterio.windows.transform(window, src.transform),
+            'count': 1, 'dtype': 'uint8', 'nodata': 0,  # Явно задаём nodata для uint8
+        })
+        if max_pixels and window.height * window.width > max_pixels:
+            # Большая маска - тайловый GeoTIFF со сжатием: полосы пишутся без загрузки растра целиком
+            profile.update({'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'LZW', 'BIGTIFF': 'IF_SAFER'})
         with rasterio.open(output_mask_path, 'w', **profile) as dst:
-            dst.write(mask, 1)
+            for part in iter_row_windows(window.height, window.width, max_pixels):
+                acc = src.read(1, window=rasterio.windows.Window(window.col_off, window.row_off + part.row_off,
+                                                                 part.width, part.height))
+                dst.write((acc >= threshold).astype(np.uint8), 1, window=part)
     return output_mask_path
 
 def render_analysis_masks_png(only_pw_geojson, only_mndwi_geojson, both_geojson, output_png_path, bounds_json_path=None, crs='EPSG:4326', width=800, height=800):
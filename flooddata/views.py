@@ -11,7 +11,7 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponseRedirect
+from django.http import FileResponse, JsonResponse, HttpResponseRedirect
 from .models import (FloodZone, FloodEvent, MeasurementPoint, WaterLevelMeasurement,
                     DEMFile, SatelliteImage, FloodAnalysis)
 from django.core.serializers import serialize
@@ -20,7 +20,8 @@ import json
 from django.urls import reverse
 from .forms import (UserRegistrationForm, DEMFileUploadForm, 
                   SatelliteImageUploadForm, FloodAnalysisForm)
-from .tasks import process_flood_analysis_bg
+from .tasks import process_flood_analysis_bg, compute_band_statistics_bg, process_dem_hydrology_bg, get_hand_extent, build_hand_extent_bg, enqueue_once
+from .raster_processing import threshold_areas, threshold_area_curve, stage_area, stage_level
 
 from .serializers import (FloodZoneSerializer, FloodEventSerializer,
                          MeasurementPointSerializer, WaterLevelMeasurementSerializer)
@@ -84,13 +85,14 @@ class HydrologicalCorrectionAPIView(APIView):
         acc_path = os.path.join(output_dir, f"{base_name}_accumulation.tif")
 
         try:
-            result = hydrological_dem_correction(dem_path, corrected_path, acc_path)
+            # Растры в память не загружаются: ответу нужна только поблочная статистика
+            stats = hydrological_dem_correction(dem_path, corrected_path, acc_path, lazy=True)['stats']
             return Response({
                 "corrected_dem": corrected_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL),
                 "accumulation": acc_path.replace(settings.MEDIA_ROOT, settings.MEDIA_URL),
-                "min_elevation": float(result['corrected_dem'].min()),
-                "max_elevation": float(result['corrected_dem'].max()),
-                "max_accumulation": float(result['accumulation'].max())
+                "min_elevation": stats['corrected_dem']['min'],
+                "max_elevation": stats['corrected_dem']['max'],
+                "max_accumulation": stats['accumulation']['max']
             })
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -172,6 +174,8 @@ def upload_dem_file(request):
             dem_file = form.save(commit=False)
             dem_file.uploaded_by = request.user
             dem_file.save()
+            # Заполнение DEM и flow accumulation считаются в фоне один раз для всего файла
+            process_dem_hydrology_bg(dem_file.id)
             
             messages.success(request, f"DEM файл '{dem_file.name}' успешно загружен")
             return redirect('upload')
@@ -190,6 +194,8 @@ def upload_satellite_image(request):
             satellite_image = form.save(commit=False)
             satellite_image.uploaded_by = request.user
             satellite_image.save()
+            # Статистика канала считается один раз в фоне и используется при нормализации MNDWI
+            compute_band_statistics_bg(satellite_image.id)
             
             messages.success(request, f"Космический снимок '{satellite_image.name}' успешно загружен")
             return redirect('upload')
@@ -211,6 +217,8 @@ def analyze_view(request):
             analysis.permanent_water_method = form.cleaned_data.get('permanent_water_method') or 'none'
             analysis.waterbody_vector = form.cleaned_data.get('waterbody_vector')
             analysis.accumulation_threshold = form.cleaned_data.get('accumulation_threshold') or 1000
+            analysis.min_region_pixels = form.cleaned_data.get('min_region_pixels') or 0
+            analysis.mndwi_threshold = form.cleaned_data.get('mndwi_threshold') or 0.0
             analysis.save()
             process_flood_analysis_bg(analysis.id)
             messages.success(request, f"Анализ затопления '{analysis.name}' поставлен в очередь")
@@ -300,6 +308,95 @@ def check_analysis_status(request, analysis_id):
         'has_error': analysis.status == 'error'
     })
 
+@login_required
+def flood_analysis_threshold_area(request, analysis_id):
+    """
+    API: площади затопления для порога MNDWI (?threshold=0.1) или, без параметра,
+    кривая порог-площадь. Считается по сохраненной гистограмме индекса, без чтения растров.
+    Гистограмма строится до удаления мелких областей: при min_region_pixels > 0 ответ
+    содержит sieved: true и пояснение note.
+    """
+    analysis = get_object_or_404(FloodAnalysis, pk=analysis_id)
+    if analysis.created_by != request.user and not request.user.is_staff:
+        return JsonResponse({'error': 'Нет доступа'}, status=403)
+    if not analysis.mndwi_histogram:
+        return JsonResponse({'error': 'Гистограмма индекса MNDWI не рассчитана'}, status=404)
+    threshold = request.GET.get('threshold')
+    if threshold is None:
+        return JsonResponse(threshold_area_curve(analysis.mndwi_histogram, analysis.min_region_pixels))
+    try:
+        threshold = float(threshold)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный порог'}, status=400)
+    return JsonResponse(threshold_areas(analysis.mndwi_histogram, threshold, analysis.min_region_pixels))
+
+@login_required
+def revectorize_analysis(request, analysis_id):
+    """
+    API: повторный анализ с другим порогом MNDWI (POST threshold).
+    Индекс MNDWI и маска постоянных вод берутся из кэша этапов, пересчитываются только маска, классы и полигоны.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Метод не поддерживается'}, status=405)
+    analysis = get_object_or_404(FloodAnalysis, pk=analysis_id)
+    if analysis.created_by != request.user and not request.user.is_staff:
+        return JsonResponse({'error': 'Нет доступа'}, status=403)
+    if analysis.status == 'processing':
+        return JsonResponse({'error': 'Анализ уже обрабатывается'}, status=409)
+    try:
+        threshold = float(request.POST.get('threshold', ''))
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный порог'}, status=400)
+    if not -1.0 <= threshold <= 1.0:
+        return JsonResponse({'error': 'Порог MNDWI должен быть от -1 до 1'}, status=400)
+    analysis.mndwi_threshold = threshold
+    analysis.status = 'pending'
+    analysis.error_message = ''
+    analysis.save(update_fields=['mndwi_threshold', 'status', 'error_message'])
+    process_flood_analysis_bg(analysis.id)
+    return JsonResponse({'id': analysis.id, 'status': analysis.status, 'mndwi_threshold': threshold})
+
+@login_required
+def dem_hand_stage(request, dem_id):
+    """
+    API: затопление по HAND при подъеме воды на ?stage=2 (м) - площадь из индекса DEM, без чтения растров;
+    с geojson=1 - контур затопления (строится в фоне: до готовности ответ 202). Без stage - кривая уровень-площадь.
+    """
+    dem = get_object_or_404(DEMFile, pk=dem_id)
+    if dem.uploaded_by != request.user and not dem.is_base_layer and not request.user.is_staff:
+        return JsonResponse({'error': 'Нет доступа'}, status=403)
+    if not dem.hand_index:
+        # HAND считается в фоне (вместе с гидрологической коррекцией); повторные запросы не ставят задачу повторно
+        enqueue_once(process_dem_hydrology_bg, dem.id)
+        return JsonResponse({'error': 'HAND для DEM еще не рассчитан, расчет поставлен в очередь'}, status=409)
+    index = dem.hand_index
+    stage = request.GET.get('stage')
+    if stage is None:
+        return JsonResponse({
+            'stages': [level * index['step'] for level in range(len(index['areas_sqkm']))],
+            'areas_sqkm': index['areas_sqkm'],
+        })
+    try:
+        stage = float(stage)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный уровень воды'}, status=400)
+    level = stage_level(index, stage)
+    if request.GET.get('geojson'):
+        if not (dem.hand_file and os.path.exists(dem.hand_file.path)):
+            return JsonResponse({'error': 'Растр HAND не найден'}, status=404)
+        extent_path = get_hand_extent(dem, stage, build=False)
+        if not extent_path:
+            # Контур строится в фоне, по уровню индекса (запросы с уровнями одного шага - одна задача)
+            enqueue_once(build_hand_extent_bg, dem.id, -1.0 if level is None else level * index['step'])
+            return JsonResponse({'status': 'pending', 'message': 'Контур затопления строится, повторите запрос позже'}, status=202)
+        # Файл отдается потоком, без разбора GeoJSON в памяти
+        return FileResponse(open(extent_path, 'rb'), content_type='application/geo+json')
+    return JsonResponse({
+        'stage': stage,
+        'index_stage': None if level is None else level * index['step'],
+        'area_sqkm': stage_area(index, stage),
+    })
+
 # API для GeoJSON (для Leaflet)
 def flood_zones_geojson(request):
     zones = FloodZone.objects.all()
@@ -0,0 +1,97 @@
+"""
+Рабочие каталоги задач для промежуточных файлов (заполненный DEM, аккумуляция, водотоки, направления стока).
+Каждая задача получает собственный каталог (tempfile.mkdtemp), который удаляется по ее завершении,
+поэтому параллельные задачи над DEM из одного каталога не перезаписывают файлы друг друга.
+Каталоги можно размещать на tmpfs (например, /dev/shm). Результаты задач заменяют файлы назначения атомарно.
+Модуль не зависит от Django.
+"""
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Префикс имени рабочего каталога; за ним - PID процесса задачи (по нему находятся каталоги завершившихся процессов)
+WORKSPACE_PREFIX = 'floodjob_'
+
+
+@contextmanager
+def scratch_workspace(base_dir=None, label='job'):
+    """
+    Собственный рабочий каталог задачи; удаляется при выходе из блока (и при исключении).
+    Args:
+        base_dir: каталог для рабочих каталогов (None - системный каталог временных файлов)
+        label: метка задачи в имени каталога
+    Returns:
+        путь к рабочему каталогу
+    """
+    if base_dir:
+        os.makedirs(base_dir, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}_{label}_", dir=base_dir)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Запись результата во временный файл рядом с path; при успешном выходе из блока файл заменяет path
+    (os.replace), при исключении удаляется. Параллельные задачи с одним файлом назначения
+    не видят недописанный файл друг друга.
+    Returns:
+        путь к временному файлу (с тем же расширением, что и path)
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=os.path.splitext(name)[1], dir=directory)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _process_alive(pid):
+    """Существует ли процесс pid."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def remove_stale_workspaces(base_dir=None):
+    """
+    Удаляет рабочие каталоги процессов, завершившихся без очистки (например, аварийно).
+    Args:
+        base_dir: каталог рабочих каталогов (None - системный каталог временных файлов)
+    Returns:
+        число удаленных каталогов
+    """
+    base_dir = base_dir or tempfile.gettempdir()
+    if not os.path.isdir(base_dir):
+        return 0
+    removed = 0
+    for entry in os.scandir(base_dir):
+        if not entry.name.startswith(WORKSPACE_PREFIX) or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            pid = int(entry.name[len(WORKSPACE_PREFIX):].split('_', 1)[0])
+        except ValueError:
+            continue
+        if not _process_alive(pid):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info(f"Удалено рабочих каталогов завершившихся задач: {removed}")
+    return removed
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -173,4 +174,50 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-ROOT_URLCONF = 'floodportal.urls'
\ No newline at end of file
+ROOT_URLCONF = 'floodportal.urls'
+
+# Параметры поблочной обработки растров анализа затоплений
+# Максимальное число пикселей в одном окне (определяет пиковое потребление памяти)
+FLOOD_ANALYSIS_WINDOW_PIXELS = 4 * 1024 * 1024
+# Число процессов для тайловой обработки сцены (1 - без пула процессов)
+FLOOD_ANALYSIS_WORKERS = os.cpu_count() or 1
+# Хранить растр классов анализа упакованным (2 бита на пиксель, NBITS=2)
+FLOOD_CLASS_RASTER_BIT_PACKED = True
+
+# Кэш артефактов этапов анализа (ключ - хэш входов этапа)
+FLOOD_ARTIFACT_CACHE_DIR = os.path.join(MEDIA_ROOT, 'artifact_cache')
+# Ограничение размера кэша масок постоянных вод в сетке снимков (вытесняются давно не использованные)
+FLOOD_PW_MASK_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Ограничение размера кэша каждого из остальных этапов (индекс MNDWI, классы, полигоны, мозаики DEM)
+FLOOD_STAGE_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+# EPSG-коды CRS (зоны UTM снимков), в которых хранятся заранее перепроецированные копии объектов водоёмов
+WATERBODY_PROJECTED_SRIDS = [32636, 32637, 32638]
+
+# Порог flow accumulation (ячеек) для водотоков при расчете HAND
+HAND_STREAM_THRESHOLD = 1000
+# Шаг (м) и максимальный уровень (м) индекса "уровень воды - площадь затопления" по HAND
+HAND_INDEX_STEP = 0.1
+HAND_INDEX_MAX_STAGE = 50.0
+# Ограничение размера кэша контуров затопления по HAND
+HAND_EXTENT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Профилирование анализа: учитывать пиковую память Python/numpy через tracemalloc (замедляет обработку)
+FLOOD_ANALYSIS_TRACEMALLOC = False
+# Отладочные проверки масок (np.unique - полный проход по растру) в журнале
+FLOOD_ANALYSIS_DEBUG_DIAGNOSTICS = False
+
+# Кэш декодированных растров (аккумуляция, HAND, маски постоянных вод) в разделяемой памяти узла:
+# ограничение общего размера (0 - отключен) и каталог описаний сегментов (локальный для узла)
+FLOOD_SHARED_RASTER_CACHE_BYTES = 1024 * 1024 * 1024
+FLOOD_SHARED_RASTER_INDEX_DIR = os.path.join(tempfile.gettempdir(), 'floodportal_shared_rasters')
+
+# Движок гидрологической коррекции DEM (заполнение понижений, аккумуляция D8):
+# 'native' - в процессе по массиву в памяти (flooddata/hydrology.py, с numba - JIT), 'whitebox' - WhiteboxTools
+HYDRO_ENGINE = 'native'
+# DEM больше этого числа пикселей обрабатывается по тайлам (память - на тайл, а не на весь DEM)
+HYDRO_IN_MEMORY_MAX_PIXELS = 100_000_000
+# Размер стороны тайла (пикселей) при обработке DEM по тайлам
+HYDRO_TILE_SIZE = 4096
+# Каталог рабочих каталогов задач для промежуточных файлов (None - системный каталог временных файлов).
+# Можно указать tmpfs, например '/dev/shm/floodportal_scratch'; каталоги задач удаляются по их завершении
+FLOOD_SCRATCH_DIR = None
@@ -67,6 +67,9 @@ urlpatterns = [
     path('api/flood-analysis/<int:analysis_id>/status/', views.check_analysis_status, name='check_analysis_status'),
     path('api/flood-analysis/<int:analysis_id>/geojson/', views.flood_analysis_geojson, name='flood_analysis_geojson'),
     path('api/flood-analysis/<int:analysis_id>/masks-geojson/', views.flood_analysis_masks_geojson, name='flood_analysis_masks_geojson'),
+    path('api/flood-analysis/<int:analysis_id>/threshold-area/', views.flood_analysis_threshold_area, name='flood_analysis_threshold_area'),
+    path('api/flood-analysis/<int:analysis_id>/revectorize/', views.revectorize_analysis, name='revectorize_analysis'),
+    path('api/dem/<int:dem_id>/hand-stage/', views.dem_hand_stage, name='dem_hand_stage'),
     path('api/flood-analyses-list/', views.flood_analyses_list, name='flood_analyses_list'),
     path('api/permanent-water/', views.permanent_water_geojson, name='permanent_water_geojson'),
 ]